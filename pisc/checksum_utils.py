@@ -31,6 +31,12 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 
+from operator import xor
+
+def nmea_checksum(data):
+    '''Return XOR of every character in data as an integer. Data shouldn't include the leading $ or the *.'''
+    return reduce(xor, bytearray(data), 0)
+
 # Check the NMEA sentence checksum. Return True if passes and False if failed
 def check_nmea_checksum(nmea_sentence):
     split_sentence = nmea_sentence.split('*')
@@ -41,8 +47,6 @@ def check_nmea_checksum(nmea_sentence):
 
     #Remove the $ at the front
     data_to_checksum = split_sentence[0][1:]
-    checksum = 0
-    for c in data_to_checksum:
-        checksum ^= ord(c)
+    checksum = nmea_checksum(data_to_checksum)
 
-    return ("%02X" % checksum) == transmitted_checksum.upper()
\ No newline at end of file
+    return ("%02X" % checksum) == transmitted_checksum.upper()
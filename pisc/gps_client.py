@@ -2,28 +2,166 @@
 
 import sys
 import socket
+import select
+import struct
 import logging
 import time
+import functools
+from collections import OrderedDict, deque
+
+from gps_protocol import binary_protocol, csv_protocol, connect_request, parse_connect_ack, decode, decode_sequenced
+from gps_protocol import heartbeat_message, remove_message, time_sync_request, command_types, timed_message_types
+from gps_protocol import multicast_option, heartbeat_option, ntp_option, sequence_option, sequenced_types
+from gps_protocol import shared_memory_option, requested_shared_memory
+from time_sync import TimeSync, SyncStats
+from link_stats import LinkStats
+from shared_memory import SharedMemoryReader
 
 def mean(l):
     return float(sum(l)) / max(len(l),1)
 
+def resolve(address):
+    '''Return (host, port) with host name looked up, so it can be compared to where packets come from.'''
+    try:
+        return (socket.gethostbyname(address[0]), address[1])
+    except socket.error:
+        return address # try again when sending
+
 class GPSClient():
     '''
     UDP client that makes connection with GPS server and then handles new data.
-    First call connect() and then start().
+    First call connect() and then start().  Call disconnect() when shutting down so server stops sending data.
+    If there's more than one server then the others are standbys.  They're sent time sync requests every so often,
+    which shows they're still there and keeps track of their time, and if the server stops sending data then
+    the client switches to the first standby that's still answering.  The time source keeps going the whole time.
     '''
-    def __init__(self, server_addr, controller, time_source, position_source, orientation_source, sync_time_thresh=0.015):
+    
+    # Reconnect if nothing is received from server for this long.
+    data_timeout = 7 # seconds
+    
+    # How often to send time sync requests until synced, and then after that to keep time up to date.
+    sync_request_period = 0.1 # seconds
+    resync_period = 4.0 # seconds
+    
+    # How often to log packet loss/delay stats.
+    stats_log_period = 60.0 # seconds
+    
+    # Most packets to take off a socket at once before going back to check on heartbeats and sync requests.
+    max_batch_size = 64
+    
+    # How many sync messages from the server (sync1/sync2) have to agree before the time is good enough.
+    sync_message_count = 5
+    
+    # Forget sync1 messages that haven't gotten a sync2 after this long, or once there are too many of them.
+    sync_message_timeout = 5.0 # seconds
+    max_pending_sync_messages = 50
+    
+    # Time without data before switching to a standby server.  Waits longer if the server normally sends data
+    # less often than this (e.g. 1 Hz GPS) so it doesn't switch between packets.
+    failover_timeout = 0.5 # seconds
+    
+    # How often to send standby servers a time sync request, and how long one can go without answering before
+    # it isn't switched to.
+    standby_probe_period = 0.25 # seconds
+    standby_timeout = 1.0 # seconds
+    
+    # Shortest time between switching servers, so it doesn't keep switching back and forth if none have data.
+    min_failover_interval = 5.0 # seconds
+    
+    def __init__(self, server_addr, controller, time_source, position_source, orientation_source, sync_time_thresh=0.015,
+                 protocol=binary_protocol, multicast=False, heartbeat_period=2.0, ntp=True, sequenced=True,
+                 shared_memory_path=None, shared_memory_poll_period=0.001):
         '''
-        Constructor. Server address is tuple of (host, port).   Sync time thresh (in seconds) sets how close
-        the client has to synchronize to the server time before calling it good enough.
+        Constructor. Server address is tuple of (host, port), or a list of them to switch between in order of
+        preference if one stops sending data.  Hosts should be the addresses replies come from.   Sync time thresh (in seconds) sets how close
+        the client has to synchronize to the server time before calling it good enough.  Protocol is what to ask
+        the server to send data in (see gps_protocol).  Falls back to CSV if the server doesn't support it.
+        If multicast is true then will ask to get time/position/orientation from the server's multicast group,
+        if it has one, instead of having the server send a copy just to this client.  Heartbeat period (in seconds)
+        is how often to let the server know this client is still running.  Set to 0 to not send heartbeats.
+        If ntp is true then client syncs its own time with the server (see time_sync) while data keeps coming
+        in, instead of the server holding data back until its sync finishes.  Only used if server supports it.
+        If sequenced is true then asks server to number packets so lost and out of order ones can be detected.
+        Shared memory path is where to read time/position/orientation from if the server is on this computer
+        and shares them there (see shared_memory).  Falls back to getting them over UDP if the server doesn't.
+        Shared memory poll period (in seconds) is how often to check it for new messages.  Reading it doesn't make
+        any system calls, but waiting between checks is a select() call each time, so a shorter period means less
+        delay but more CPU.
         '''
-        self.server_address = server_addr 
+        if isinstance(server_addr, tuple):
+            server_addr = [server_addr]
+        # Servers in order of preference and the one that's being used.  The rest are standbys.
+        self.server_addresses = [resolve(address) for address in server_addr]
+        self.server_address = self.server_addresses[0]
         self.controller = controller
         self.time_source = time_source
         self.position_source = position_source
         self.orientation_source = orientation_source
         self.sync_time_thresh = sync_time_thresh
+        self.requested_protocol = protocol
+        
+        # Protocol server agreed to send data in.  Figured out after connecting.
+        self.protocol = None
+        
+        self.multicast = multicast
+        self.heartbeat_period = heartbeat_period
+        
+        # System time to send next heartbeat to server.
+        self.next_heartbeat_time = 0
+        
+        # True if client asks to do its own time sync, and if the server agreed to it after connecting.
+        # Never syncs if the threshold is turned off since nothing would ever be good enough.
+        self.ntp = ntp and sync_time_thresh > 0
+        self.ntp_active = False
+        
+        # Accepted/rejected syncs, round trip times and how long syncing took.  Covers both kinds of sync.
+        self.sync_stats = SyncStats()
+        
+        # {server address: TimeSync} of round trips used for time sync with each server, and system time to send
+        # the next request.  Standbys are kept synced too so switching to one doesn't need a new sync.
+        self.time_syncs = dict((address, TimeSync(sync_time_thresh)) for address in self.server_addresses)
+        self.time_sync = self.time_syncs[self.server_address]
+        self.time_sync.stats = self.sync_stats
+        self.next_sync_request_time = 0
+        
+        # {standby server address: system time it last answered a time sync request}, and system time to send
+        # the next ones.
+        self.standby_reply_times = {}
+        self.next_probe_time = 0
+        
+        # System time of last switch to another server.
+        self.last_switch_time = 0
+        
+        # Average time (in seconds) between packets from server.
+        self.data_interval = 0.0
+        
+        # True if client asks for sequence numbers, and if the server agreed to send them after connecting.
+        self.sequenced = sequenced
+        self.sequence_active = False
+        
+        # Loss, reorder and delay of packets from server.  Can be checked at any time with link_stats.summary().
+        self.link_stats = LinkStats()
+        self.next_stats_log_time = time.time() + self.stats_log_period
+        
+        # Where to read timed messages from if server is sharing memory, or None to always use UDP.
+        self.shared_memory_path = shared_memory_path
+        self.shared_memory_poll_period = shared_memory_poll_period
+        self.shared_memory = None
+        
+        # System time that something new was last read from shared memory.
+        self.last_shared_memory_time = 0
+        
+        # Socket that's joined the server's multicast group, or None if not using multicast.
+        self.multicast_sock = None
+        self.multicast_address = None
+        
+        # True until the first time sync finishes.  Multicast data is ignored until then since the server
+        # can't hold it back like it does for data it sends straight to this client.
+        self.waiting_for_sync = False
+        
+        # True if connected with require_sync.  When syncing on our own the times in packets aren't used until then
+        # since they're off by however long the packets took to get here.
+        self.require_sync = False
     
         # UDP socket used to communicate with server.
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -34,148 +172,611 @@ class GPSClient():
         # Used to notify user that messages are being received.
         self.first_message_received = False
         
-        # Time-stamped sync messages originally received from client.
-        self.uncorrected_sync_messages = []
+        # {sync id: time-stamped sync message} originally received from server, oldest first.
+        self.uncorrected_sync_messages = OrderedDict()
         
-        # Sync messages that have been corrected to account for latency.
-        self.sync_messages = []
+        # Latest sync messages that have been corrected to account for latency.
+        self.sync_messages = deque(maxlen=self.sync_message_count)
         
         # True if received a sync message, but haven't successfully synced yet.
         self.syncing = False
+        
+        # (Server UTC time, system time) from newest packet in the batch being handled.  Only passed to the time
+        # source once the whole batch is done since only the newest one matters.
+        self.pending_time = None
+        
+        # {packet type: method that handles its fields}.  Each method takes (fields, receive time, handler address).
+        self.packet_handlers = {'t': self._handle_time,
+                                'p': self._handle_position,
+                                'f': self._handle_fix,
+                                'o': self._handle_orientation,
+                                'ts2': self._handle_time_sync_reply_packet,
+                                'sync1': self._handle_sync1,
+                                'sync2': self._handle_sync2}
+        for command_type in command_types:
+            self.packet_handlers[command_type] = functools.partial(self._handle_command, command_type)
     
-    def connect(self, require_sync):
+    def connect(self, require_sync, first_address=None, timeout=2):
         '''
-        Keep trying to connect to server until it acknowledges that it's there.
-        If require_sync is true then will request the server goes through the 
-        time sync procedure before sending data. This sync will happen in start().  
+        Keep trying to connect to server until it acknowledges that it's there.  If there are standby servers then
+        takes turns trying each one, starting with first address (default the current server).  Timeout is how many
+        seconds to wait for each one to answer.  If require_sync is true then will request the server goes through
+        the time sync procedure before sending data. This sync will happen in start().  
         '''
-        timeout = 2 # seconds
         connected = False
         
-        logging.getLogger().info('Connecting to server at {}:{}'.format(self.server_address[0], self.server_address[1]))
+        if first_address is None:
+            first_address = self.server_address
+        first_index = self.server_addresses.index(first_address)
+        addresses = self.server_addresses[first_index:] + self.server_addresses[:first_index]
+        
+        if require_sync:
+            self.waiting_for_sync = True
+            self.require_sync = True
         
+        attempt = 0
         while not connected:
+            # Give each server a try with both kinds of request before moving on to the next one.
+            address = addresses[(attempt // 2) % len(addresses)]
+            if attempt == 0 or (attempt % 2 == 0 and len(addresses) > 1):
+                logging.getLogger().info('Connecting to server at {}:{}'.format(address[0], address[1]))
             connect_command = 'sync' if require_sync else 'add'
-            self.sock.sendto(connect_command, self.server_address)
+            # Older servers ignore requests with a protocol in them so ask for plain CSV on every other attempt.
+            if attempt % 2 == 0:
+                request = connect_request(connect_command, self.requested_protocol, self._connect_options())
+            else:
+                request = connect_request(connect_command, csv_protocol)
+            attempt += 1
             try:
-                self.sock.settimeout(timeout)
+                self.sock.sendto(request, address)
                 # Make sure server sends some data back as an ack
-                data, self.handler_address = self.sock.recvfrom(1024)
-                if data != 'ack':
-                    continue # wrong ack
-            except socket.timeout:
-                continue # try again
+                ack = self._receive_ack(address, timeout)
+                if ack is None:
+                    continue # try again
+                self.protocol, multicast_address, options = ack
+                self.ntp_active = ntp_option in options
+                self.sequence_active = sequence_option in options
+                shared_memory = shared_memory_option in options
             except socket.error:
                 time.sleep(timeout)
                 continue
+            
+            if multicast_address is None:
+                self._leave_multicast()
+            elif not self._join_multicast(multicast_address):
+                # Have to tell server to send data straight to us instead.
+                self.multicast = False
+                continue
+            
+            if not shared_memory:
+                self._close_shared_memory()
+                if self.shared_memory_path is not None and requested_shared_memory(request):
+                    logging.getLogger().warning('Server isn\'t sharing memory. Getting data over UDP instead.')
+                    self.shared_memory_path = None
+            elif not self._open_shared_memory():
+                # Have to tell server to send data over UDP instead.
+                self.shared_memory_path = None
+                continue
 
             connected = True
             
-        logging.getLogger().info('Successfully connected.')
+        if address != self.server_address:
+            self._switch_server(address)
+            
+        if self.ntp_active or self.shared_memory is not None:
+            # Server doesn't hold anything back since it's not the one syncing.
+            self.waiting_for_sync = False
+            
+        logging.getLogger().info('Successfully connected using {} protocol.'.format(self.protocol))
+        if self.multicast_sock is not None:
+            logging.getLogger().info('Receiving data from multicast group {}:{}'.format(*self.multicast_address))
+        if self.shared_memory is not None:
+            logging.getLogger().info('Reading data from shared memory {}'.format(self.shared_memory_path))
+            
+    def _receive_ack(self, address, timeout):
+        '''
+        Return ack (see parse_connect_ack) from server at address, or None if it doesn't come within timeout seconds.
+        Anything else that comes in first is ignored.
+        '''
+        end_time = time.time() + timeout
+        while True:
+            remaining_time = end_time - time.time()
+            if remaining_time <= 0:
+                return None
+            self.sock.settimeout(remaining_time)
+            try:
+                data, source_address = self.sock.recvfrom(1024)
+            except socket.timeout:
+                return None
+            ack = parse_connect_ack(data)
+            # Could be a late ack from a server tried earlier, or a standby answering a time sync request.
+            if ack is not None and (len(self.server_addresses) == 1 or source_address == address):
+                self.handler_address = source_address
+                return ack
+            
+    def _switch_server(self, address):
+        '''Make server at address the one that data comes from.  The old one becomes a standby.'''
+        old_address = self.server_address
+        self.time_sync.stats = None
+        self.server_address = address
+        self.time_sync = self.time_syncs[address]
+        self.time_sync.stats = self.sync_stats
+        self.standby_reply_times.pop(address, None)
+        self.next_sync_request_time = 0
+        # New server numbers its packets on its own.
+        self.link_stats.reset_stream_positions()
+        self.last_switch_time = time.time()
+        logging.getLogger().warning('Switched from server {}:{} to {}:{}.'.format(old_address[0], old_address[1],
+                                                                                 address[0], address[1]))
+        
+    def _fail_over(self, last_data_time):
+        '''
+        Switch to first standby server that's still answering if there hasn't been data from the server for long
+        enough.  Return true if switched.
+        '''
+        if len(self.server_addresses) < 2:
+            return False
+        current_time = time.time()
+        failover_delay = max(self.failover_timeout, 3 * self.data_interval)
+        if current_time - last_data_time < failover_delay or current_time - self.last_switch_time < self.min_failover_interval:
+            return False
+        standby_address = next((address for address in self.server_addresses if address != self.server_address and
+                                current_time - self.standby_reply_times.get(address, 0) <= self.standby_timeout), None)
+        if standby_address is None:
+            return False
+        logging.getLogger().warning('No data from server {}:{} for {:.2f} seconds.'.format(self.server_address[0],
+                                                                      self.server_address[1], current_time - last_data_time))
+        try:
+            self.sock.sendto(remove_message, self.server_address)
+        except socket.error:
+            pass # probably why it stopped
+        self.last_switch_time = current_time
+        # Don't need to sync since time source already has a valid time reference.
+        self.connect(require_sync=False, first_address=standby_address, timeout=self.failover_timeout)
+        return True
+        
+    def _probe_standby_servers(self):
+        '''Send time sync request to each standby server if it's been long enough since the last ones.'''
+        if len(self.server_addresses) < 2 or time.time() < self.next_probe_time:
+            return
+        self.next_probe_time = time.time() + self.standby_probe_period
+        for address in self.server_addresses:
+            if address == self.server_address:
+                continue
+            try:
+                self.sock.sendto(time_sync_request(self.time_syncs[address].new_request()), address)
+            except socket.error:
+                pass # just won't answer
+                
+    def _process_standby_packet(self, data, address, receive_time):
+        '''Handle packet from standby server at address.  Only time sync replies are expected.'''
+        try:
+            packet_type, fields = decode(data)
+        except ValueError:
+            return
+        if packet_type != 'ts2':
+            return
+        sync_id, server_receive_time, server_send_time = fields[:3]
+        if self.time_syncs[address].add_reply(sync_id, server_receive_time, server_send_time, receive_time) is not None:
+            self.standby_reply_times[address] = receive_time
         
     def start(self):
         '''
         Infinite loop handling new data from server.  Must call connect() first.
         If connection to the server is lost then it will automatically try to reconnect.  
         '''
+        last_data_time = time.time()
         while True:
+            self._send_heartbeat()
+            self._send_time_sync_request()
+            self._probe_standby_servers()
+            self._log_link_stats()
+            
+            if self._fail_over(last_data_time):
+                last_data_time = time.time()
+                continue
+            
+            socks = [self.sock]
+            if self.multicast_sock is not None:
+                socks.append(self.multicast_sock)
+            
+            # Wake up in time to send the next heartbeat or sync request even if there's no data.
+            timeout = last_data_time + self.data_timeout
+            if self.heartbeat_period > 0:
+                timeout = min(timeout, self.next_heartbeat_time)
+            if self.ntp_active:
+                timeout = min(timeout, self.next_sync_request_time)
+            if self.shared_memory is not None:
+                timeout = min(timeout, time.time() + self.shared_memory_poll_period)
+            if len(self.server_addresses) > 1:
+                # Also in time to probe standbys and notice the server has gone quiet.
+                timeout = min(timeout, self.next_probe_time, last_data_time + max(self.failover_timeout, 3 * self.data_interval))
+            timeout = max(timeout - time.time(), 0)
             try:
-                self.sock.settimeout(7)
-                data, handler_address = self.sock.recvfrom(1024)
-            except (socket.timeout, socket.error):
+                readable, _, _ = select.select(socks, [], [], timeout)
+                batches = [(sock,) + self._receive_batch(sock) for sock in readable]
+            except socket.error:
+                batches = None
+                
+            data_received = False
+            if batches is not None:
+                if self.shared_memory is not None and self._read_shared_memory():
+                    data_received = True
+                for sock, datagrams, receive_time in batches:
+                    if sock is self.multicast_sock and self.waiting_for_sync:
+                        data_received = True
+                        continue # not allowed to use data yet
+                    # Server always puts sequence numbers on multicast packets.
+                    sequenced = self.sequence_active or sock is self.multicast_sock
+                    for data, handler_address in datagrams:
+                        if handler_address != self.server_address and handler_address in self.time_syncs:
+                            self._process_standby_packet(data, handler_address, receive_time)
+                            continue
+                        # Server answers time sync requests even if it's restarted and forgotten about this client.
+                        if self._process_packet(data, handler_address, sequenced, receive_time) != 'ts2':
+                            data_received = True
+                self._apply_pending_time()
+            
+            current_time = time.time()
+            if data_received:
+                self.data_interval += 0.1 * (current_time - last_data_time - self.data_interval)
+                last_data_time = current_time
+            elif batches is None or current_time - last_data_time > self.data_timeout or \
+                    (self.shared_memory is not None and current_time - self.last_shared_memory_time > self.data_timeout):
+                # Server could have restarted with new shared memory, and still be answering heartbeats.
                 logging.getLogger().warn('No data received from GPS server. Trying to reconnect.')
                 # Don't need to sync since already have valid time reference.
                 self.connect(require_sync=False)
-                continue
+                last_data_time = time.time()
+            
+    def _receive_batch(self, sock):
+        '''
+        Return (list of (data, address), system time first one was received) for every packet waiting on socket, up
+        to max batch size.  Raises socket.error if the first one can't be received.
+        '''
+        sock.settimeout(0)
+        datagrams = [sock.recvfrom(1024)]
+        receive_time = time.time()
+        while len(datagrams) < self.max_batch_size:
+            try:
+                datagrams.append(sock.recvfrom(1024))
+            except socket.error:
+                break # nothing left
+        return datagrams, receive_time
+            
+    def _open_shared_memory(self):
+        '''Start reading timed messages from shared memory. Return false if it couldn't be opened.'''
+        self._close_shared_memory()
+        try:
+            self.shared_memory = SharedMemoryReader(self.shared_memory_path)
+        except (EnvironmentError, ValueError) as e:
+            logging.getLogger().warning('Could not open shared memory {}. {}'.format(self.shared_memory_path, e))
+            return False
+        self.last_shared_memory_time = time.time()
+        return True
+    
+    def _close_shared_memory(self):
+        '''Stop reading from shared memory if using it.'''
+        if self.shared_memory is not None:
+            self.shared_memory.close()
+        self.shared_memory = None
         
-            self.process_data(data, handler_address)
+    def _read_shared_memory(self):
+        '''Handle any new messages in shared memory.  Return true if there were any.'''
+        messages = self.shared_memory.read_new()
+        if not messages:
+            return False
+        receive_time = time.time()
+        self.last_shared_memory_time = receive_time
+        for count, fields in messages:
+            # Same as a packet from the server, which has the time since the message was read in instead of when.
+            packet_type, utc_time, sys_time = fields[:3]
+            self._handle_packet(packet_type, [utc_time, receive_time - sys_time] + fields[3:], count, receive_time, None)
+        self._apply_pending_time()
+        return True
+    
+    def _connect_options(self):
+        '''Return list of options to put in connect request.'''
+        options = []
+        if self.multicast:
+            options.append(multicast_option)
+        if self.shared_memory_path is not None:
+            options.append(shared_memory_option)
+        if self.heartbeat_period > 0:
+            options.append(heartbeat_option)
+        if self.ntp and self.shared_memory_path is None:
+            # Shared memory is on the same clock as the server so there's nothing to sync.
+            options.append(ntp_option)
+        if self.sequenced:
+            options.append(sequence_option)
+        return options
+            
+    def _log_link_stats(self):
+        '''Log packet loss/delay stats if it's been long enough since the last time.'''
+        if time.time() < self.next_stats_log_time:
+            return
+        self.next_stats_log_time = time.time() + self.stats_log_period
+        report = self.link_stats.report()
+        if report:
+            logging.getLogger().info('Packets from server over the last minute\n{}'.format(report))
+    
+    def disconnect(self):
+        '''Tell server to stop sending data to this client.  Server doesn't reply so this doesn't block.'''
+        try:
+            self.sock.sendto(remove_message, self.server_address)
+        except socket.error:
+            pass # server will drop this client once heartbeats stop
+        self._leave_multicast()
+        self._close_shared_memory()
+            
+    def _send_heartbeat(self):
+        '''Let server know this client is still running if it's been long enough since the last heartbeat.'''
+        if self.heartbeat_period <= 0 or time.time() < self.next_heartbeat_time:
+            return
+        self.next_heartbeat_time = time.time() + self.heartbeat_period
+        try:
+            self.sock.sendto(heartbeat_message, self.server_address)
+        except socket.error:
+            pass # will reconnect if server really is gone
+            
+    def _accept_packet(self, packet_type, fields, sequence, receive_time):
+        '''Return true if packet is new enough to use.  Also updates link stats.'''
+        utc_time = None
+        delay = None
+        if packet_type in timed_message_types:
+            utc_time, time_delay = fields[:2]
+            if self.time_sync.synced():
+                # Server sent packet at UTC time + time delay.  Only know when it got here if synced on our own
+                # since otherwise the time came from the packets themselves.
+                delay = self.time_sync.utc_time(receive_time) - (utc_time + time_delay)
+        return self.link_stats.accept(packet_type, sequence, utc_time, delay)
+        
+    def _send_time_sync_request(self):
+        '''Send next time sync request if server answers them and it's been long enough since the last one.'''
+        if not self.ntp_active or time.time() < self.next_sync_request_time:
+            return
+        synced = self.time_sync.synced()
+        if not synced:
+            self.sync_stats.started()
+        period = self.resync_period if synced else self.sync_request_period
+        self.next_sync_request_time = time.time() + period
+        try:
+            self.sock.sendto(time_sync_request(self.time_sync.new_request()), self.server_address)
+        except socket.error:
+            pass # will reconnect if server really is gone
+            
+    def _handle_time_sync_reply(self, sync_id, server_receive_time, server_send_time, receive_time):
+        '''Add round trip to time sync and update time source once it's good enough.'''
+        was_synced = self.time_sync.synced()
+        sample = self.time_sync.add_reply(sync_id, server_receive_time, server_send_time, receive_time)
+        if sample is None:
+            return
+        if not self.time_sync.synced():
+            return
+        
+        if not was_synced:
+            # Start off with best round trip so far.
+            current_time = time.time()
+            self.sync_stats.round_finished(True, current_time)
+            self.time_source.set_time(self.time_sync.utc_time(current_time), current_time, self.time_sync.error())
+        elif sample.delay / 2.0 <= self.sync_time_thresh:
+            # Pass along each good round trip on its own so a time source that tracks clock drift (see 
+            # DisciplinedTimeSource) gets fresh samples instead of the same best one over and over.
+            self.time_source.set_time(receive_time + sample.offset, receive_time, sample.delay / 2.0)
+        
+        if not was_synced:
+            # log sync stats
+            delays = [sample.delay for sample in self.time_sync.samples]
+            logging.getLogger().info('Success\nDelay {} / {} error {} / {}'.format(int(mean(delays)*1000000),
+                                                                                 int(max(delays)*1000000),
+                                                                                 int(self.time_sync.error()*1000000),
+                                                                                 int(self.sync_time_thresh*1000000)))
+    
+    def _join_multicast(self, multicast_address):
+        '''Start receiving data from multicast (group, port). Return false if couldn't join group.'''
+        if self.multicast_sock is not None and self.multicast_address == multicast_address:
+            return True # already joined
+        
+        self._leave_multicast()
+        
+        group, port = multicast_address
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            # Allow more than one client on the same computer to join group.
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(('', port))
+            membership = struct.pack('4s4s', socket.inet_aton(group), socket.inet_aton('0.0.0.0'))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        except socket.error as e:
+            logging.getLogger().warning('Could not join multicast group {}:{}. {}'.format(group, port, e))
+            sock.close()
+            return False
+        
+        self.multicast_sock = sock
+        self.multicast_address = multicast_address
+        return True
+    
+    def _leave_multicast(self):
+        '''Stop receiving data from multicast group if joined one.'''
+        if self.multicast_sock is not None:
+            self.multicast_sock.close()
+        self.multicast_sock = None
+        self.multicast_address = None
 
-    def process_data(self, data, handler_address):
-        '''Parse data then handle it if it's valid.'''
-        fields = [f.strip() for f in data.split(',') if f.strip()]
-        packet_type = fields[0]
+    def process_data(self, data, handler_address, sequenced=False):
+        '''
+        Parse data then handle it if it's valid.  Data can be in any protocol since binary packets are marked.
+        If sequenced is true then packets that get sequence numbers have one on the end.  Duplicate, out of order
+        or stale packets are thrown out.
+        '''
+        self._process_packet(data, handler_address, sequenced, time.time())
+        self._apply_pending_time()
+        
+    def _process_packet(self, data, handler_address, sequenced, receive_time):
+        '''
+        Parse and handle one packet received at system receive time.  Any new time is saved in pending time instead of
+        being passed to the time source, so call _apply_pending_time() once done with every packet that came in together.
+        Return packet type, or None if packet is invalid.
+        '''
+        try:
+            if sequenced:
+                packet_type, fields, sequence = decode_sequenced(data)
+            else:
+                packet_type, fields = decode(data)
+                sequence = None
+        except ValueError:
+            logging.getLogger().warning('Invalid packet {}'.format(repr(data)))
+            return None
+        
+        self._handle_packet(packet_type, fields, sequence, receive_time, handler_address)
+        return packet_type
+        
+    def _handle_packet(self, packet_type, fields, sequence, receive_time, handler_address):
+        '''
+        Use fields from packet of type (see gps_protocol) that was received at system receive time.  Sequence is
+        its sequence number or None if it doesn't have one.  Handler address is where the packet came from, or None
+        if it was read from shared memory.
+        '''
+        if packet_type in sequenced_types and not self._accept_packet(packet_type, fields, sequence, receive_time):
+            return
         
         if not self.first_message_received:
             self.first_message_received = True
             logging.getLogger().info('Messages being received.')
+            
+        handler = self.packet_handlers.get(packet_type)
+        if handler is None:
+            logging.getLogger().warning('Unhandled packet of type {}'.format(packet_type))
+            return
+        handler(fields, receive_time, handler_address)
+        
+    def _new_time(self, utc_time, time_delay, receive_time):
+        '''
+        Save server UTC time that a packet was sent (UTC time it was read in + time delay) if it's the newest one in
+        the current batch.  The newest one spent the least time waiting to be received so it's the most accurate.
+        '''
+        send_time = utc_time + time_delay
+        if self.pending_time is None or send_time > self.pending_time[0]:
+            self.pending_time = (send_time, receive_time)
+            
+    def _apply_pending_time(self):
+        '''Pass newest time from packets that were just handled to time source.'''
+        if self.pending_time is None:
+            return
+        utc_time, receive_time = self.pending_time
+        self.pending_time = None
+        if self.require_sync and self.ntp_active and not self.time_sync.synced():
+            return # time source would lock onto a time that doesn't account for latency
+        self.time_source.set_time(utc_time, receive_time)
+        
+    def _handle_time(self, fields, receive_time, handler_address):
+        '''Handle time packet (UTC time, time delay).'''
+        self._new_time(fields[0], fields[1], receive_time)
+            
+    def _handle_position(self, fields, receive_time, handler_address):
+        '''Handle position packet (UTC time, time delay, x, y, z, zone).'''
+        utc_time, time_delay, x, y, z, zone = fields[:6]
+        self._new_time(utc_time, time_delay, receive_time)
+        # Store reported time for position since that was the exact time it was measured.
+        self.position_source.position = (utc_time, (x, y, z), zone)
+            
+    def _handle_fix(self, fields, receive_time, handler_address):
+        '''Handle fix packet (position packet fields plus fix type, hdop, satellites, x/y error, speed, course).'''
+        utc_time, time_delay, x, y, z, zone = fields[:6]
+        self._new_time(utc_time, time_delay, receive_time)
+        # Set fix first so it's ready by the time anything waiting on the new position wakes up.
+        self.position_source.fix = {'utc_time': utc_time,
+                                    'fix_type': fields[6],
+                                    'hdop': fields[7],
+                                    'num_satellites': fields[8],
+                                    'x_error': fields[9],
+                                    'y_error': fields[10],
+                                    'speed': fields[11],
+                                    'course': fields[12]}
+        # Store reported time for position since that was the exact time it was measured.
+        self.position_source.position = (utc_time, (x, y, z), zone)
+            
+    def _handle_orientation(self, fields, receive_time, handler_address):
+        '''Handle orientation packet (UTC time, time delay, roll, pitch, yaw).'''
+        utc_time, time_delay, roll, pitch, yaw = fields[:5]
+        self._new_time(utc_time, time_delay, receive_time)
+        # Store reported time for orientation since that was the exact time it was measured.
+        self.orientation_source.orientation = (utc_time, (roll, pitch, yaw))
+            
+    def _handle_command(self, command_type, fields, receive_time, handler_address):
+        '''Handle command packet (target, command, optional UTC time to run it) of type ct, cn or ci.'''
+        target, command = fields[:2]
+        execute_time = fields[2] if len(fields) > 2 else None
+        if self.controller is None:
+            logging.getLogger().warning('No sensor controller to run command {} for {}.'.format(command, target))
+            return
+        self.controller.handle_command(command_type, target, command, execute_time)
         
-        if packet_type == 't':
-            utc_time = float(fields[1])
-            time_delay = float(fields[2])
-            self.time_source.set_time(utc_time + time_delay, time.time())
-            
-        elif packet_type == 'p':
-            utc_time = float(fields[1])
-            time_delay = float(fields[2])
-            x = float(fields[3])
-            y = float(fields[4])
-            z = float(fields[5])
-            zone = fields[6]
-            self.time_source.set_time(utc_time + time_delay, time.time())
-            # Store reported time for position since that was the exact time it was measured.
-            self.position_source.position = (utc_time, (x, y, z), zone)
-            
-        elif packet_type == 'o':
-            utc_time = float(fields[1])
-            time_delay = float(fields[2])
-            roll = float(fields[3])
-            pitch = float(fields[4])
-            yaw = float(fields[5])
-            self.time_source.set_time(utc_time + time_delay, time.time())
-            # Store reported time for orientation since that was the exact time it was measured.
-            self.orientation_source.orientation = (utc_time, (roll, pitch, yaw))
-            
-        elif packet_type == 'sync1':
-            if not self.syncing:
-                self.syncing = True
-                logging.getLogger().info('Syncing')
-            sync_id = int(fields[1])
-            utc_time = float(fields[2])
-            system_time = time.time()
-            self.uncorrected_sync_messages.append({"id":sync_id, "utc_time":utc_time, "sys_time":system_time})
-            # Ack sync message so client can calculate round trip time (RTT)
-            self.sock.sendto(str(sync_id), handler_address)
-            
-        elif packet_type == 'sync2':
-            sync_successful = False
-            sync_id = int(fields[1])
-            rtt = float(fields[2]) # round trip time
-            estimated_latency = rtt / 2.0
-            matching_messages = [message for message in self.uncorrected_sync_messages if message['id'] == sync_id]
-            if len(matching_messages) == 1:
-                matching_message = matching_messages[0]
-                # Add in latency now that we know it.
-                matching_message['utc_time'] += estimated_latency
-                matching_message['latency'] = estimated_latency
-                self.sync_messages.append(matching_message)
-                self.uncorrected_sync_messages.remove(matching_message)
+    def _handle_time_sync_reply_packet(self, fields, receive_time, handler_address):
+        '''Handle ts2 packet (sync id, UTC time request received, UTC time reply sent).'''
+        sync_id, server_receive_time, server_send_time = fields[:3]
+        self._handle_time_sync_reply(sync_id, server_receive_time, server_send_time, receive_time)
+            
+    def _handle_sync1(self, fields, receive_time, handler_address):
+        '''Handle first message of server run time sync (sync id, UTC time) by acking it.'''
+        if not self.syncing:
+            self.syncing = True
+            logging.getLogger().info('Syncing')
+        sync_id, utc_time = fields[:2]
+        self.sync_stats.started(receive_time)
+        self._expire_sync_messages(receive_time)
+        self.uncorrected_sync_messages[sync_id] = {"id":sync_id, "utc_time":utc_time, "sys_time":receive_time}
+        # Ack sync message so client can calculate round trip time (RTT)
+        self.sock.sendto(str(sync_id), handler_address)
+            
+    def _expire_sync_messages(self, current_time):
+        '''Forget oldest sync messages that are too old to get a sync2, or that there's no room left for.'''
+        while self.uncorrected_sync_messages:
+            oldest = next(self.uncorrected_sync_messages.itervalues())
+            if (current_time - oldest['sys_time'] <= self.sync_message_timeout and
+                    len(self.uncorrected_sync_messages) < self.max_pending_sync_messages):
+                break
+            del self.uncorrected_sync_messages[oldest['id']]
+            self.sync_stats.expired_requests += 1
+            
+    def _handle_sync2(self, fields, receive_time, handler_address):
+        '''Handle second message of server run time sync (sync id, round trip time) and tell server if synced.'''
+        sync_successful = False
+        sync_id, rtt = fields[:2] # rtt is round trip time
+        estimated_latency = rtt / 2.0
+        matching_message = self.uncorrected_sync_messages.pop(sync_id, None)
+        if matching_message is not None:
+            # Add in latency now that we know it.
+            matching_message['utc_time'] += estimated_latency
+            matching_message['latency'] = estimated_latency
+            self.sync_messages.append(matching_message)
+            self.sync_stats.add_rtt(rtt)
 
-                if len(self.sync_messages) >= 5:
-                    current_time = time.time()
-                    # Take into account elapsed time since sync messages were received.  These should (hopefully) all be close to the same time now.
-                    current_sync_times = [(m['utc_time'] + (current_time - m['sys_time'])) for m in self.sync_messages]
-                    
-                    avg_time = mean(current_sync_times)
-                    #avg_offset = mean([abs(t-avg_time) for t in current_sync_times])
-                    max_offset = max([abs(t-avg_time) for t in current_sync_times])
+            if len(self.sync_messages) >= self.sync_message_count:
+                current_time = time.time()
+                # Take into account elapsed time since sync messages were received.  These should (hopefully) all be close to the same time now.
+                current_sync_times = [(m['utc_time'] + (current_time - m['sys_time'])) for m in self.sync_messages]
+                
+                avg_time = mean(current_sync_times)
+                #avg_offset = mean([abs(t-avg_time) for t in current_sync_times])
+                max_offset = max([abs(t-avg_time) for t in current_sync_times])
 
-                    sync_successful = max_offset < self.sync_time_thresh
+                sync_successful = max_offset < self.sync_time_thresh
+                self.sync_stats.round_finished(sync_successful, current_time)
+                
+                if sync_successful:
+                    self.time_source.set_time(avg_time, current_time, max_offset)
+                    self.waiting_for_sync = False
+                    # log sync stats
+                    latencies = [m['latency'] for m in self.sync_messages]
+                    logging.getLogger().info('Success\nLatency {} / {} thresh {} / {}'.format(int(mean(latencies)*1000000),
+                                                                                              int(max(latencies)*1000000),
+                                                                                              int(max_offset*1000000),
+                                                                                              int(self.sync_time_thresh*1000000)))
+                else:
+                    self.sync_messages.clear()
+                    # Print additional period to show that it's still trying to sync
+                    sys.stdout.write('.')
+                    sys.stdout.flush()
                     
-                    if sync_successful:
-                        self.time_source.set_time(avg_time, current_time)
-                        # log sync stats
-                        latencies = [m['latency'] for m in self.sync_messages]
-                        logging.getLogger().info('Success\nLatency {} / {} thresh {} / {}'.format(int(mean(latencies)*1000000),
-                                                                                                  int(max(latencies)*1000000),
-                                                                                                  int(max_offset*1000000),
-                                                                                                  int(self.sync_time_thresh*1000000)))
-                    else:
-                        self.sync_messages = []
-                        # Print additional period to show that it's still trying to sync
-                        sys.stdout.write('.')
-                        sys.stdout.flush()
-                        
-            self.sock.sendto(str(sync_successful).lower(), handler_address)
-
-        else:
-            logging.getLogger().warning('Unhandled packet of type {}'.format(packet_type))
+        self.sock.sendto(str(sync_successful).lower(), handler_address)
@@ -0,0 +1,590 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import math
+import select
+import threading
+from Queue import Queue, Full, Empty
+
+from nmea_parser import check_and_parse_nmea_sentence, UTCDate
+
+if os.name == 'nt':
+    import winsound
+
+# Fix quality indicator in GGA message.
+gga_fix_types = { '0': 'None',
+                  '1': 'GPS',
+                  '2': 'DGPS',
+                  '3': 'PPS',
+                  '4': 'Fixed RTK',
+                  '5': 'Float/Location RTK or OmniStar',
+                  '6': 'Dead Reckoning',
+                  '7': 'Manual',
+                  '8': 'Simulation' }
+
+# GPS quality indicator in Trimble PTNL AVR message.
+avr_fix_types = { '0': 'None',
+                  '1': 'Autonomous',
+                  '2': 'RTK Float',
+                  '3': 'RTK Fix',
+                  '4': 'DGPS' }
+
+def sound_alert():
+    '''Make an alert noise to get operator's attention.'''
+    beep_freq = 700 # Hz
+    beep_duration = 325 # ms
+    if os.name == 'nt':
+        winsound.Beep(beep_freq, beep_duration)
+    else:
+        print '\a' # Cross platform alert noise
+
+class Feedback(threading.Thread):
+    '''
+    Prints console messages and sounds alerts on a background thread so operator feedback can never delay data
+    from going out.  Messages of the same kind are limited to one per min period and the rest are counted.
+    Once the queue fills up new feedback is dropped instead of waiting.
+    '''
+    def __init__(self, min_period=1.0, max_queued=100):
+        '''Constructor. Min period is in seconds.'''
+        super(Feedback, self).__init__()
+        self.min_period = min_period
+        self.queue = Queue(max_queued)
+        
+        # {kind: time last message of that kind was shown}
+        self.last_shown_times = {}
+        
+        # {kind: number of messages of that kind skipped since last one was shown}
+        self.skipped_counts = {}
+        
+        # Number of messages that didn't fit in queue.
+        self.dropped_count = 0
+        
+    def message(self, text, kind=None):
+        '''Queue up message to be printed. If kind is specified then will be rate limited with other messages of that kind.'''
+        if kind is not None:
+            if not self._should_show(kind):
+                return
+            skipped_count = self.skipped_counts.pop(kind, 0)
+            if skipped_count > 0:
+                text = '{} ({} more since last shown)'.format(text, skipped_count)
+        self._put(('message', text))
+        
+    def alert(self):
+        '''Queue up an alert noise.  Rate limited so it doesn't go off constantly.'''
+        if self._should_show('alert'):
+            self._put(('alert', None))
+            
+    def progress(self, text='.'):
+        '''Queue up text to write without a new line.'''
+        self._put(('progress', text))
+        
+    def run(self):
+        '''Thread start method. Show feedback as it's queued up.'''
+        while True:
+            feedback_type, text = self.queue.get(block=True, timeout=None)
+            if feedback_type == 'message':
+                print text
+            elif feedback_type == 'progress':
+                sys.stdout.write(text)
+                sys.stdout.flush()
+            elif feedback_type == 'alert':
+                sound_alert()
+                
+    def _should_show(self, kind):
+        '''Return true if enough time has passed since last feedback of kind was shown. Otherwise count it as skipped.'''
+        current_time = time.time()
+        if current_time - self.last_shown_times.get(kind, 0) < self.min_period:
+            self.skipped_counts[kind] = self.skipped_counts.get(kind, 0) + 1
+            return False
+        self.last_shown_times[kind] = current_time
+        return True
+        
+    def _put(self, feedback):
+        '''Add feedback to queue without blocking.'''
+        try:
+            self.queue.put(feedback, block=False)
+        except Full:
+            self.dropped_count += 1
+
+class ReceiverGate(object):
+    '''
+    Keeps track of the fix and precision of a single GPS receiver to decide if its data is good enough to send out.
+    '''
+    # How long (seconds of UTC time) error from a GST message can be used for fixes in later epochs without one.
+    max_gst_age = 2.0
+
+    def __init__(self, name, feedback, required_fix='none', required_precision=-1, required_heading_fix='none'):
+        '''
+        Constructor. Name is used in feedback shown to the user through the Feedback thread.  Required fix is a GGA
+        fix type (see gga_fix_types) and required heading fix is an AVR GPS quality (see avr_fix_types), or 'none' to
+        allow any fix.  Required precision is the max standard deviation (in meters) of the latitude/longitude error,
+        or not positive to not check it.
+        '''
+        self.name = name
+        self.feedback = feedback
+        self.required_fix = required_fix
+        self.required_precision = required_precision
+        self.required_heading_fix = required_heading_fix
+
+        # Initialize last_fix and last_error as values that will never occur
+        self.last_fix = '-1'
+        self.last_heading_fix = '-1'
+        self.last_error = -1.0
+
+        self.missing_gst_count = 0 # how many fixes in a row didn't have a GST message.
+
+        # (UTC time, latitude error, longitude error) from last GST message, or None if there hasn't been one.
+        self.last_gst = None
+
+    def gst_error(self, utc_time, lat_error, long_error):
+        '''
+        Return (latitude error, longitude error) for a fix at UTC time.  If error from the GST in the same epoch is
+        missing (NaN) then uses the last GST error if it's within max GST age, since many receivers send GST slower
+        than GGA.  Still NaN if there isn't a recent enough one.
+        '''
+        if not (math.isnan(lat_error) or math.isnan(long_error)):
+            self.last_gst = (utc_time, lat_error, long_error)
+            return lat_error, long_error
+
+        if self.last_gst is not None and abs(utc_time - self.last_gst[0]) <= self.max_gst_age:
+            return self.last_gst[1:]
+
+        return lat_error, long_error
+
+    def precision_allowed(self, lat_error, long_error):
+        '''Return true if latitude/longitude error (from a recent GST message, see gst_error) is within required precision.'''
+        if self.required_precision <= 0:
+            return True
+
+        if math.isnan(lat_error) or math.isnan(long_error):
+            # Can't tell how good the position is without a GST message.
+            self.missing_gst_count += 1
+            if self.missing_gst_count > 100:
+                self.feedback.message('{}: Received {} GGA messages without a GST message'.format(self.name, self.missing_gst_count))
+                self.missing_gst_count = 0
+            return False
+
+        self.missing_gst_count = 0
+
+        current_error = max(lat_error, long_error)
+
+        if current_error > self.required_precision:
+
+            self.feedback.alert()
+
+            if current_error != self.last_error:
+
+                self.feedback.message('{}: Current error of {}m is too large.'.format(self.name, current_error))
+                self.last_error = current_error
+
+            return False
+
+        if current_error != self.last_error:
+
+            self.feedback.message('{}: Required Precision of {}m achieved. Data being logged.'.format(self.name, self.required_precision))
+            self.last_error = current_error
+
+        return True
+
+    def position_allowed(self, fix):
+        '''Return true if position with GGA fix type (as a string) should be sent out.'''
+        if self.required_fix != 'none' and fix != self.required_fix:
+
+            if fix != self.last_fix:
+                self.last_fix = fix
+                self.feedback.message('{}: Insufficient fix: {}'.format(self.name, gga_fix_types.get(fix, fix)))
+
+            return False # bad fix
+
+        if fix != self.last_fix:
+            self.last_fix = fix
+            self.feedback.message('{}: Current fix: {}'.format(self.name, gga_fix_types.get(fix, fix)))
+
+        return True
+
+    def orientation_allowed(self, fix):
+        '''Return true if orientation with AVR GPS quality (as a string) should be sent out.'''
+        if self.required_heading_fix != 'none' and fix != self.required_heading_fix:
+
+            if fix != self.last_heading_fix:
+                self.last_heading_fix = fix
+                self.feedback.message('{}: Insufficient heading fix: {}'.format(self.name, avr_fix_types.get(fix, fix)))
+
+            return False # bad fix
+
+        if fix != self.last_heading_fix:
+            self.last_heading_fix = fix
+            self.feedback.message('{}: Current heading fix: {}'.format(self.name, avr_fix_types.get(fix, fix)))
+
+        return True
+
+class EpochCoalescer(object):
+    '''
+    Groups the GGA, GST and RMC sentences from one receiver that share the same UTC time (an epoch) so they can be
+    published together as one fix.  An epoch is finished once every coalesced type has arrived, a sentence from a
+    newer epoch shows up or it's been open for longer than the epoch timeout.  Receivers often send GST or RMC
+    slower than GGA so there's no way to know ahead of time which types an epoch will get.  If the time jumps back
+    by more than a few epochs (e.g. a test file looping or midnight rollover) it's treated as a new stream instead
+    of late sentences.
+    '''
+    coalesced_types = ('GGA', 'GST', 'RMC')
+
+    # How long (seconds of system time) after its first sentence was read to wait on the rest of an epoch.
+    epoch_timeout = 0.2
+
+    # How many epochs time has to jump back before it's a new stream rather than late sentences.
+    restart_epochs = 3
+
+    # Time between epochs (seconds) to assume until it's been measured.
+    default_epoch_interval = 1.0
+
+    def __init__(self):
+        '''Constructor.'''
+        # UTC time of epoch currently being filled in, or None if there isn't one.
+        self.epoch_time = None
+
+        # System time that the first sentence in the current epoch was read in.
+        self.epoch_read_time = None
+
+        # {sentence type: parsed data} for current epoch.
+        self.epoch_data = {}
+
+        # UTC time of the last epoch that was finished.  Sentences at or before this are too late to use.
+        self.last_finished_time = None
+
+        # Shortest time seen between finished epochs, or None if it hasn't been measured yet.
+        self.epoch_interval = None
+
+    def add(self, sentence_type, data, read_time):
+        '''
+        Add parsed sentence (that has a valid utc_time) to its epoch.
+        Return list of (utc_time, read_time, {sentence type: data}) for every epoch this finished.
+        '''
+        finished_epochs = self.expire(read_time)
+        utc_time = data['utc_time']
+
+        if self._restarted(utc_time):
+            finished_epochs.extend(self.flush())
+            self.last_finished_time = None
+
+        if self.epoch_time is not None and utc_time > self.epoch_time:
+            finished_epochs.append(self._finish())
+
+        late = (self.epoch_time is not None and utc_time < self.epoch_time) or \
+               (self.last_finished_time is not None and utc_time <= self.last_finished_time)
+        if late:
+            return finished_epochs # epoch was already sent without it
+
+        if self.epoch_time is None:
+            self.epoch_time = utc_time
+            self.epoch_read_time = read_time
+
+        self.epoch_data[sentence_type] = data
+
+        if len(self.epoch_data) == len(self.coalesced_types):
+            finished_epochs.append(self._finish())
+
+        return finished_epochs
+
+    def expire(self, current_time):
+        '''
+        Return list of (utc_time, read_time, {sentence type: data}) for the current epoch if it's been open longer
+        than the epoch timeout as of system current time.
+        '''
+        if self.epoch_time is None or current_time - self.epoch_read_time <= self.epoch_timeout:
+            return []
+        return [self._finish()]
+
+    def flush(self):
+        '''Return list of (utc_time, read_time, {sentence type: data}) for the current epoch if there is one.'''
+        if self.epoch_time is None:
+            return []
+        return [self._finish()]
+
+    def _restarted(self, utc_time):
+        '''Return true if UTC time is so far before the newest epoch that it must be from a new stream.'''
+        newest_time = self.epoch_time if self.epoch_time is not None else self.last_finished_time
+        if newest_time is None:
+            return False
+        interval = self.epoch_interval or self.default_epoch_interval
+        return utc_time < newest_time - self.restart_epochs * interval
+
+    def _finish(self):
+        '''Return current epoch as (utc_time, read_time, {sentence type: data}) and start a new one.'''
+        epoch = (self.epoch_time, self.epoch_read_time, self.epoch_data)
+        if self.last_finished_time is not None and self.epoch_time > self.last_finished_time:
+            interval = self.epoch_time - self.last_finished_time
+            self.epoch_interval = interval if self.epoch_interval is None else min(self.epoch_interval, interval)
+        self.last_finished_time = self.epoch_time
+        self.epoch_time = None
+        self.epoch_read_time = None
+        self.epoch_data = {}
+        return epoch
+
+class NMEASource(object):
+    '''
+    One GPS receiver (read through an NMEAFramer) or test file (played through an NMEAReplay) along with the
+    gate that decides if its data is good enough to use.
+    '''
+    def __init__(self, name, gate, framer=None, replay=None):
+        '''Constructor. Exactly one of framer or replay should be specified.'''
+        self.name = name
+        self.gate = gate
+        self.framer = framer
+        self.replay = replay
+
+        # Groups sentences from this source into one fix per epoch.
+        self.epochs = EpochCoalescer()
+
+        # Date that this source's times are on.  Each source has its own so one receiver (or test file) passing
+        # midnight or sending a different date doesn't change the date of another.
+        self.utc_date = UTCDate()
+
+    def fileno(self):
+        '''Return file descriptor of serial port so it can be used with select(), or None if it's not supported.'''
+        if self.framer is None or os.name == 'nt':
+            return None # can't select on serial ports in windows.
+        try:
+            return self.framer.port.fileno()
+        except (AttributeError, IOError, ValueError):
+            return None
+
+class NMEAMultiplexer(object):
+    '''
+    Reads sentences from several NMEA sources on a single thread. Serial ports are waited on with select() and test
+    files are scheduled by when their next sentence is due.  Serial ports that can't be selected (e.g. on Windows)
+    are polled instead.
+    '''
+    # How often to check serial ports that can't be selected.
+    poll_period = 0.005 # seconds
+
+    def __init__(self, sources):
+        '''Constructor.'''
+        self.sources = sources
+
+    def sentences(self):
+        '''Generator that yields (source, sentence, read_time) until every source is finished.'''
+        selectable = [source for source in self.sources if source.fileno() is not None]
+        polled = [source for source in self.sources if source.framer is not None and source.fileno() is None]
+        replays = [source for source in self.sources if source.replay is not None]
+
+        while selectable or polled or replays:
+
+            # Figure out how long until next test file sentence is due.
+            timeout = None
+            for source in list(replays):
+                due_time = source.replay.next_due_time()
+                if due_time is None:
+                    replays.remove(source) # finished playing
+                    continue
+                time_until_due = max(due_time - time.time(), 0)
+                timeout = time_until_due if timeout is None else min(timeout, time_until_due)
+
+            if polled:
+                timeout = self.poll_period if timeout is None else min(timeout, self.poll_period)
+
+            if not (selectable or polled or replays):
+                break
+
+            # Block until a serial port has data or a test file sentence is due.
+            ready = []
+            if selectable:
+                ready, _, _ = select.select(selectable, [], [], timeout)
+            elif timeout is not None:
+                time.sleep(timeout)
+
+            for source in ready:
+                for sentence, read_time in source.framer.read_waiting():
+                    yield source, sentence, read_time
+
+            for source in polled:
+                for sentence, read_time in source.framer.read_waiting():
+                    yield source, sentence, read_time
+
+            for source in replays:
+                for sentence, read_time in source.replay.due_sentences():
+                    yield source, sentence, read_time
+
+class NMEAReader(threading.Thread):
+    '''
+    First stage of GPS ingest. Reads sentences from every source and queues them up along with the time they were
+    read in.  Queues None once all sources are finished.
+    '''
+    def __init__(self, multiplexer, sentence_queue):
+        '''Constructor.'''
+        super(NMEAReader, self).__init__()
+        self.multiplexer = multiplexer
+        self.sentence_queue = sentence_queue
+        
+    def run(self):
+        '''Thread start method. Queue up (source, sentence, read_time) for every sentence.'''
+        for sentence in self.multiplexer.sentences():
+            self.sentence_queue.put(sentence)
+        self.sentence_queue.put(None)
+
+class SentenceProcessor(threading.Thread):
+    '''
+    Second stage of GPS ingest. Parses sentences, groups the ones from the same epoch into a single fix, checks
+    them against their source's gate and hands good fix/orientation data to the publisher.
+    '''
+    def __init__(self, sentence_queue, publisher, feedback, display_count=10):
+        '''
+        Constructor. Publisher needs new_fix() and new_orientation() methods like GPSServer.
+        Display count is how many fixes to send before displaying feedback character.
+        '''
+        super(SentenceProcessor, self).__init__()
+        self.sentence_queue = sentence_queue
+        self.publisher = publisher
+        self.feedback = feedback
+        self.display_count = display_count
+        
+        self.send_counter = 0 # number of fix messages sent
+        
+        # Every source that's sent a sentence so their last epoch can be flushed out at the end.
+        self.sources = set()
+        
+    def run(self):
+        '''Thread start method. Process sentences until reader is finished.'''
+        while True:
+            try:
+                queued_sentence = self.sentence_queue.get(block=True, timeout=EpochCoalescer.epoch_timeout)
+            except Empty:
+                self.expire()
+                continue
+            if queued_sentence is None:
+                break # no more sentences
+            self.process(*queued_sentence)
+        self.flush()
+        
+    def process(self, nmea_source, nmea_string, message_read_time):
+        '''Parse and gate sentence. Message read time is the time (in seconds) that the sentence was read in.'''
+        checksum_valid, parsed_sentence = check_and_parse_nmea_sentence(nmea_string, nmea_source.utc_date)
+        if not checksum_valid:
+            self.feedback.message("Received a sentence with an invalid checksum. Sentence was: {}".format(repr(nmea_string)), 'checksum')
+            return
+        
+        if not parsed_sentence:
+            self.feedback.message("Failed to parse NMEA sentence. Sentence was: {}".format(nmea_string), 'parse')
+            return
+        
+        self.sources.add(nmea_source)
+        
+        for sentence_type in EpochCoalescer.coalesced_types:
+            if sentence_type in parsed_sentence:
+                data = parsed_sentence[sentence_type]
+                if math.isnan(data['utc_time']):
+                    self.feedback.message('Invalid UTC time: {}'.format(data['utc_time']), 'time')
+                    return
+                for epoch in nmea_source.epochs.add(sentence_type, data, message_read_time):
+                    self._process_fix(nmea_source.gate, *epoch)
+            
+        if 'AVR' in parsed_sentence:
+            self._process_orientation(nmea_source.gate, parsed_sentence['AVR'], message_read_time)
+            
+    def expire(self):
+        '''Process any epochs that have waited too long on more sentences.  Needed when sentences stop coming in.'''
+        current_time = time.time()
+        for nmea_source in self.sources:
+            for epoch in nmea_source.epochs.expire(current_time):
+                self._process_fix(nmea_source.gate, *epoch)
+
+    def flush(self):
+        '''Process any epochs that are still waiting on more sentences.'''
+        for nmea_source in self.sources:
+            for epoch in nmea_source.epochs.flush():
+                self._process_fix(nmea_source.gate, *epoch)
+            
+    def _process_fix(self, gate, utc_time, message_read_time, epoch_data):
+        '''Publish fix from one epoch of GGA/GST/RMC data if it passes gate.'''
+        if 'GGA' not in epoch_data:
+            return # need GGA for position
+        
+        data = epoch_data['GGA']
+        
+        latitude = data['latitude']
+        if data['latitude_direction'] == 'S':
+            latitude = -latitude
+        
+        longitude = data['longitude']
+        if data['longitude_direction'] == 'W':
+            longitude = -longitude
+            
+        # Altitude is above ellipsoid, so adjust for mean-sea-level
+        altitude = data['altitude'] + data['mean_sea_level']
+        
+        # Standard deviation of latitude/longitude error in meters.
+        latitude_error = float('NaN')
+        longitude_error = float('NaN')
+        if 'GST' in epoch_data:
+            latitude_error = epoch_data['GST']['latitude_error']
+            longitude_error = epoch_data['GST']['longitude_error']
+        latitude_error, longitude_error = gate.gst_error(utc_time, latitude_error, longitude_error)
+            
+        # Speed over ground (m/s) and true course (radians).
+        speed = float('NaN')
+        course = float('NaN')
+        if 'RMC' in epoch_data:
+            speed = epoch_data['RMC']['speed']
+            course = epoch_data['RMC']['true_course']
+        
+        if not gate.precision_allowed(latitude_error, longitude_error):
+            return
+        
+        if not gate.position_allowed(str(data['fix_type'])):
+            return
+        
+        self.publisher.new_fix(utc_time, message_read_time, latitude, longitude, altitude, None, data['fix_type'],
+                               data['hdop'], data['num_satellites'], latitude_error, longitude_error, speed, course)
+        
+        # Print out new period once for every 'display_count' messages for constant feedback that messages are being sent.
+        self.send_counter += 1
+        if (self.send_counter % self.display_count) == 0:
+            self.feedback.progress('.')
+            
+    def _process_orientation(self, gate, data, message_read_time):
+        '''Publish orientation from AVR data if it passes gate.'''
+        utc_time = data['utc_time']
+        if math.isnan(utc_time):
+            self.feedback.message('Invalid UTC time: {}'.format(utc_time), 'time')
+            return
+        
+        if not gate.orientation_allowed(str(data['gps_quality'])):
+            return
+        
+        # Dual antenna heading only measures yaw and tilt of the baseline, so roll isn't known.
+        roll = float('NaN')
+        pitch = math.radians(data['tilt_deg'])
+        yaw = math.radians(data['yaw_deg'])
+        
+        self.publisher.new_orientation(utc_time, message_read_time, roll, pitch, yaw)
+
+class Publisher(threading.Thread):
+    '''
+    Last stage of GPS ingest. Passes data on to the GPS server on its own thread. Has the same methods as GPSServer.
+    '''
+    def __init__(self, server):
+        '''Constructor.'''
+        super(Publisher, self).__init__()
+        self.server = server
+        self.queue = Queue()
+        
+    def new_position(self, utc_time, sys_time, x, y, z, zone=None):
+        '''Queue up new position to be posted to server.'''
+        self.queue.put((self.server.new_position, (utc_time, sys_time, x, y, z, zone)))
+        
+    def new_fix(self, utc_time, sys_time, x, y, z, zone, fix_type, hdop, num_satellites, x_error, y_error, speed, course):
+        '''Queue up new fix to be posted to server.'''
+        self.queue.put((self.server.new_fix, (utc_time, sys_time, x, y, z, zone, fix_type, hdop, num_satellites,
+                                              x_error, y_error, speed, course)))
+        
+    def new_orientation(self, utc_time, sys_time, roll, pitch, yaw):
+        '''Queue up new orientation to be posted to server.'''
+        self.queue.put((self.server.new_orientation, (utc_time, sys_time, roll, pitch, yaw)))
+        
+    def run(self):
+        '''Thread start method. Post queued up data to server.'''
+        while True:
+            post, data = self.queue.get(block=True, timeout=None)
+            post(*data)
@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+
+import struct
+
+# Packet formats used between GPSServer and GPSClient.  The client asks for a protocol when it connects
+# (e.g. 'sync,bin1') and the server acknowledges with the one it picked (e.g. 'ack,bin1').  A plain 'sync'/'add'
+# or 'ack' means CSV, which is what older clients and servers use.  Replies from the client during a time sync
+# are always plain text.  A client can also add 'multicast' to its request to get timed messages from the server's
+# multicast group instead of its own copy, in which case the ack ends with the group address (e.g. 'ack,bin1,239.255.50.5:50006').
+# Clients that add 'heartbeat' to their request promise to send 'alive' every so often, so the server can drop them
+# if it stops hearing from them.  Any client can send 'remove' when it shuts down so the server stops sending to it.
+# Clients that add 'ntp' sync their own time by sending 'ts1,<id>' whenever they want, which the server answers right
+# away with a 'ts2' packet holding the UTC times it received the request and sent the reply (see time_sync).  Servers
+# that support this add 'ntp' to the ack and then don't hold back data or run the older sync1/sync2 sync for the client.
+# Commands (ct/cn/ci) can end with the UTC time to run them at, so every client runs them at the same moment.
+# Clients that add 'seq' get a sequence number on the end of every time/position/orientation/command packet (see
+# append_sequence) so they can tell when packets are lost or out of order.  Multicast packets always have one.
+# Clients on the same computer as the server can add 'shm' to read timed messages straight out of shared memory (see
+# shared_memory) instead.  Servers that are sharing memory add 'shm' to the ack and then only send them everything else.
+
+# Comma separated text. Fields are formatted with str() so floats are rounded to 12 significant digits.
+csv_protocol = 'csv'
+
+# Fixed struct layouts (little endian) with full double precision.
+binary_protocol = 'bin1'
+
+# Protocols this version knows, in order of preference.
+supported_protocols = [binary_protocol, csv_protocol]
+
+# Added to connect request by clients that want timed messages over multicast.
+multicast_option = 'multicast'
+
+# Added to connect request by clients that will send heartbeat messages.
+heartbeat_option = 'heartbeat'
+
+# Added to connect request by clients that sync their own time with ts1/ts2 round trips.
+ntp_option = 'ntp'
+
+# Added to connect request by clients that want sequence numbers.
+sequence_option = 'seq'
+
+# Added to connect request by clients that want timed messages from shared memory.
+shared_memory_option = 'shm'
+
+# Options that server repeats back in its ack if it supports them.
+acknowledged_options = [ntp_option, sequence_option, shared_memory_option]
+
+# Plain text messages client sends to server after connecting.
+heartbeat_message = 'alive'
+remove_message = 'remove'
+
+# Message types that have a UTC time (index 1) and the system time it was read in (index 2).
+# Before a message is sent the system time is replaced by the time delay since it was read in.
+timed_message_types = ['t', 'p', 'o', 'f']
+
+# First byte of every binary packet.  CSV packets always start with a letter so they can't be confused.
+binary_magic = '\xb1'
+
+# Zones are sent as a fixed number of characters in binary packets.  Enough for UTM zones like 14S.
+zone_length = 4
+
+"""{packet type: (type code, struct format codes for each field after the packet type)}
+Commands are variable length so they're sent as the target and the command separated by a null character."""
+binary_formats = {
+    't': (1, 'dd'), # utc time, time delay
+    'p': (2, 'ddddd{}s'.format(zone_length)), # utc time, time delay, x, y, z, zone
+    'o': (3, 'ddddd'), # utc time, time delay, roll, pitch, yaw
+    'f': (4, 'ddddd{}sBdBdddd'.format(zone_length)), # p + fix type, hdop, satellites, x/y error, speed, course
+    'sync1': (5, 'Id'), # sync id, utc time
+    'sync2': (6, 'Id'), # sync id, round trip time
+    'ct': (7, None), # sensor type, command, optional utc time to run command at
+    'cn': (8, None), # sensor name, command, optional utc time
+    'ci': (9, None), # sensor id, command, optional utc time
+    'ts2': (10, 'Idd'), # sync id, utc time request received, utc time reply sent
+    }
+
+binary_header = struct.Struct('<cB') # magic, type code
+binary_time_delay = struct.Struct('<d')
+binary_sequence = struct.Struct('<I')
+
+# {type code: (packet type, Struct of every field or None if variable length)}
+binary_decoders = dict((code, (packet_type, struct.Struct('<' + codes) if codes else None))
+                       for packet_type, (code, codes) in binary_formats.iteritems())
+
+def _zone(zone):
+    '''Return zone the same way CSV sends it, since binary sends None as an empty string.'''
+    return zone.rstrip('\0') or 'None'
+
+"""{packet type: function for each CSV field after the packet type}. Any fields past the end are left as strings."""
+csv_field_types = {
+    't': [float, float],
+    'p': [float, float, float, float, float, str],
+    'o': [float, float, float, float, float],
+    'f': [float, float, float, float, float, str, int, float, int, float, float, float, float],
+    'sync1': [int, float],
+    'sync2': [int, float],
+    'ts1': [int],
+    'ts2': [int, float, float],
+    'ct': [str, str, float],
+    'cn': [str, str, float],
+    'ci': [str, str, float],
+    }
+
+# Message types that target sensors on the client by type, name or ID.
+command_types = ['ct', 'cn', 'ci']
+
+# Message types that get sequence numbers.  Each type is its own stream with its own numbers.
+sequenced_types = timed_message_types + command_types
+
+# Sequence numbers wrap around at this.
+sequence_modulus = 2 ** 32
+
+# CSV packets with times that need to be sent with full precision.  str() would round epoch times to 10 ms.
+full_precision_types = ['ts2'] + command_types
+
+def _precise_str(field):
+    '''Return field as a string without rounding floats like str() does.'''
+    return repr(field) if isinstance(field, float) else str(field)
+
+def choose_protocol(request):
+    '''
+    Return (command, protocol) from connect request such as 'sync,bin1,csv' by picking the first protocol the
+    client listed that's supported.  Defaults to CSV if the client didn't list any.
+    '''
+    request_fields = request.split(',')
+    for protocol in request_fields[1:]:
+        if protocol in supported_protocols:
+            return request_fields[0], protocol
+    return request_fields[0], csv_protocol
+
+def requested_multicast(request):
+    '''Return true if client asked for timed messages over multicast in its connect request.'''
+    return multicast_option in request.split(',')[1:]
+
+def requested_heartbeat(request):
+    '''Return true if client said in its connect request that it will send heartbeats.'''
+    return heartbeat_option in request.split(',')[1:]
+
+def requested_ntp(request):
+    '''Return true if client asked to sync its own time with ts1/ts2 round trips in its connect request.'''
+    return ntp_option in request.split(',')[1:]
+
+def requested_sequence(request):
+    '''Return true if client asked for sequence numbers in its connect request.'''
+    return sequence_option in request.split(',')[1:]
+
+def requested_shared_memory(request):
+    '''Return true if client asked for timed messages from shared memory in its connect request.'''
+    return shared_memory_option in request.split(',')[1:]
+
+def connect_request(command, protocol, options=[]):
+    '''
+    Return request client sends to connect (command is sync or add) asking for protocol.  Options is a list of
+    anything else it wants (e.g. multicast_option) or is going to do (e.g. heartbeat_option).
+    '''
+    request_fields = [command]
+    if protocol != csv_protocol or options:
+        request_fields.append(protocol)
+    request_fields.extend(options)
+    return ','.join(request_fields)
+
+def connect_ack(protocol, multicast_address=None, options=[]):
+    '''
+    Return acknowledgement server sends back once client is connected using protocol.  Multicast address is the
+    (group, port) that the client should get timed messages from, or None if it should keep getting its own copy.
+    Options are the acknowledged_options the client asked for that the server is going to use (e.g. ntp_option
+    if server will answer client's ts1 sync requests instead of syncing it with sync1/sync2).
+    '''
+    ack_fields = ['ack']
+    if protocol != csv_protocol or multicast_address is not None or options:
+        ack_fields.append(protocol)
+    if multicast_address is not None:
+        ack_fields.append('{}:{}'.format(multicast_address[0], multicast_address[1]))
+    ack_fields.extend(options)
+    return ','.join(ack_fields)
+
+def parse_connect_ack(data):
+    '''
+    Return (protocol, multicast address or None, list of acknowledged options) from server's acknowledgement,
+    or None if data isn't an ack.
+    '''
+    ack_fields = data.split(',')
+    if ack_fields[0] != 'ack':
+        return None
+    protocol = ack_fields[1] if len(ack_fields) > 1 else csv_protocol
+    multicast_address = None
+    options = []
+    for ack_field in ack_fields[2:]:
+        if ack_field in acknowledged_options:
+            options.append(ack_field)
+            continue
+        try:
+            group, port = ack_field.split(':')
+            multicast_address = (group, int(port))
+        except ValueError:
+            return None
+    return protocol, multicast_address, options
+
+def command_fields(command_type, target, command, utc_time=None):
+    '''Return fields of command message (type is ct, cn or ci) that runs at UTC time, or right away if it's None.'''
+    if utc_time is None:
+        return [command_type, target, command]
+    return [command_type, target, command, float(utc_time)]
+
+def time_sync_request(sync_id):
+    '''Return request client sends to get a ts2 reply with the server's UTC times.'''
+    return 'ts1,{}'.format(sync_id)
+
+def split_encode(fields, protocol):
+    '''
+    Return message fields (packet type first) encoded as (head, tail) in protocol.  For timed messages the time
+    delay goes in between head and tail (see encode_time_delay) so it can be filled in for each client without
+    encoding the rest of the message again.  Other messages are all in head and tail is empty.
+    '''
+    packet_type = fields[0]
+    timed = len(fields) > 2 and packet_type in timed_message_types
+
+    if protocol != binary_protocol:
+        if timed:
+            return '{},{},'.format(packet_type, fields[1]), ''.join([',' + str(f) for f in fields[3:]])
+        if packet_type in full_precision_types:
+            return ','.join([packet_type] + [_precise_str(f) for f in fields[1:]]), ''
+        return ','.join([str(f) for f in fields]), ''
+
+    code, codes = binary_formats[packet_type]
+    header = binary_header.pack(binary_magic, code)
+
+    if codes is None:
+        return header + '\0'.join([_precise_str(f) for f in fields[1:]]), ''
+
+    field_codes = _split_codes(codes)
+
+    # Strings (i.e. zone) can't be None in a struct.
+    values = [('' if f is None else str(f)) if c.endswith('s') else f for f, c in zip(fields[1:], field_codes)]
+
+    if timed:
+        return header + struct.pack('<' + field_codes[0], values[0]), struct.pack('<' + ''.join(field_codes[2:]), *values[2:])
+
+    return header + struct.pack('<' + codes, *values), ''
+
+def encode_time_delay(time_delay, protocol):
+    '''Return time delay encoded to go between the head and tail from split_encode().'''
+    if protocol != binary_protocol:
+        return str(time_delay)
+    return binary_time_delay.pack(time_delay)
+
+def encode(fields, protocol):
+    '''Return whole message encoded in protocol.  Timed messages should already have the time delay in field 2.'''
+    if len(fields) > 2 and fields[0] in timed_message_types:
+        head, tail = split_encode(fields, protocol)
+        return head + encode_time_delay(fields[2], protocol) + tail
+    return split_encode(fields, protocol)[0]
+
+def append_sequence(packet, sequence, protocol):
+    '''Return packet with sequence number added to the end.'''
+    if protocol != binary_protocol:
+        return '{},{}'.format(packet, sequence)
+    return packet + binary_sequence.pack(sequence % sequence_modulus)
+
+def decode_sequenced(data):
+    '''
+    Return (packet type, list of field values, sequence number) from packet that might have a sequence number on
+    the end (see append_sequence).  Sequence number is None for packet types that don't get one.  Raises ValueError
+    if packet is invalid.
+    '''
+    if data[:1] != binary_magic:
+        fields = _split_csv(data)
+        if fields[0] not in sequenced_types:
+            return fields[0], _convert_fields(fields[0], fields[1:]), None
+        if len(fields) < 2:
+            raise ValueError('Packet missing sequence number {}'.format(repr(data)))
+        return fields[0], _convert_fields(fields[0], fields[1:-1]), int(fields[-1])
+    
+    try:
+        packet_type = binary_decoders[binary_header.unpack_from(data)[1]][0]
+    except (struct.error, KeyError):
+        raise ValueError('Invalid binary packet {}'.format(repr(data)))
+    
+    if packet_type not in sequenced_types:
+        packet_type, values = _decode_binary(data)
+        return packet_type, values, None
+    
+    if len(data) < binary_header.size + binary_sequence.size:
+        raise ValueError('Invalid binary packet {}'.format(repr(data)))
+    sequence = binary_sequence.unpack_from(data, len(data) - binary_sequence.size)[0]
+    packet_type, values = _decode_binary(data[:-binary_sequence.size])
+    return packet_type, values, sequence
+
+def decode(data):
+    '''
+    Return (packet type, list of field values) from a packet in either protocol.  Numeric fields are converted
+    to numbers, but anything unexpected is left as a string.  Raises ValueError if packet is invalid.
+    '''
+    if data[:1] == binary_magic:
+        return _decode_binary(data)
+    return _decode_csv(data)
+
+def _decode_csv(data):
+    '''Return (packet type, field values) from CSV packet.'''
+    fields = _split_csv(data)
+    return fields[0], _convert_fields(fields[0], fields[1:])
+
+def _split_csv(data):
+    '''Return list of non-empty fields in CSV packet with whitespace stripped.  Raises ValueError if there aren't any.'''
+    fields = [f for f in map(str.strip, data.split(',')) if f]
+    if not fields:
+        raise ValueError('Empty packet')
+    return fields
+
+def _convert_fields(packet_type, values):
+    '''Return string values converted to the types in csv_field_types. Any fields past the end are left as strings.'''
+    field_types = csv_field_types.get(packet_type)
+    if field_types is None:
+        return values
+    converted = [field_type(value) for field_type, value in zip(field_types, values)]
+    return converted + values[len(converted):]
+
+def _decode_binary(data):
+    '''Return (packet type, field values) from binary packet.'''
+    try:
+        _, code = binary_header.unpack_from(data)
+        packet_type, decoder = binary_decoders[code]
+        if decoder is None:
+            return packet_type, _convert_fields(packet_type, data[binary_header.size:].split('\0'))
+        values = list(decoder.unpack_from(data, binary_header.size))
+    except (struct.error, KeyError):
+        raise ValueError('Invalid binary packet {}'.format(repr(data)))
+
+    if packet_type in ('p', 'f'):
+        values[5] = _zone(values[5])
+    return packet_type, values
+
+def _split_codes(codes):
+    '''Return list of struct format codes, one per field (e.g. 'dd8s' -> ['d', 'd', '8s']).'''
+    split_codes = []
+    count = ''
+    for c in codes:
+        if c.isdigit():
+            count += c
+        else:
+            split_codes.append(count + c)
+            count = ''
+    return split_codes
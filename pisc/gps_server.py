@@ -1,23 +1,140 @@
 #!/usr/bin/env python
 
 import socket
+import select
 import time
 import threading
-from Queue import Queue
+import itertools
+from collections import deque
+
+from gps_protocol import timed_message_types, csv_protocol, binary_protocol, choose_protocol, requested_multicast, connect_ack
+from gps_protocol import requested_heartbeat, heartbeat_message, remove_message, requested_ntp, ntp_option
+from gps_protocol import requested_sequence, sequence_option, sequenced_types, append_sequence
+from gps_protocol import requested_shared_memory, shared_memory_option
+from gps_protocol import split_encode, encode_time_delay, encode, decode, command_fields
+from shared_memory import SharedMemoryWriter
+
+class EncodedMessage(object):
+    '''
+    Message that's already been formatted into what gets sent to clients, so it only needs to be encoded once (per
+    protocol) no matter how many clients it goes to.  Timed messages are split around the time delay field (index 2)
+    so that each client can fill in its own delay without encoding the rest of the message again.
+    '''
+    def __init__(self, fields):
+        '''Constructor. For timed messages (see timed_message_types) field 1 is UTC time and 2 is the system time it was read in.'''
+        self.fields = fields
+        self.message_type = fields[0]
+        self.timed = len(fields) > 2 and fields[0] in timed_message_types
+        self.utc_time = fields[1] if self.timed else None
+        self.sys_time = fields[2] if self.timed else None
+        
+        # {protocol: (head, tail)} for each protocol the message has been encoded in.  Filled in the first time
+        # it's needed.  Okay if two handler threads do it at once since they'd come up with the same thing.
+        self.parts = {}
+        
+        # Position in its stream (see gps_protocol.sequenced_types).  Set by server when message is published.
+        self.sequence = None
+            
+    def time_delay(self):
+        '''Return time (in seconds) that's elapsed since message was read in, or None if message isn't timed.'''
+        if not self.timed:
+            return None
+        return time.time() - self.sys_time
+    
+    def encode(self, time_delay=None, protocol=csv_protocol, sequenced=False):
+        '''
+        Return message encoded in protocol (see gps_protocol) with time delay filled in.  If sequenced is true
+        then sequence number is added on the end if message has one.
+        '''
+        parts = self.parts.get(protocol)
+        if parts is None:
+            parts = split_encode(self.fields, protocol)
+            self.parts[protocol] = parts
+        if not self.timed:
+            packet = parts[0]
+        else:
+            packet = parts[0] + encode_time_delay(time_delay, protocol) + parts[1]
+        if sequenced and self.sequence is not None:
+            packet = append_sequence(packet, self.sequence, protocol)
+        return packet
 
 class GPSServer(threading.Thread):
     '''
     UDP server that allows clients to connect and, essentially subscribe, to 
-    new data that is posted to the server.
+    new data that is posted to the server.  By default each client gets its own handler thread.  In fan out
+    mode a single thread sends every message to all clients from the server socket instead.  If a multicast
+    group is set then timed messages (time/position/orientation) are also sent to the group once, and clients
+    that ask for it get them from there instead of their own copy.  Time syncs and commands are always unicast.
+    Clients are removed when they send 'remove', or when they promised heartbeats and haven't sent anything in
+    client timeout seconds (e.g. sensor computer rebooted and came back on a new port).  Clients that ask for 'ntp'
+    sync their own time by sending ts1 requests, which are answered right away from the server thread, so they
+    get data as soon as they connect.  If a shared memory path is set then timed messages are also put in shared
+    memory as soon as they're published, and clients on the same computer that ask for it read them from there.
     '''
+    
+    # How often to check for clients that have stopped sending heartbeats.
+    liveness_check_period = 1.0 # seconds
 
-    def __init__(self, host, port):
-        '''Constructor.'''
+    def __init__(self, host, port, fan_out=False, multicast_address=None, multicast_ttl=1, multicast_protocol=binary_protocol,
+                 outbox_size=100, outbox_policy='latest', client_timeout=10.0, shared_memory_path=None):
+        '''
+        Constructor.  If fan out is true then won't create a thread per client.  Multicast address is (group, port)
+        or None to not use multicast.  Multicast TTL is how many routers multicast messages can go through.
+        Outbox size and policy set how many messages can wait to go to each client handler and what happens
+        when there are too many (see ClientOutbox).  Client timeout (in seconds) is how long to wait on a client
+        that sends heartbeats before deciding it's gone.  Shared memory path is the file to share timed messages
+        through (see SharedMemoryWriter) or None to not share memory.  Raises EnvironmentError if it can't be created.
+        '''
         super(GPSServer, self).__init__()
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.address = (host, port)
+        # {client address: ClientHandler}.  Never changed once it's created.  Instead the server thread swaps in a
+        # new copy when a client is added or removed, so publishing can read it from any thread without a lock.
         self.handlers = {}
-        self.handlers_lock = threading.Lock()
+        self.fan_out = fan_out
+        self.outbox_size = outbox_size
+        self.outbox_policy = outbox_policy
+        self.client_timeout = client_timeout
+        
+        # System time to next look for clients that have timed out.
+        self.next_liveness_check = 0
+        
+        # {message type: counter} for numbering each stream of messages.  Numbers are the same for every client
+        # so messages are still only encoded once, and anything a client's outbox drops shows up as lost.
+        self.sequence_counters = dict((message_type, itertools.count()) for message_type in sequenced_types)
+        
+        # (UTC time, system time it was read in) of the latest timed message.  Used to tell what UTC time it is
+        # when answering time sync requests.  Replaced all at once so it can be read without a lock.
+        self.utc_reference = None
+        
+        self.multicast_address = multicast_address
+        self.multicast_protocol = multicast_protocol
+        if multicast_address is not None:
+            self.multicast_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.multicast_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, multicast_ttl)
+            if host not in ('', '0.0.0.0'):
+                # Send out the same interface clients connect on.
+                self.multicast_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(host))
+        
+        self.shared_memory = None
+        if shared_memory_path is not None:
+            self.shared_memory = SharedMemoryWriter(shared_memory_path)
+        
+        if fan_out:
+            # {client address: ClientState}. Only used by server thread so doesn't need a lock.
+            self.clients = {}
+            
+            # Messages posted to server that haven't been sent out yet.
+            self.pending_messages = []
+            self.pending_lock = threading.Lock()
+            
+            # Sending anything to the wake socket wakes up the server thread so it can send out pending messages.
+            # Use a loopback UDP socket instead of a pipe since select() only works on sockets in windows.
+            self.wake_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.wake_sock.bind(('127.0.0.1', 0))
+            self.wake_sock.setblocking(False)
+            self.wake_address = self.wake_sock.getsockname()
+            self.wake_sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
     def run(self):
         '''
@@ -28,33 +145,82 @@ class GPSServer(threading.Thread):
         # Set socket to be re-usable to avoid timeout after closing.
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.bind((self.address))
+        
+        if self.fan_out:
+            self._run_fan_out()
+            return
+        
+        # Wake up every so often even if no client says anything so dead ones are still found.
+        self.sock.settimeout(self.liveness_check_period)
     
         while True:
-            data, addr = self.sock.recvfrom(1024)
+            try:
+                data, addr = self.sock.recvfrom(1024)
+                receive_time = time.time()
+            except socket.timeout:
+                pass
+            except socket.error:
+                pass # windows reports when an earlier send couldn't reach a client
+            else:
+                self._handle_request(data, addr, receive_time)
+                
+            self._evict_dead_clients(self.handlers, self._remove_handler)
+                
+    def _handle_request(self, data, addr, receive_time):
+        '''
+        Register new client or update existing one for sync/add request, and remove it if it asks to be.
+        Answer time sync requests using receive time (system time data was received).
+        '''
+        # Client can ask for a protocol after the command (e.g. sync,bin1).  Otherwise it only knows CSV.
+        command, protocol = choose_protocol(data)
+        # Clients reading shared memory are on the same clock as the server, so they never need to be synced,
+        # and they get timed messages from there just like multicast clients get them from the group.
+        shared_memory = requested_shared_memory(data) and self.shared_memory is not None
+        multicast = requested_multicast(data) and self.multicast_address is not None and not shared_memory
+        heartbeat = requested_heartbeat(data)
+        ntp = requested_ntp(data)
+        sequenced = requested_sequence(data)
 
-            with self.handlers_lock: 
-                already_registered = addr in self.handlers
-                if data == 'sync':
-                    if already_registered:
-                        self.handlers[addr].resync()
-                    else:
-                        self._create_new_handler(addr, sync=True)
-                    # Tell client that its request has been received successfully.
-                    self.sock.sendto('ack', addr)
-                elif data =='add':
-                    if not already_registered:
-                        self._create_new_handler(addr, sync=False)
-                    # Tell client that its request has been received successfully.
-                    self.sock.sendto('ack', addr)
-                    
+        handler = self.handlers.get(addr)
+        if handler is not None:
+            # Anything from client (e.g. heartbeat) shows it's still there.
+            handler.last_heard_time = time.time()
+        if command == 'sync':
+            # Client that syncs its own time doesn't need to wait on a sync here.
+            if handler is not None:
+                handler.protocol = protocol
+                handler.multicast = multicast or shared_memory
+                handler.heartbeat = heartbeat
+                handler.sequenced = sequenced
+                if not (ntp or shared_memory):
+                    handler.resync()
+            else:
+                self._create_new_handler(addr, sync=not (ntp or shared_memory), protocol=protocol,
+                                         multicast=multicast or shared_memory, heartbeat=heartbeat, sequenced=sequenced)
+            # Tell client that its request has been received successfully.
+            self._send_raw(self._connect_ack(protocol, multicast, ntp, sequenced, shared_memory), addr)
+        elif command =='add':
+            if handler is not None:
+                handler.protocol = protocol
+                handler.multicast = multicast or shared_memory
+                handler.heartbeat = heartbeat
+                handler.sequenced = sequenced
+            else:
+                self._create_new_handler(addr, sync=False, protocol=protocol, multicast=multicast or shared_memory,
+                                         heartbeat=heartbeat, sequenced=sequenced)
+            # Tell client that its request has been received successfully.
+            self._send_raw(self._connect_ack(protocol, multicast, ntp, sequenced, shared_memory), addr)
+        elif command == 'ts1':
+            self._answer_time_sync(data, addr, receive_time, handler.protocol if handler is not None else csv_protocol)
+        elif command == remove_message and handler is not None:
+            self._remove_handler(addr, 'client asked to be removed')
+                
     def new_time(self, utc_time, sys_time):
         '''
         Post new time to server.  This will send it out to all clients.
         Sys time is the system time when the UTC time was first read in.
         '''
-        with self.handlers_lock:
-            for handler in self.handlers.itervalues():
-                handler.send_time(utc_time, sys_time)
+        self._publish(EncodedMessage(['t', utc_time, sys_time]))
                 
     def new_position(self, utc_time, sys_time, x, y, z, zone=None):
         '''
@@ -62,9 +228,16 @@ class GPSServer(threading.Thread):
         Sys time is the system time when the UTC time was first read in.
         Zone is for frames that are split into zones.  For example in UTM it could be 14S.
         '''
-        with self.handlers_lock:
-            for handler in self.handlers.itervalues():
-                handler.send_position(utc_time, sys_time, x, y, z, zone)
+        self._publish(EncodedMessage(['p', utc_time, sys_time, x, y, z, zone]))
+                
+    def new_fix(self, utc_time, sys_time, x, y, z, zone, fix_type, hdop, num_satellites, x_error, y_error, speed, course):
+        '''
+        Post everything known about the position at one UTC time (epoch) to server.  This will send it out to all clients.
+        Sys time is the system time when the UTC time was first read in.  Fix type is the GGA fix quality, X/Y error
+        are the standard deviations (in meters) of the position error and speed (m/s) / course (radians) are over ground.
+        Any value that isn't known should be NaN.
+        '''
+        self._publish(EncodedMessage(['f', utc_time, sys_time, x, y, z, zone, fix_type, hdop, num_satellites, x_error, y_error, speed, course]))
                     
     def new_orientation(self, utc_time, sys_time, roll, pitch, yaw):
         '''
@@ -72,18 +245,428 @@ class GPSServer(threading.Thread):
         Sys time is the system time when the UTC time was first read in.
         Roll pitch in yaw are the relative rotations ZYX or static rotations XYZ.
         '''
-        with self.handlers_lock:
-            for handler in self.handlers.itervalues():
-                handler.send_orientation(utc_time, sys_time, roll, pitch, yaw)
+        self._publish(EncodedMessage(['o', utc_time, sys_time, roll, pitch, yaw]))
+        
+    def send_command_by_type(self, sensor_type, command, utc_time=None):
+        '''
+        Send command to every sensor of type (e.g. canon_mcu) on all clients.  If UTC time is set then clients
+        wait until then to run it so sensors on different computers act together.
+        '''
+        self._publish(EncodedMessage(command_fields('ct', sensor_type, command, utc_time)))
+        
+    def send_command_by_name(self, sensor_name, command, utc_time=None):
+        '''Send command to sensor with matching name on all clients.  See send_command_by_type().'''
+        self._publish(EncodedMessage(command_fields('cn', sensor_name, command, utc_time)))
+        
+    def send_command_by_id(self, sensor_id, command, utc_time=None):
+        '''Send command to sensor with matching ID on all clients.  See send_command_by_type().'''
+        self._publish(EncodedMessage(command_fields('ci', sensor_id, command, utc_time)))
+        
+    def utc_time(self):
+        '''Return current UTC time based on latest timed message, or None if nothing has been published yet.'''
+        utc_reference = self.utc_reference
+        if utc_reference is None:
+            return None
+        utc_time, sys_time = utc_reference
+        return utc_time + (time.time() - sys_time)
                     
-    def _create_new_handler(self, addr, sync):
+    def _create_new_handler(self, addr, sync, protocol=csv_protocol, multicast=False, heartbeat=False, sequenced=False):
         '''Create client handler on background thread.'''
-        handler = ClientHandler(addr, sync)
+        handler = ClientHandler(addr, sync, protocol, multicast, ClientOutbox(self.outbox_size, self.outbox_policy), heartbeat, sequenced)
         handler.setDaemon(True)
         handler.start()
-        self.handlers[addr] = handler
+        handlers = dict(self.handlers)
+        handlers[addr] = handler
+        self.handlers = handlers
         return handler
+    
+    def _remove_handler(self, addr, reason):
+        '''Stop sending to client and shut down its handler thread.'''
+        handlers = dict(self.handlers)
+        handler = handlers.pop(addr)
+        self.handlers = handlers
+        # Anything that's still publishing to the old copy of handlers just puts messages in a closed outbox.
+        handler.stop()
+        print 'Removed client {}:{} ({}).'.format(addr[0], addr[1], reason)
+        
+    def _remove_client(self, addr, reason):
+        '''Stop sending to client in fan out mode.'''
+        del self.clients[addr]
+        print 'Removed client {}:{} ({}).'.format(addr[0], addr[1], reason)
+        
+    def _evict_dead_clients(self, clients, remove):
+        '''
+        Remove any clients (dictionary of {address: ClientHandler or ClientState}) that promised heartbeats but
+        haven't sent anything within the client timeout.  Only checks every liveness check period.
+        '''
+        current_time = time.time()
+        if current_time < self.next_liveness_check:
+            return
+        self.next_liveness_check = current_time + self.liveness_check_period
+        
+        dead_addresses = [addr for addr, client in clients.iteritems() 
+                          if client.heartbeat and current_time - client.last_heard_time > self.client_timeout]
+        for addr in dead_addresses:
+            remove(addr, 'no heartbeat for {} seconds'.format(self.client_timeout))
+        
+    def dropped_counts(self):
+        '''Return {client address: number of messages dropped because client's outbox was full}.'''
+        return dict((addr, handler.queue.dropped_count) for addr, handler in self.handlers.iteritems())
+        
+    def _connect_ack(self, protocol, multicast, ntp=False, sequenced=False, shared_memory=False):
+        '''Return acknowledgement to send to client that just connected.'''
+        options = []
+        if ntp:
+            options.append(ntp_option)
+        if sequenced:
+            options.append(sequence_option)
+        if shared_memory:
+            options.append(shared_memory_option)
+        return connect_ack(protocol, self.multicast_address if multicast else None, options)
         
+    def _answer_time_sync(self, data, addr, receive_time, protocol):
+        '''
+        Reply to client's ts1 request with the UTC times (see time_sync) that it was received (at system receive
+        time) and that the reply was sent.  Ignored if no timed message has been published yet.
+        '''
+        utc_reference = self.utc_reference
+        if utc_reference is None:
+            return # don't know UTC time yet.  Client will ask again.
+        try:
+            _, fields = decode(data)
+            sync_id = fields[0]
+        except (ValueError, IndexError):
+            return
+        utc_time, sys_time = utc_reference
+        receive_utc_time = utc_time + (receive_time - sys_time)
+        send_utc_time = utc_time + (time.time() - sys_time)
+        self._send_raw(encode(['ts2', sync_id, receive_utc_time, send_utc_time], protocol), addr)
+        
+    def _publish(self, message):
+        '''Send encoded message out to all clients.'''
+        if message.timed:
+            self.utc_reference = (message.utc_time, message.sys_time)
+            if self.shared_memory is not None:
+                # Right away instead of from fan out thread so local clients get it as soon as possible.
+                self.shared_memory.write(message.fields)
+        counter = self.sequence_counters.get(message.message_type)
+        if counter is not None:
+            message.sequence = next(counter)
+        if self.fan_out:
+            self._post(message)
+            return
+        if message.timed:
+            self._send_multicast(message, message.time_delay())
+        # Registration never blocks publishing since handlers is swapped out instead of changed.
+        for handler in self.handlers.itervalues():
+            handler.send_message(message)
+        
+    def _send_multicast(self, message, time_delay):
+        '''Send timed message to multicast group if there is one.'''
+        if self.multicast_address is None:
+            return
+        try:
+            # Always add sequence numbers since there's no way to ask each client if it wants them.
+            self.multicast_sock.sendto(message.encode(time_delay, self.multicast_protocol, True), self.multicast_address)
+        except socket.error:
+            print 'Socket error: could not send to multicast group.'
+        
+    def _post(self, message):
+        '''Queue up message for fan out thread to send, and wake it up if it's not already going to.'''
+        with self.pending_lock:
+            wake_needed = len(self.pending_messages) == 0
+            self.pending_messages.append(message)
+        if wake_needed:
+            self.wake_sender.sendto('w', self.wake_address)
+        
+    def _run_fan_out(self):
+        '''Handle client requests and send out posted messages on this thread until program exits.'''
+        while True:
+            # Only need to wake up on a timeout if waiting for a client to reply to a sync or checking heartbeats.
+            timeout = None
+            deadlines = [client.sync_deadline for client in self.clients.itervalues() if client.sync_step is not None]
+            if any(client.heartbeat for client in self.clients.itervalues()):
+                deadlines.append(self.next_liveness_check)
+            if deadlines:
+                timeout = max(min(deadlines) - time.time(), 0)
+                
+            readable, _, _ = select.select([self.sock, self.wake_sock], [], [], timeout)
+            
+            if self.wake_sock in readable:
+                self._drain_wake_socket()
+                with self.pending_lock:
+                    messages = self.pending_messages
+                    self.pending_messages = []
+                for message in messages:
+                    self._fan_out(message)
+                    
+            if self.sock in readable:
+                try:
+                    data, addr = self.sock.recvfrom(1024)
+                    receive_time = time.time()
+                except socket.error:
+                    pass # windows reports when an earlier send couldn't reach a client
+                else:
+                    self._handle_client_data(data, addr, receive_time)
+                    
+            self._check_sync_timeouts()
+            self._evict_dead_clients(self.clients, self._remove_client)
+            
+    def _drain_wake_socket(self):
+        '''Read everything out of wake socket so select() doesn't keep returning right away.'''
+        while True:
+            try:
+                self.wake_sock.recv(16)
+            except socket.error:
+                break # nothing left
+                
+    def _handle_client_data(self, data, addr, receive_time):
+        '''
+        Register client for sync/add request or remove it if it asks to be.  Heartbeats only update when client
+        was last heard from, time sync requests are answered using receive time and anything else is treated as
+        a reply to a sync1/sync2 time sync.
+        '''
+        client = self.clients.get(addr)
+        command, protocol = choose_protocol(data)
+        # Clients reading shared memory are on the same clock as the server, so they never need to be synced,
+        # and they get timed messages from there just like multicast clients get them from the group.
+        shared_memory = requested_shared_memory(data) and self.shared_memory is not None
+        multicast = requested_multicast(data) and self.multicast_address is not None and not shared_memory
+        heartbeat = requested_heartbeat(data)
+        ntp = requested_ntp(data)
+        sequenced = requested_sequence(data)
+        if client is not None:
+            client.last_heard_time = time.time()
+        if command == 'sync':
+            # Client that syncs its own time doesn't need to wait on a sync here.
+            if client is None:
+                self.clients[addr] = ClientState(addr, need_to_sync=not (ntp or shared_memory), protocol=protocol,
+                                                 multicast=multicast or shared_memory, heartbeat=heartbeat, sequenced=sequenced)
+            else:
+                client.protocol = protocol
+                client.multicast = multicast or shared_memory
+                client.heartbeat = heartbeat
+                client.sequenced = sequenced
+                if not (ntp or shared_memory):
+                    client.synced = False
+            # Tell client that its request has been received successfully.
+            self._send_raw(self._connect_ack(protocol, multicast, ntp, sequenced, shared_memory), addr)
+        elif command == 'add':
+            if client is None:
+                self.clients[addr] = ClientState(addr, need_to_sync=False, protocol=protocol,
+                                                 multicast=multicast or shared_memory, heartbeat=heartbeat, sequenced=sequenced)
+            else:
+                client.protocol = protocol
+                client.multicast = multicast or shared_memory
+                client.heartbeat = heartbeat
+                client.sequenced = sequenced
+            # Tell client that its request has been received successfully.
+            self._send_raw(self._connect_ack(protocol, multicast, ntp, sequenced, shared_memory), addr)
+        elif command == 'ts1':
+            self._answer_time_sync(data, addr, receive_time, client.protocol if client is not None else csv_protocol)
+        elif command == remove_message:
+            if client is not None:
+                self._remove_client(addr, 'client asked to be removed')
+        elif command == heartbeat_message:
+            pass # already marked as heard from
+        elif client is not None:
+            self._continue_sync(client, data)
+            
+    def _fan_out(self, message):
+        '''Send message to every synced client and use it to sync any clients that aren't.'''
+        # Every client is sent the message at the same time so only need to figure out time delay once.
+        time_delay = message.time_delay()
+        
+        if message.timed:
+            self._send_multicast(message, time_delay)
+        
+        # {(protocol, sequenced): packet} so message is only encoded once for each protocol that clients are using.
+        packets = {}
+        
+        for client in self.clients.itervalues():
+            if client.synced and client.multicast and message.timed:
+                continue # already got it from multicast group or shared memory
+            if client.synced:
+                packet_key = (client.protocol, client.sequenced)
+                packet = packets.get(packet_key)
+                if packet is None:
+                    packet = message.encode(time_delay, client.protocol, client.sequenced)
+                    packets[packet_key] = packet
+                try:
+                    self.sock.sendto(packet, client.address)
+                except socket.error:
+                    print 'Socket error: client could not send data.'
+            elif client.sync_step is None:
+                self._start_sync(client, message, time_delay)
+                
+    def _start_sync(self, client, message, time_delay):
+        '''
+        Start time sync with client using message if it has a time that hasn't been used yet.  Works the same as
+        ClientHandler._send_time_sync(), but each step happens as the client replies instead of waiting on it.
+        '''
+        if not message.timed:
+            return # can't use this message for a sync
+        
+        if message.utc_time == client.last_sync_time:
+            return # already used this same time to sync 
+        
+        client.last_sync_time = message.utc_time
+        
+        # Add on any time delay.
+        sync_time = message.utc_time + time_delay
+            
+        client.sync_id = client.next_sync_id
+        client.next_sync_id += 1
+        client.sync_step = 'ack'
+        client.sync_sent_time = time.time()
+        client.sync_deadline = client.sync_sent_time + ClientState.sync_timeout
+        self._send_raw(encode(['sync1', client.sync_id, sync_time], client.protocol), client.address)
+        
+    def _continue_sync(self, client, data):
+        '''Handle reply from client that's in the middle of syncing.'''
+        if client.sync_step == 'ack':
+            try:
+                returned_sync_id = int(data)
+            except ValueError:
+                return
+            if returned_sync_id != client.sync_id:
+                return # reply to an old sync
+            elapsed_time = time.time() - client.sync_sent_time
+            client.sync_step = 'result'
+            client.sync_deadline = time.time() + ClientState.sync_timeout
+            self._send_raw(encode(['sync2', client.sync_id, elapsed_time], client.protocol), client.address)
+            
+        elif client.sync_step == 'result':
+            client.synced = (data == 'true')
+            client.sync_step = None
+            
+    def _check_sync_timeouts(self):
+        '''Give up on any syncs that the client never replied to. Next message will start a new one.'''
+        current_time = time.time()
+        for client in self.clients.itervalues():
+            if client.sync_step is not None and current_time > client.sync_deadline:
+                client.sync_step = None
+                
+    def _send_raw(self, packet, addr):
+        '''Send already encoded packet to client.'''
+        try:
+            self.sock.sendto(packet, addr)
+        except socket.error:
+            print 'Socket error: client could not send data.'
+
+class ClientState(object):
+    '''
+    Everything the fan out server needs to remember about one client.  Takes the place of a ClientHandler thread.
+    '''
+    # How long to wait for a client to reply during a time sync.
+    sync_timeout = 1.0 # seconds
+    
+    def __init__(self, client_address, need_to_sync, protocol=csv_protocol, multicast=False, heartbeat=False, sequenced=False):
+        '''
+        Constructor. Protocol is how messages are encoded for the client (see gps_protocol).  Multicast is true
+        if client gets timed messages from the multicast group (or shared memory) once it's synced.  Heartbeat is
+        true if client sends heartbeats, so it can be removed when they stop.  Sequenced is true if client wants
+        sequence numbers.
+        '''
+        self.address = client_address
+        self.protocol = protocol
+        self.multicast = multicast
+        self.heartbeat = heartbeat
+        self.sequenced = sequenced
+        
+        # System time anything was last received from client.
+        self.last_heard_time = time.time()
+        
+        # Set to True once host time is synced.
+        self.synced = not need_to_sync
+        
+        # Last utc time used in sync command. Used to avoid syncing using duplicate timestamps.
+        self.last_sync_time = 0 
+        
+        # Next id to use for sync command. Used to uniquely specify each sync message.
+        self.next_sync_id = 0
+        
+        # Step of time sync that's waiting on a reply from client ('ack' or 'result'), or None if not syncing.
+        self.sync_step = None
+        
+        # ID of sync in progress, system time its sync1 was sent and the time to give up waiting on the client.
+        self.sync_id = None
+        self.sync_sent_time = None
+        self.sync_deadline = None
+
+class ClientOutbox(object):
+    '''
+    Thread-safe queue of messages waiting to be sent to one client that never holds more than max size messages.
+    Policy decides what to do with a new message:
+      'latest' - replace the waiting message of the same type (e.g. the last position) so client gets the freshest
+                 one as soon as possible.  Commands are never replaced.  Oldest message is dropped if still full.
+      'drop_oldest' - drop the oldest waiting message if full.
+      'block' - wait until there's room.  This holds up everything that posts to the server.
+    '''
+    policies = ['latest', 'drop_oldest', 'block']
+    
+    def __init__(self, max_size=100, policy='latest'):
+        '''Constructor.'''
+        if policy not in self.policies:
+            raise ValueError('Invalid outbox policy {}. Options {}'.format(policy, self.policies))
+        self.max_size = max(max_size, 1)
+        self.policy = policy
+        self.messages = deque()
+        self.condition = threading.Condition(threading.Lock())
+        
+        # Number of messages that were thrown out or replaced before being sent.
+        self.dropped_count = 0
+        
+        # Set once client is removed so nothing else gets queued up.
+        self.closed = False
+        
+    def put(self, message):
+        '''Add EncodedMessage to outbox.  Ignored if outbox is closed.'''
+        with self.condition:
+            if self.closed:
+                return
+            if self.policy == 'latest' and message.timed:
+                for i, waiting_message in enumerate(self.messages):
+                    if waiting_message.message_type == message.message_type:
+                        # Keep its place in line since it's been waiting longer than anything after it.
+                        self.messages[i] = message
+                        self.dropped_count += 1
+                        return
+            
+            while len(self.messages) >= self.max_size:
+                if self.policy == 'block':
+                    self.condition.wait()
+                    if self.closed:
+                        return
+                else:
+                    self.messages.popleft()
+                    self.dropped_count += 1
+                    
+            self.messages.append(message)
+            self.condition.notify_all()
+            
+    def get(self):
+        '''Remove and return oldest message.  Blocks until there is one.  Returns None once outbox is closed.'''
+        with self.condition:
+            while not self.messages and not self.closed:
+                self.condition.wait()
+            if self.closed:
+                return None
+            message = self.messages.popleft()
+            # Let anything waiting for room know there is some.
+            self.condition.notify_all()
+            return message
+            
+    def close(self):
+        '''Throw out any waiting messages and wake up anything waiting on the outbox.'''
+        with self.condition:
+            self.closed = True
+            self.messages.clear()
+            self.condition.notify_all()
+            
+    def __len__(self):
+        '''Return number of messages waiting to be sent.'''
+        return len(self.messages)
 
 class ClientHandler(threading.Thread):
     '''
@@ -92,11 +675,25 @@ class ClientHandler(threading.Thread):
     but as far as the client is concerned it can just recvfrom the server socket.
     '''
     
-    def __init__(self, client_address, need_to_sync):
+    def __init__(self, client_address, need_to_sync, protocol=csv_protocol, multicast=False, outbox=None, heartbeat=False,
+                 sequenced=False):
+        '''
+        Constructor. Protocol is how messages are encoded for the client (see gps_protocol).  Multicast is true
+        if client gets timed messages from the multicast group (or shared memory) once it's synced.  Outbox is the
+        ClientOutbox that messages wait in, or None to use the default one.  Heartbeat is true if client sends
+        heartbeats.  Sequenced is true if client wants sequence numbers.
+        '''
         super(ClientHandler, self).__init__()
         # SOCK_DGRAM is the socket type to use for UDP sockets
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.address = client_address
+        self.protocol = protocol
+        self.multicast = multicast
+        self.heartbeat = heartbeat
+        self.sequenced = sequenced
+        
+        # System time anything was last received from client.  Updated by server.
+        self.last_heard_time = time.time()
         
         # Set to True once host time is synced.
         self.synced = not need_to_sync
@@ -110,60 +707,76 @@ class ClientHandler(threading.Thread):
         # Dict of {id, system_time} used for calculating elapsed time during sync process.
         self.sync_id_times = {}
         
-        # Threadsafe queue for getting new data from server.
-        self.queue = Queue()
+        # Threadsafe bounded queue for getting new data from server.
+        self.queue = outbox if outbox is not None else ClientOutbox()
         
     def run(self):
-        '''Thread start method.  Send queued up data to client'''
+        '''Thread start method.  Send queued up data to client until handler is stopped.'''
         while True:
             # Block here until we have new data to handle.
-            data = self.queue.get(block=True, timeout=None)
+            message = self.queue.get()
+            if message is None:
+                break # stopped
             try:
-                # Update data for the elapsed time since it was read in.
-                self._account_for_time_delay(data)
+                # Elapsed time since the message was read in.
+                time_delay = message.time_delay()
                 
                 if not self.synced:
-                    self.synced = self._try_sync(data)
+                    self.synced = self._try_sync(message, time_delay)
                 
-                if self.synced: 
-                    data = ','.join([str(f) for f in data])
-                    self.sock.sendto(data, self.address)
+                if self.synced and not (self.multicast and message.timed): 
+                    self.sock.sendto(message.encode(time_delay, self.protocol, self.sequenced), self.address)
             except socket.error:
                 print 'Socket error: client could not send data.'
+                
+        self.sock.close()
+                
+    def stop(self):
+        '''Make thread exit once it's done with the current message.  Nothing more will be sent to client.'''
+        self.queue.close()
     
+    def send_message(self, message):
+        '''Queue up message that's already been encoded (see EncodedMessage) to be sent to client.'''
+        self.queue.put(message)
+        
     def send_time(self, utc_time, time_delay):
         '''Queue up time to be sent to client.'''
-        self.queue.put(['t', utc_time, time_delay])
+        self.queue.put(EncodedMessage(['t', utc_time, time_delay]))
         
     def send_position(self, utc_time, time_delay, x, y, z, zone=None):
         '''Queue up time/position to be sent to client.'''
-        self.queue.put(['p', utc_time, time_delay, x, y, z, zone])
+        self.queue.put(EncodedMessage(['p', utc_time, time_delay, x, y, z, zone]))
+        
+    def send_fix(self, utc_time, time_delay, x, y, z, zone, fix_type, hdop, num_satellites, x_error, y_error, speed, course):
+        '''Queue up time/position along with its fix quality/precision and velocity to be sent to client.'''
+        self.queue.put(EncodedMessage(['f', utc_time, time_delay, x, y, z, zone, fix_type, hdop, num_satellites, x_error, y_error, speed, course]))
         
     def send_orientation(self, utc_time, time_delay, roll, pitch, yaw):
         '''Queue up time/orientation to be sent to client.'''
-        self.queue.put(['o', utc_time, time_delay, roll, pitch, yaw])
+        self.queue.put(EncodedMessage(['o', utc_time, time_delay, roll, pitch, yaw]))
         
-    def send_command_by_type(self, sensor_type, command):
+    def send_command_by_type(self, sensor_type, command, utc_time=None):
         '''
         Queue up command to be sent to client.
         'sensor_type' is the type of sensors to send command to.  For example canon_mcu.
         'command' could be anything depending on sensor type.
+        'utc_time' is when client should run command, or None to run it right away.
         '''
-        self.queue.put(['ct', sensor_type, command])
+        self.queue.put(EncodedMessage(command_fields('ct', sensor_type, command, utc_time)))
         
-    def send_command_by_name(self, sensor_name, command):
+    def send_command_by_name(self, sensor_name, command, utc_time=None):
         '''
         Queue up command to be sent to client.
         Will send to sensor with matching name.
         '''
-        self.queue.put(['cn', sensor_name, command])
+        self.queue.put(EncodedMessage(command_fields('cn', sensor_name, command, utc_time)))
         
-    def send_command_by_id(self, sensor_id, command):
+    def send_command_by_id(self, sensor_id, command, utc_time=None):
         '''
         Queue up command to be sent to client.
         Will send to sensor with matching ID.
         '''
-        self.queue.put(['ci', sensor_id, command])
+        self.queue.put(EncodedMessage(command_fields('ci', sensor_id, command, utc_time)))
                     
     def resync(self):
         '''
@@ -173,44 +786,21 @@ class ClientHandler(threading.Thread):
         '''
         self.synced = False
                
-    def _account_for_time_delay(self, data):
-        '''
-        If data contains a time reference (should be at index 1), then switch out the 'sys_time' reference
-        (should be at index 2) for the elapsed time (the time delay) since the data was originally read in.
-        '''
-        
-        # Make sure message has a sys time reference to use
-        if (len(data) <= 2) or (data[0] not in ['t', 'p', 'o']):
-            return False 
-                   
-        # Calculate time that's elapsed since UTC time was read in.
-        sys_time_ref = data[2]
-        elapsed_time = time.time() - sys_time_ref
-                    
-        # Replace sys time ref with elapsed times.
-        data[2] = elapsed_time
-                    
-    def _try_sync(self, data):
+    def _try_sync(self, message, time_delay):
         '''
-        If 'data' is a message that can be used for time syncing to client then updates
-        sync process.  If the time is already been used then it will be ignored.  Must
-        call account_for_time_delay() before this.
+        If message can be used for time syncing to client then updates sync process.
+        If the time is already been used then it will be ignored.
         '''
-        if (len(data) <= 1) or (data[0] not in ['t', 'p', 'o']):
+        if not message.timed:
             return False # can't use this message for a sync
         
-        sync_time = data[1]
-         
-        if sync_time == self.last_sync_time:
+        if message.utc_time == self.last_sync_time:
             return False # already used this same time to sync 
         
-        self.last_sync_time = sync_time
+        self.last_sync_time = message.utc_time
         
         # Add on any time delay.
-        if len(data) >= 3:
-            sync_time += data[2]
-        
-        return self._send_time_sync(sync_time)
+        return self._send_time_sync(message.utc_time + time_delay)
         
                     
     def _send_time_sync(self, utc_time):
@@ -233,7 +823,7 @@ class ClientHandler(threading.Thread):
         '''
         sync_id = self.next_sync_id
         self.sock.settimeout(1.0)
-        self.sock.sendto("sync1,{},{}".format(sync_id, utc_time), self.address)
+        self.sock.sendto(encode(['sync1', sync_id, utc_time], self.protocol), self.address)
         self.sync_id_times[sync_id] = time.time()
 
         data, _ = self.sock.recvfrom(1024)
@@ -243,7 +833,7 @@ class ClientHandler(threading.Thread):
         sent_sync_time = self.sync_id_times[returned_sync_id]
         elapsed_time = returned_sync_time - sent_sync_time
         
-        self.sock.sendto("sync2,{},{}".format(sync_id, elapsed_time), self.address)
+        self.sock.sendto(encode(['sync2', sync_id, elapsed_time], self.protocol), self.address)
         
         data, _ = self.sock.recvfrom(1024)
         if data == 'true':
@@ -7,221 +7,251 @@ import socket
 import serial
 import math
 import time
+import threading
+from Queue import Queue
 
-if os.name == 'nt':
-    import winsound
-
-from gps_server import GPSServer
-from nmea_parser import parse_nmea_sentence
-from checksum_utils import check_nmea_checksum
+from gps_server import GPSServer, ClientOutbox
+from nmea_parser import convert_time_of_day
+from nmea_framer import NMEAFramer
+from nmea_replay import NMEAReplay
+from gps_ingest import NMEASource, NMEAMultiplexer, ReceiverGate, gga_fix_types, avr_fix_types
+from gps_ingest import Feedback, NMEAReader, SentenceProcessor, Publisher
+from shared_memory import default_shared_memory_path
 
 # Default command line argument values.  Global so sensor controller can use as default host.
 default_server_port = 50005
 
+def read_commands(server, lead_time):
+    '''
+    Send sensor commands typed in by user to every client until input is closed.  Each line should be
+      <type|name|id> <target> <command> [seconds from now]
+    for example 'type canon_mcu retime:2'.  Commands run on every client at the same UTC time, which defaults to
+    lead time seconds after the command is sent so that every client has time to get it.
+    '''
+    senders = {'type': server.send_command_by_type, 'name': server.send_command_by_name, 'id': server.send_command_by_id}
+    while True:
+        try:
+            line = raw_input()
+        except EOFError:
+            return
+        fields = line.split()
+        if len(fields) == 0:
+            continue
+        try:
+            if len(fields) not in (3, 4) or fields[0] not in senders:
+                raise ValueError()
+            delay = float(fields[3]) if len(fields) > 3 else lead_time
+        except ValueError:
+            print 'Invalid command {}. Should be <type|name|id> <target> <command> [seconds from now].'.format(line)
+            continue
+        utc_time = server.utc_time()
+        if utc_time is None:
+            print 'Can\'t send command until a time has been read in.'
+            continue
+        senders[fields[0]](fields[1], fields[2], utc_time + delay)
+        print 'Sent {} to {} {} to run in {} seconds.'.format(fields[2], fields[0], fields[1], delay)
+
 
 if __name__ == "__main__":
     '''
-    Read in NMEA messages from either a GPS or test file and immediately send time/position information
-     to each sensor client.  Runs until keyboard interrupt.
+    Read in NMEA messages from one or more GPS receivers or test files and immediately send time/position/orientation
+     information to each sensor client.  Runs until keyboard interrupt.
     '''
-    default_rate = 10 # Hz.  Rate to read messages out of test file.
+    default_rate = 10 # Hz.  Rate to read messages out of test file if they don't have a UTC time.
+    default_replay_speed = 1.0 # times faster than real time to replay test file.
     default_gps_baud = 9600 
     default_server_host = '0.0.0.0' # all available ip address 
+    default_outbox_size = 100 # messages
+    default_outbox_policy = 'latest'
+    default_client_timeout = 10 # seconds
+    default_command_lead_time = 1.0 # seconds
     
-    fix_types = { '0': 'None',
-                  '1': 'GPS',
-                  '2': 'DGPS',
-                  '3': 'PPS',
-                  '4': 'Fixed RTK',
-                  '5': 'Float/Location RTK or OmniStar',
-                  '6': 'Dead Reckoning',
-                  '7': 'Manual',
-                  '8': 'Simulation' }
-
     # Define command line arguments.
     argparser = argparse.ArgumentParser(description='Pass position/time from GPS to sensor controller.')
     argparser.add_argument('-n', '--host', default=default_server_host, help='Server host name. Default {}.'.format(default_server_host))
     argparser.add_argument('-x', '--server_port', default=default_server_port, help='Server port number. Default {}.'.format(default_server_port))
-    argparser.add_argument('-f', '--test_file', default='', help='Path to NMEA test log file.')
-    argparser.add_argument('-r', '--test_rate', default=default_rate, help='Rate to parse messages from test file. Default {} Hz'.format(default_rate))
-    argparser.add_argument('-p', '--serial_port', default='None', help='Serial port name ie COM4 or /dev/ttyS1.')
-    argparser.add_argument('-b', '--baud', default=default_gps_baud, help='Baud rate of serial port. Default {}.'.format(default_gps_baud))
-    argparser.add_argument('-s', '--required_fix', default= 'None', help='Required fix quality indicator in GGA message. Options {}'.format(fix_types))
+    argparser.add_argument('-f', '--test_file', action='append', default=[], help='Path to NMEA test log file. Can be repeated to play several files at once.')
+    argparser.add_argument('-r', '--test_rate', default=default_rate, help='Rate to parse messages from test file that don\'t have a UTC time. Default {} Hz'.format(default_rate))
+    argparser.add_argument('-m', '--replay_speed', default=default_replay_speed, help='How many times faster than real time to replay test file ({} to {}). Default {}.'.format(NMEAReplay.min_speed, NMEAReplay.max_speed, default_replay_speed))
+    argparser.add_argument('-l', '--loop', action='store_true', help='Start test file back over once the end is reached.')
+    argparser.add_argument('-k', '--seek', default='', help='UTC time (hhmmss) in test file to start replaying at. If the file passes midnight then times before it starts are on the next day.')
+    argparser.add_argument('-p', '--serial_port', action='append', default=[], help='Serial port name ie COM4 or /dev/ttyS1. Can be repeated to read from several receivers, for example one for position and one for heading.')
+    argparser.add_argument('-b', '--baud', action='append', default=[], help='Baud rate of serial port. Repeat in the same order as serial ports if they\'re different. Default {}.'.format(default_gps_baud))
+    argparser.add_argument('-s', '--required_fix', default= 'None', help='Required fix quality indicator in GGA message. Options {}'.format(gga_fix_types))
     argparser.add_argument('-z', '--required_precision', default= -1, help='Set the max standard deviation of latitude/longitude error for usable data.')
+    argparser.add_argument('-g', '--multicast_group', default='', help='Multicast group (e.g. 239.255.50.5) to also send time/position/orientation to. Clients can ask to get data from it instead of their own copy. Default is no multicast.')
+    argparser.add_argument('-q', '--multicast_port', default=0, help='Port number of multicast group. Default is one more than the server port.')
+    argparser.add_argument('-w', '--shared_memory', nargs='?', const=default_shared_memory_path, default=None, help='Also put time/position/orientation in shared memory (default file {}) for clients on this computer that ask for it. Default is no shared memory.'.format(default_shared_memory_path))
+    argparser.add_argument('-e', '--outbox_size', default=default_outbox_size, help='Max number of messages that can wait to be sent to each client. Default {}.'.format(default_outbox_size))
+    argparser.add_argument('-o', '--outbox_policy', default=default_outbox_policy, choices=ClientOutbox.policies, help='What to do when a client has too many messages waiting. Default {}.'.format(default_outbox_policy))
+    argparser.add_argument('-t', '--client_timeout', default=default_client_timeout, help='Remove clients that send heartbeats if nothing is heard from them for this many seconds. Default {}.'.format(default_client_timeout))
+    argparser.add_argument('-c', '--commands', action='store_true', help='Read sensor commands from standard input (e.g. type canon_mcu stop) and send them to all clients to run {} seconds later.'.format(default_command_lead_time))
+    argparser.add_argument('-u', '--fan_out', action='store_true', help='Send to every client from one server thread instead of a thread per client.')
+    argparser.add_argument('-a', '--required_heading_fix', default= 'None', help='Required GPS quality indicator in PTNL AVR message. Options {}'.format(avr_fix_types))
     args = argparser.parse_args()
 
     # Validate command line arguments.
     host = args.host
-    server_port = args.server_port
-    serial_port_name = args.serial_port
-    baud_rate = int(args.baud)
-    test_file_name = args.test_file
+    server_port = int(args.server_port)
+    multicast_port = int(args.multicast_port) if int(args.multicast_port) > 0 else server_port + 1
+    serial_port_names = args.serial_port
+    baud_rates = [int(baud) for baud in args.baud]
+    test_file_names = args.test_file
     required_fix = args.required_fix.lower()
     required_precision = float(args.required_precision)
+    required_heading_fix = args.required_heading_fix.lower()
     test_rate = float(args.test_rate)
+    replay_speed = float(args.replay_speed)
+    client_timeout = float(args.client_timeout)
     
     if test_rate <= 0.0:
         print 'Invalid test rate {}. Changing to {}.'.format(test_rate, default_rate)
         test_rate = default_rate
         
-    if required_fix != 'none' and required_fix not in fix_types:
+    if not (NMEAReplay.min_speed <= replay_speed <= NMEAReplay.max_speed):
+        print 'Invalid replay speed {}. Changing to {}.'.format(replay_speed, default_replay_speed)
+        replay_speed = default_replay_speed
+        
+    if client_timeout <= 0.0:
+        print 'Invalid client timeout {}. Changing to {}.'.format(client_timeout, default_client_timeout)
+        client_timeout = default_client_timeout
+        
+    seek_time = None
+    if args.seek != '':
+        try:
+            seek_time = convert_time_of_day(args.seek)
+        except ValueError:
+            seek_time = float('NaN')
+        if math.isnan(seek_time):
+            print 'Invalid seek time {}. Should be hhmmss.'.format(args.seek)
+            sys.exit(1)
+        
+    if required_fix != 'none' and required_fix not in gga_fix_types:
         print 'Invalid required fix {}. See options in --help.'.format(required_fix)
         sys.exit(1)
         
-    # Initialize last_fix and last_error as values that will never occur
-    last_fix = '-1'
-    last_error = -1.0
-    data_quality = True
-    gga_count = 0 # how many gga messages have been received since last GST message.
-    beep_freq = 700 # Hz
-    beep_duration = 325 # ms
+    if required_heading_fix != 'none' and required_heading_fix not in avr_fix_types:
+        print 'Invalid required heading fix {}. See options in --help.'.format(required_heading_fix)
+        sys.exit(1)
+        
+    multicast_address = None
+    if args.multicast_group != '':
+        try:
+            if not (224 <= ord(socket.inet_aton(args.multicast_group)[0]) <= 239):
+                raise socket.error()
+        except socket.error:
+            print 'Invalid multicast group {}. Should be between 224.0.0.0 and 239.255.255.255.'.format(args.multicast_group)
+            sys.exit(1)
+        multicast_address = (args.multicast_group, multicast_port)
+        
+    if len(test_file_names) == 0 and len(serial_port_names) == 0:
+        print 'Need to specify at least one serial port or test file. See --help.'
+        sys.exit(1)
+    
+    # Show console output and alerts on their own thread so they never hold up data.
+    feedback = Feedback()
+    feedback.setDaemon(True)
+    feedback.start()
+    
+    # Each source gets its own gate so one receiver's fix and precision doesn't affect another's.
+    nmea_sources = []
     
-    # First try to open a test file that contains NMEA messages.
-    nmea_source = None
-    using_test_file = False
-    if test_file_name != '':
+    # First try to open test files that contain NMEA messages.
+    for test_file_name in test_file_names:
         if not os.path.isfile(test_file_name):
             print '\nThe test file could not be found:\n\'{}\'\n'.format(test_file_name)
             sys.exit(1)
         else:
-            print 'Using provided test file.'
-            nmea_source = open(test_file_name, 'r')
-            using_test_file = True
+            print 'Using provided test file {}.'.format(test_file_name)
+            source_name = os.path.basename(test_file_name)
+            gate = ReceiverGate(source_name, feedback, required_fix, required_precision, required_heading_fix)
+            replay = NMEAReplay(test_file_name, replay_speed, args.loop, seek_time, test_rate)
+            nmea_sources.append(NMEASource(source_name, gate, replay=replay))
     
-    # If user didn't specify a test file then open the actual serial port.
-    if nmea_source is None:
-        try:
-            print "\nOpening serial port {} with baud {}".format(serial_port_name, baud_rate)
-            nmea_source = serial.Serial(port=serial_port_name, baudrate=baud_rate, timeout=2)
-        except serial.serialutil.SerialException, e:
-            print 'Failed to open GPS\n{}'.format(e)
-            sys.exit(1)
+    # If user didn't specify a test file then open the actual serial ports.
+    if len(nmea_sources) == 0:
+        for port_number, serial_port_name in enumerate(serial_port_names):
+            if port_number < len(baud_rates):
+                baud_rate = baud_rates[port_number]
+            elif len(baud_rates) > 0:
+                baud_rate = baud_rates[-1]
+            else:
+                baud_rate = default_gps_baud
+            try:
+                print "\nOpening serial port {} with baud {}".format(serial_port_name, baud_rate)
+                serial_port = serial.Serial(port=serial_port_name, baudrate=baud_rate, timeout=2)
+            except serial.serialutil.SerialException, e:
+                print 'Failed to open GPS\n{}'.format(e)
+                sys.exit(1)
+            gate = ReceiverGate(serial_port_name, feedback, required_fix, required_precision, required_heading_fix)
+            nmea_sources.append(NMEASource(serial_port_name, gate, framer=NMEAFramer(serial_port, baud_rate)))
     
     print "Starting server at {}:{}".format(host, server_port)
-    server = GPSServer(host, server_port)
+    try:
+        server = GPSServer(host, server_port, args.fan_out, multicast_address,
+                           outbox_size=int(args.outbox_size), outbox_policy=args.outbox_policy, client_timeout=client_timeout,
+                           shared_memory_path=args.shared_memory)
+    except EnvironmentError as e:
+        print 'Failed to create shared memory {}\n{}'.format(args.shared_memory, e)
+        sys.exit(1)
     server.setDaemon(True)
     server.start()
+    
+    if multicast_address is not None:
+        print "Sending to multicast group {}:{}".format(*multicast_address)
+        
+    if args.shared_memory is not None:
+        print "Sharing memory at {}".format(args.shared_memory)
 
-    send_counter = 0 # number of position/time messages sent 
     display_count = 10 # how many messages to send before displaying feedback character
     
     print 'Each period represents {} new position messages.'.format(display_count)
           
     if required_precision > 0:
         print 'Required precision set to {}'.format(required_precision)
-        # Override to false until we know we have good precision.
-        data_quality = False
           
     if required_fix != 'none':
-        print 'Waiting for required fix of {}'.format(fix_types[required_fix])
+        print 'Waiting for required fix of {}'.format(gga_fix_types[required_fix])
+          
+    if required_heading_fix != 'none':
+        print 'Waiting for required heading fix of {}'.format(avr_fix_types[required_heading_fix])
+          
+    # Split ingest into stages so nothing that happens after a sentence is read can delay reading the next one.
+    #  Reader thread -> sentence queue -> processor thread (parse/gate) -> publisher thread -> server
+    sentence_queue = Queue()
+    
+    publisher = Publisher(server)
+    publisher.setDaemon(True)
+    publisher.start()
+    
+    processor = SentenceProcessor(sentence_queue, publisher, feedback, display_count)
+    processor.setDaemon(True)
+    processor.start()
+    
+    reader = NMEAReader(NMEAMultiplexer(nmea_sources), sentence_queue)
+    reader.setDaemon(True)
+    reader.start()
+    
+    if args.commands:
+        print 'Enter commands as <type|name|id> <target> <command> [seconds from now].'
+        command_reader = threading.Thread(target=read_commands, args=(server, default_command_lead_time))
+        command_reader.setDaemon(True)
+        command_reader.start()
           
     try:
-        while True:
-            # Delay when using test file so all messages don't get read out at once.
-            if using_test_file:
-                time.sleep(1.0/test_rate)
-            
-            nmea_string = nmea_source.readline().strip()
-            
-            # time (in seconds) that the most recent nmea message was read in.
-            message_read_time = time.time()
-
-            if not check_nmea_checksum(nmea_string):
-                print "Received a sentence with an invalid checksum. Sentence was: {}".format(repr(nmea_string))
-                continue
-            
-            parsed_sentence = parse_nmea_sentence(nmea_string)
-            if not parsed_sentence:
-                print "Failed to parse NMEA sentence. Sentence was: {}".format(nmea_string)
-                continue
-                               
-            if required_precision > 0:
-                
-                if gga_count > 100:
-                    print 'Received {} GGA messages and 0 GST messages'.format(gga_count)
-                    gga_count = 0
-                                                                
-                if 'GST' in parsed_sentence:
-                    data = parsed_sentence['GST']
-                    
-                    lat_error = data['latitude_error']
-                    long_error = data['longitude_error']
-                    
-                    current_error = max(lat_error,long_error)
-                    
-                    data_quality = True  
-                                  
-                    gga_count = 0
-                    
-                    if current_error <= required_precision:
-                        
-                        if current_error != last_error:
-                            
-                            print 'Required Precision of {0}m achieved. Data being logged.'.format(required_precision)
-                            last_error = current_error 
-                            
-                    if current_error > required_precision:
-                        
-                        if os.name == 'nt':
-                            winsound.Beep(beep_freq,beep_duration)
-                        else:
-                            print '\a' # Cross platform alert noise
-                        
-                        if current_error != last_error:
-
-                            print 'Current error of {}m is too large.'.format(current_error)
-                            last_error = current_error                        
-                                             
-                        data_quality = False
-                        
-            if 'GGA' in parsed_sentence:
-                                                            
-                gga_count += 1
-                                 
-                data = parsed_sentence['GGA']
-                           
-                latitude = data['latitude']
-                if data['latitude_direction'] == 'S':
-                    latitude = -latitude
-         
-                longitude = data['longitude']
-                if data['longitude_direction'] == 'W':
-                    longitude = -longitude
-                     
-                # Altitude is above ellipsoid, so adjust for mean-sea-level
-                altitude = data['altitude'] + data['mean_sea_level']
-                 
-                utc_time = data['utc_time']
-                if math.isnan(utc_time):
-                    print 'Invalid UTC time: {}'.format(utc_time)
-                    continue
-                
-                if data_quality == True: 
-                    
-                    fix = str(data['fix_type'])
-                    
-                    if required_fix != 'none' and fix != required_fix:
-                        
-                        if fix != last_fix:
-                            last_fix = fix
-                            print 'Insufficient fix: {}'.format(fix_types[fix])
-                            
-                        continue # bad fix 
-                        
-                    if fix != last_fix:  
-                        last_fix = fix
-                        print 'Current fix: {}'.format(fix_types[fix])
-                        
-                    server.new_position(utc_time, message_read_time, latitude, longitude, altitude)
-     
-                    # Print out new period once for every 'display_count' messages for constant feedback that messages are being sent.
-                    send_counter += 1
-                    if (send_counter % display_count) == 0:
-                        sys.stdout.write('.')
-                        sys.stdout.flush()
-           
+        # Wait with a timeout so keyboard interrupts are still handled.
+        while processor.isAlive():
+            processor.join(0.5)
+        print "\nFinished reading all test files."
                                             
     except KeyboardInterrupt:
         print "\nKeyboard interrupt detected"
         print "Shutting down..."
+        
+    for client_address, dropped_count in server.dropped_counts().iteritems():
+        if dropped_count > 0:
+            print 'Dropped {} messages for client {}:{} that it couldn\'t keep up with.'.format(dropped_count, *client_address)
+            
+    if server.shared_memory is not None:
+        server.shared_memory.remove()
     
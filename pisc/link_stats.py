@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+import time
+import threading
+from collections import deque
+
+from gps_protocol import sequence_modulus
+
+class LinkStats(object):
+    '''
+    Keeps track of packets received on each stream (message type) from the server so out of order or stale
+    packets can be thrown out and the user can see how well the link is doing.  Counts are kept for each
+    interval and the last few intervals are added up when asked for, so stats only cover the recent past.
+    Thread-safe.
+    '''
+    # Upper edge (in seconds) of each one-way delay histogram bin.  There's one more bin for anything slower.
+    delay_bins = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0]
+
+    def __init__(self, interval=10.0, interval_count=6, max_reorder=100, max_time_jump=5.0, restart_run=3):
+        '''
+        Constructor.  Stats cover the last interval count intervals of interval seconds each.  A sequence number
+        more than max reorder behind the newest one is taken to mean the server restarted and started over.  So is
+        one that's behind but has a UTC time newer than the newest one, or restart run of them in a row for packets
+        without a time.  UTC time going back by more than max time jump (seconds) means the stream started over
+        (e.g. a test file looped), otherwise packets without sequence numbers that go back in time are stale.
+        '''
+        self.interval = interval
+        self.max_reorder = max_reorder
+        self.max_time_jump = max_time_jump
+        self.restart_run = restart_run
+        self.lock = threading.Lock()
+
+        # {stream: newest sequence number} and {stream: newest UTC time} of packets that were used.
+        self.last_sequences = {}
+        self.last_utc_times = {}
+
+        # {stream: (sequence number, count)} of the last packet that was behind the newest one and how many in a
+        # row have been one after another.  Cleared once a packet is used.
+        self.behind_runs = {}
+
+        # {stream: counts} for finished intervals, oldest first, and the current interval.
+        self.intervals = deque(maxlen=max(interval_count - 1, 1))
+        self.current_counts = {}
+        self.interval_end_time = time.time() + interval
+
+    def accept(self, stream, sequence=None, utc_time=None, delay=None):
+        '''
+        Return true if packet from stream should be used, or false if it's a duplicate, out of order or older (by
+        UTC time) than one that's already been used.  Sequence is the packet's sequence number (or None if it
+        doesn't have one) and delay is how long it took to get here in seconds (or None if unknown).  Packets with
+        sequence numbers are only checked by sequence number since UTC time can go backwards when a test file loops.
+        '''
+        with self.lock:
+            self._roll_intervals()
+            counts = self.current_counts.get(stream)
+            if counts is None:
+                counts = self._new_counts()
+                self.current_counts[stream] = counts
+
+            last_utc_time = self.last_utc_times.get(stream)
+
+            if sequence is not None:
+                last_sequence = self.last_sequences.get(stream)
+                if last_sequence is not None:
+                    ahead = (sequence - last_sequence) % sequence_modulus
+                    behind = sequence_modulus - ahead
+                    if ahead == 0:
+                        counts['duplicate'] += 1
+                        return False
+                    if ahead <= sequence_modulus // 2:
+                        # Anything skipped over is lost since it'll be thrown out if it shows up later.
+                        counts['lost'] += ahead - 1
+                    elif behind <= self.max_reorder and not self._restarted(stream, sequence, utc_time, last_utc_time):
+                        counts['reordered'] += 1
+                        return False
+                    # Otherwise server restarted so start over from this one.
+                self.last_sequences[stream] = sequence
+                self.behind_runs.pop(stream, None)
+
+            elif utc_time is not None and last_utc_time is not None and utc_time < last_utc_time:
+                if last_utc_time - utc_time <= self.max_time_jump:
+                    counts['stale'] += 1
+                    return False
+                # Otherwise stream started over so start over from this one.
+
+            if utc_time is not None:
+                self.last_utc_times[stream] = utc_time
+
+            counts['received'] += 1
+            if delay is not None:
+                counts['delay_count'] += 1
+                counts['delay_sum'] += delay
+                counts['delay_max'] = max(counts['delay_max'], delay)
+                counts['delay_histogram'][self._delay_bin(delay)] += 1
+            return True
+
+    def reset_stream_positions(self):
+        '''Forget newest sequence numbers and UTC times, for example after switching servers.  Counts are kept.'''
+        with self.lock:
+            self.last_sequences = {}
+            self.last_utc_times = {}
+            self.behind_runs = {}
+
+    def summary(self):
+        '''
+        Return {stream: stats} for recent intervals where stats is a dictionary of received, lost, reordered,
+        duplicate and stale packet counts, loss_percent, mean/max delay (None if unknown) and delay_histogram
+        which has a count for each bin in delay_bins plus one for anything slower.
+        '''
+        with self.lock:
+            self._roll_intervals()
+            totals = {}
+            for interval_counts in list(self.intervals) + [self.current_counts]:
+                for stream, counts in interval_counts.iteritems():
+                    total = totals.get(stream)
+                    if total is None:
+                        total = self._new_counts()
+                        totals[stream] = total
+                    for key in ['received', 'lost', 'reordered', 'duplicate', 'stale', 'delay_count', 'delay_sum']:
+                        total[key] += counts[key]
+                    total['delay_max'] = max(total['delay_max'], counts['delay_max'])
+                    total['delay_histogram'] = [a + b for a, b in zip(total['delay_histogram'], counts['delay_histogram'])]
+
+        stats = {}
+        for stream, total in totals.iteritems():
+            expected_count = total['received'] + total['lost']
+            has_delay = total['delay_count'] > 0
+            stats[stream] = {'received': total['received'],
+                             'lost': total['lost'],
+                             'reordered': total['reordered'],
+                             'duplicate': total['duplicate'],
+                             'stale': total['stale'],
+                             'loss_percent': 100.0 * total['lost'] / expected_count if expected_count > 0 else 0.0,
+                             'mean_delay': total['delay_sum'] / total['delay_count'] if has_delay else None,
+                             'max_delay': total['delay_max'] if has_delay else None,
+                             'delay_histogram': total['delay_histogram']}
+        return stats
+
+    def report(self):
+        '''Return summary as a few lines of text for logging.'''
+        lines = []
+        for stream, stats in sorted(self.summary().iteritems()):
+            line = '{}: received {} lost {} ({:.1f}%) reordered {} duplicate {} stale {}'.format(stream, stats['received'],
+                            stats['lost'], stats['loss_percent'], stats['reordered'], stats['duplicate'], stats['stale'])
+            if stats['mean_delay'] is not None:
+                line += ' delay mean {:.1f} max {:.1f} ms'.format(stats['mean_delay'] * 1000, stats['max_delay'] * 1000)
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def _new_counts(self):
+        '''Return counts for one stream in one interval.'''
+        return {'received': 0, 'lost': 0, 'reordered': 0, 'duplicate': 0, 'stale': 0,
+                'delay_count': 0, 'delay_sum': 0.0, 'delay_max': 0.0,
+                'delay_histogram': [0] * (len(self.delay_bins) + 1)}
+
+    def _restarted(self, stream, sequence, utc_time, last_utc_time):
+        '''
+        Return true if sequence number that's a little behind the newest one is really from a server that restarted
+        instead of an old packet that got reordered.  Must hold lock.
+        '''
+        if utc_time is not None and last_utc_time is not None:
+            # Reordered packet can't be newer than one that was already used, or much older.
+            return utc_time > last_utc_time or last_utc_time - utc_time > self.max_time_jump
+
+        last_behind = self.behind_runs.get(stream)
+        run = 1
+        if last_behind is not None and (sequence - last_behind[0]) % sequence_modulus == 1:
+            run = last_behind[1] + 1
+        self.behind_runs[stream] = (sequence, run)
+        return run >= self.restart_run
+
+    def _delay_bin(self, delay):
+        '''Return index of histogram bin that delay goes in.'''
+        for i, upper_edge in enumerate(self.delay_bins):
+            if delay <= upper_edge:
+                return i
+        return len(self.delay_bins)
+
+    def _roll_intervals(self):
+        '''Start a new interval if current one is over.  Must hold lock.'''
+        current_time = time.time()
+        if current_time < self.interval_end_time:
+            return
+        self.intervals.append(self.current_counts)
+        self.current_counts = {}
+        # Skip ahead if nothing was received for a while.
+        while self.interval_end_time <= current_time:
+            self.interval_end_time += self.interval
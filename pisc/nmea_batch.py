@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+
+'''
+Batch NMEA parsing for post-processing and replaying large log files.  Rather than parsing
+one sentence at a time like parse_nmea_sentence(), an entire buffer is split into sentences
+at once and every field is converted for all sentences of the same type in a single NumPy
+operation.  Uses the same parse_maps field definitions as the sentence parser.
+
+Requires NumPy, which is not needed for the rest of PISC.
+'''
+
+import time
+import calendar
+import numpy as np
+
+import nmea_parser
+from nmea_parser import parse_maps, safe_float, safe_int
+
+# Lookup table for converting ASCII hex digits to their value. Anything else maps to -1.
+_hex_values = np.full(256, -1, dtype=np.int16)
+for _i, _c in enumerate('0123456789ABCDEF'):
+    _hex_values[ord(_c)] = _i
+    _hex_values[ord(_c.lower())] = _i
+
+def _split_at(strings, index):
+    '''Split each string in fixed width string array at character index. Return (head, tail) string arrays.'''
+    width = strings.dtype.itemsize
+    if index >= width:
+        return strings, np.zeros(len(strings), dtype='S1')
+    chars = np.ascontiguousarray(strings).view(np.uint8).reshape(len(strings), width)
+    head = np.ascontiguousarray(chars[:, :index]).view('S{}'.format(index)).ravel()
+    tail = np.ascontiguousarray(chars[:, index:]).view('S{}'.format(width - index)).ravel()
+    return head, tail
+
+def _to_float(strings):
+    '''Vectorized safe_float(). Empty or invalid fields become NaN.'''
+    strings = np.where(strings == '', 'nan', strings)
+    try:
+        return strings.astype(np.float64)
+    except ValueError:
+        # At least one malformed field so fall back on converting one at a time.
+        return np.array([safe_float(s) for s in strings], dtype=np.float64)
+
+def _to_int(strings):
+    '''Vectorized safe_int(). Empty or invalid fields become 0.'''
+    strings = np.where(strings == '', '0', strings)
+    try:
+        return strings.astype(np.int64)
+    except ValueError:
+        return np.array([safe_int(s) for s in strings], dtype=np.int64)
+
+def _to_latitude(strings):
+    '''Vectorized convert_latitude().'''
+    degrees, minutes = _split_at(strings, 2)
+    return _to_float(degrees) + _to_float(minutes) / 60.0
+
+def _to_longitude(strings):
+    '''Vectorized convert_longitude().'''
+    degrees, minutes = _split_at(strings, 3)
+    return _to_float(degrees) + _to_float(minutes) / 60.0
+
+def _to_seconds_of_day(strings):
+    '''Convert hhmmss.ss strings to seconds since start of day. NaN if any part is missing.'''
+    hours, rest = _split_at(strings, 2)
+    minutes, seconds = _split_at(rest, 2)
+    return _to_float(hours) * 3600.0 + _to_float(minutes) * 60.0 + _to_float(seconds)
+
+def _day_offsets(seconds):
+    '''
+    Return the number of seconds to add to each time of day (in logged order) to account for passing UTC
+    midnight, using the same rule as UTCDate where the time of day jumping backwards by more than half a day
+    is a rollover and jumping forwards by more than half a day is a late sentence from the day before.
+    '''
+    seconds_per_day = nmea_parser.UTCDate.seconds_per_day
+    offsets = np.zeros(len(seconds))
+    valid = np.flatnonzero(~np.isnan(seconds))
+    jumps = np.diff(seconds[valid])
+    rollovers = np.cumsum((jumps < -seconds_per_day / 2).astype(np.int64) - (jumps > seconds_per_day / 2))
+    offsets[valid[1:]] = rollovers * seconds_per_day
+    return offsets
+
+def _logged_day_start(columns_by_type):
+    '''
+    Return unix time at the start of the UTC day the log begins on, using the first RMC or ZDA sentence
+    with a valid date.  UTC times in columns must still be relative to the start of the log's first day.
+    Return None if the log doesn't have any dates.
+    '''
+    seconds_per_day = nmea_parser.UTCDate.seconds_per_day
+    for sentence_type in ('RMC', 'ZDA'):
+        columns = columns_by_type.get(sentence_type)
+        if columns is None:
+            continue
+        seconds = columns['utc_time']
+        if sentence_type == 'RMC':
+            day_starts = columns['utc_date']
+        else:
+            day_starts = np.array([calendar.timegm((y, m, d, 0, 0, 0)) if (1 <= m <= 12 and 1 <= d <= 31) else np.nan
+                                   for d, m, y in zip(columns['day'], columns['month'], columns['year'])])
+        dated = np.flatnonzero(~np.isnan(day_starts) & ~np.isnan(seconds))
+        if len(dated) > 0:
+            first = dated[0]
+            # Back out any midnights that passed before the first dated sentence.
+            return day_starts[first] - (seconds[first] // seconds_per_day) * seconds_per_day
+    return None
+
+def _to_status_flag(strings):
+    '''Vectorized convert_status_flag().'''
+    return strings == 'A'
+
+def _to_mps(strings):
+    '''Vectorized convert_knots_to_mps().'''
+    return _to_float(strings) * 0.514444444444
+
+def _to_rads(strings):
+    '''Vectorized convert_deg_to_rads().'''
+    return np.radians(_to_float(strings))
+
+# Vectorized equivalent of each conversion function used in parse_maps.  UTC time is handled separately
+# since it needs the date. Any converter not listed here is applied one field at a time.
+vectorized_converters = {
+    safe_float: _to_float,
+    safe_int: _to_int,
+    int: _to_int,
+    str: lambda strings: strings,
+    nmea_parser.convert_latitude: _to_latitude,
+    nmea_parser.convert_longitude: _to_longitude,
+    nmea_parser.convert_status_flag: _to_status_flag,
+    nmea_parser.convert_knots_to_mps: _to_mps,
+    nmea_parser.convert_deg_to_rads: _to_rads,
+    }
+
+def find_sentences(data):
+    '''
+    Locate every line in data (a string read from an NMEA log) and validate its checksum.
+    Return tuple of arrays (starts, ends, valid) where starts is the index of the '$',
+    ends is the index of the '*' and valid is true if the line is a sentence with a correct checksum.
+    '''
+    raw = np.frombuffer(data, dtype=np.uint8)
+    if len(raw) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0, dtype=bool)
+
+    newlines = np.flatnonzero(raw == ord('\n'))
+    line_starts = np.concatenate(([0], newlines + 1))
+    line_ends = np.concatenate((newlines, [len(raw)]))
+    non_empty = line_ends > line_starts
+    line_starts = line_starts[non_empty]
+    line_ends = line_ends[non_empty]
+    # Ignore carriage returns so the checksum is the last thing on the line.
+    line_ends = line_ends - (raw[line_ends - 1] == ord('\r'))
+
+    # First '$' and last '*' of every line.
+    dollars = np.flatnonzero(raw == ord('$'))
+    stars = np.flatnonzero(raw == ord('*'))
+    dollar_index = np.searchsorted(dollars, line_starts)
+    star_index = np.searchsorted(stars, line_ends) - 1
+    starts = np.append(dollars, len(raw))[dollar_index]
+    ends = np.append(stars, -1)[star_index]
+
+    valid = (starts < ends) & (ends >= line_starts) & (ends + 3 == line_ends)
+
+    # XOR all characters between the '$' and '*' of each line.
+    bounds = np.zeros(2 * len(starts), dtype=np.int64)
+    bounds[0::2] = np.where(valid, starts + 1, 0)
+    bounds[1::2] = np.where(valid, ends, 0)
+    checksums = np.bitwise_xor.reduceat(raw, bounds)[0::2]
+    # A '$' right before the '*' leaves nothing to checksum, and reduceat doesn't handle empty ranges.
+    checksums[starts + 1 == ends] = 0
+
+    high_digit = _hex_values[raw[np.where(valid, ends + 1, 0)]]
+    low_digit = _hex_values[raw[np.where(valid, ends + 2, 0)]]
+    valid &= (high_digit >= 0) & (low_digit >= 0) & (checksums == high_digit * 16 + low_digit)
+
+    return starts, ends, valid
+
+def _take_strings(raw, offsets, length):
+    '''Return fixed width string array made of the 'length' characters starting at each offset.'''
+    indices = np.minimum(offsets[:, np.newaxis] + np.arange(length), len(raw) - 1)
+    return np.ascontiguousarray(raw[indices]).view('S{}'.format(length)).ravel()
+
+def _sentence_types(raw, starts, ends):
+    '''
+    Return string array with the three letter type of each sentence, e.g. "GGA" for $GPGGA and
+    "AVR" for $PTNL,AVR.  Sentences that aren't a standard GPS or Trimble sentence get an empty type.
+    '''
+    prefixes = _take_strings(raw, starts, 6)
+    is_trimble = prefixes == '$PTNL,'
+    is_gps = _take_strings(raw, starts, 3) == '$GP'
+    type_offsets = np.where(is_trimble, starts + 6, starts + 3)
+    types = _take_strings(raw, type_offsets, 3)
+    # Make sure the type is the entire field.
+    separators = _take_strings(raw, type_offsets + 3, 1)
+    known = (is_gps | is_trimble) & (type_offsets + 3 <= ends) & ((separators == ',') | (type_offsets + 3 == ends))
+    return np.where(known, types, '')
+
+def _field_table(raw, starts, ends, width):
+    '''
+    Split sentences that all have 'width' fields into a 2D array of field strings with one row per sentence.
+    The checksum isn't included.  Does all sentences with one split instead of one split per sentence.
+    '''
+    # Copy out the characters from each '$' up to and including the '*'.
+    lengths = ends - starts + 1
+    sentence_ends = np.cumsum(lengths)
+    offsets = np.repeat(starts - (sentence_ends - lengths), lengths)
+    characters = raw[offsets + np.arange(len(offsets))]
+
+    # Swap each '*' for a comma so the last field of one sentence doesn't run into the first field of the next.
+    characters[sentence_ends - 1] = ord(',')
+
+    fields = characters.tostring().split(',')[:-1]
+    return np.array(fields, dtype=np.string_).reshape(len(starts), width)
+
+def parse_nmea_buffer(data, day_start=None):
+    '''
+    Parse every NMEA sentence in data (the contents of an NMEA log) into columns. Return dictionary
+    with the sentence type (e.g. "GGA") as the key and a dictionary of {field name: array} as the value.
+    Each array has one element per sentence of that type, in the order they appear in the log.  An
+    extra 'line' field holds the index of each sentence out of all valid sentences so types can be merged.
+    Sentences with bad checksums or unknown types are skipped.  Day start is the unix time at the start
+    of the UTC date the log begins on.  By default it comes from the first RMC or ZDA sentence, or
+    today's date if there aren't any.  Times after the log passes midnight are moved to the next day.
+    '''
+    starts, ends, valid = find_sentences(data)
+    starts = starts[valid]
+    ends = ends[valid]
+    if len(starts) == 0:
+        return {}
+
+    raw = np.frombuffer(data, dtype=np.uint8)
+    types = _sentence_types(raw, starts, ends)
+    commas = np.flatnonzero(raw == ord(','))
+    widths = np.searchsorted(commas, ends) - np.searchsorted(commas, starts) + 1
+
+    parsed = {}
+    for sentence_type, parse_map in parse_maps.iteritems():
+        lines = np.flatnonzero(types == sentence_type)
+        if len(lines) == 0:
+            continue
+
+        # Sentences of the same type can have a different number of fields, so split each group separately
+        # and then pad out the missing fields.
+        group_widths = widths[lines]
+        max_width = group_widths.max()
+        table = np.zeros((len(lines), max_width), dtype='S1')
+        for width in np.unique(group_widths):
+            in_group = group_widths == width
+            group_lines = lines[in_group]
+            group_table = _field_table(raw, starts[group_lines], ends[group_lines], width)
+            if group_table.dtype.itemsize > table.dtype.itemsize:
+                table = table.astype(group_table.dtype)
+            table[in_group, :width] = group_table
+
+        columns = {'line': lines}
+        for field_name, converter, index in parse_map:
+            if index < max_width:
+                strings = table[:, index]
+            else:
+                strings = np.zeros(len(lines), dtype='S1')
+            if converter is nmea_parser.convert_time:
+                # Leave as seconds into the day until the date is known.
+                columns[field_name] = _to_seconds_of_day(strings)
+            elif converter in vectorized_converters:
+                columns[field_name] = vectorized_converters[converter](strings)
+            else:
+                columns[field_name] = np.array([converter(s) for s in strings])
+        parsed[sentence_type] = columns
+
+    # Find where the log passes midnight using every time in the order it was logged.
+    time_columns = [(columns, field_name) for sentence_type, columns in parsed.iteritems()
+                    for field_name, converter, _ in parse_maps[sentence_type] if converter is nmea_parser.convert_time]
+    if len(time_columns) > 0:
+        lines = np.concatenate([columns['line'] for columns, _ in time_columns])
+        seconds = np.concatenate([columns[field_name] for columns, field_name in time_columns])
+        order = np.argsort(lines, kind='mergesort')
+        offsets = np.empty(len(seconds))
+        offsets[order] = _day_offsets(seconds[order])
+        column_ends = np.cumsum([len(columns['line']) for columns, _ in time_columns])
+        for (columns, field_name), column_offsets in zip(time_columns, np.split(offsets, column_ends[:-1])):
+            columns[field_name] += column_offsets
+
+    if day_start is None:
+        day_start = _logged_day_start(parsed)
+    if day_start is None:
+        day_start = (int(time.time()) // 86400) * 86400
+
+    for columns, field_name in time_columns:
+        columns[field_name] += day_start
+
+    return parsed
+
+def parse_nmea_file(file_path, day_start=None):
+    '''Read in entire NMEA log file and parse it with parse_nmea_buffer().'''
+    with open(file_path, 'rb') as nmea_file:
+        data = nmea_file.read()
+    return parse_nmea_buffer(data, day_start)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+import time
+from collections import deque
+
+class NMEAFramer(object):
+    '''
+    Reads everything waiting on a serial port at once and splits it into complete $...*hh NMEA sentences.
+    Each sentence is timestamped with the estimated arrival time of its first byte. Any garbage between
+    sentences (or a sentence cut off by another '$') is skipped without losing the sentence after it.
+    '''
+    # NMEA limits sentences to 82 characters, but some proprietary sentences are longer.
+    max_sentence_length = 256
+
+    # Start bit + 8 data bits + stop bit.
+    bits_per_byte = 10
+
+    def __init__(self, port, baud):
+        '''Constructor. Port is an open serial.Serial that should have a read timeout set.'''
+        self.port = port
+
+        # How long it takes one byte to come in over the serial line.
+        self.byte_time = self.bits_per_byte / float(baud)
+
+        # Bytes that have been read in, but not returned as a sentence yet.
+        self.buffer = bytearray()
+
+        # [number of bytes still in buffer, arrival time of last byte] for each read, oldest first.
+        self.reads = deque()
+
+        # How many bytes have been thrown out because they weren't part of a sentence.
+        self.discarded_byte_count = 0
+
+    def sentences(self):
+        '''Generator that yields (sentence, arrival_time) forever.'''
+        while True:
+            for sentence in self.read_sentences():
+                yield sentence
+
+    def read_sentences(self):
+        '''
+        Block until data is available (or the port times out) and then read in everything that's waiting.
+        Return list of (sentence, arrival_time) for every sentence that's been completed.
+        '''
+        # Read at least one byte so this blocks when nothing's waiting instead of spinning.
+        return self._read(max(self.port.inWaiting(), 1))
+
+    def read_waiting(self):
+        '''Read in everything that's waiting without blocking. Return list of (sentence, arrival_time).'''
+        waiting = self.port.inWaiting()
+        if waiting == 0:
+            return []
+        return self._read(waiting)
+
+    def _read(self, byte_count):
+        '''Read up to byte_count bytes and return list of (sentence, arrival_time) for every completed sentence.'''
+        data = self.port.read(byte_count)
+        read_time = time.time()
+
+        if len(data) == 0:
+            return [] # timed out
+
+        self.buffer.extend(data)
+        self.reads.append([len(data), read_time])
+
+        return self._extract_sentences()
+
+    def _arrival_time(self, index):
+        '''Return estimated time that the byte at index in buffer arrived.'''
+        for byte_count, last_byte_time in self.reads:
+            if index < byte_count:
+                # Work backwards from the last byte read in since bytes arrive at a fixed rate.
+                return last_byte_time - (byte_count - 1 - index) * self.byte_time
+            index -= byte_count
+        return time.time()
+
+    def _discard(self, byte_count):
+        '''Remove byte_count bytes from the front of the buffer.'''
+        del self.buffer[:byte_count]
+        while byte_count > 0 and self.reads:
+            if self.reads[0][0] <= byte_count:
+                byte_count -= self.reads.popleft()[0]
+            else:
+                self.reads[0][0] -= byte_count
+                byte_count = 0
+
+    def _extract_sentences(self):
+        '''Return list of (sentence, arrival_time) for every complete sentence in buffer.'''
+        sentences = []
+        while True:
+            start_index = self.buffer.find('$')
+            if start_index < 0:
+                # Nothing that could be a sentence.
+                self.discarded_byte_count += len(self.buffer)
+                self._discard(len(self.buffer))
+                break
+
+            if start_index > 0:
+                # Resync on start of sentence.
+                self.discarded_byte_count += start_index
+                self._discard(start_index)
+
+            checksum_index = self.buffer.find('*')
+            next_start_index = self.buffer.find('$', 1)
+
+            if next_start_index > 0 and (checksum_index < 0 or next_start_index < checksum_index):
+                # Sentence was cut off by the start of another one.
+                self.discarded_byte_count += next_start_index
+                self._discard(next_start_index)
+                continue
+
+            if checksum_index < 0 or len(self.buffer) < checksum_index + 3:
+                if len(self.buffer) > self.max_sentence_length:
+                    # Never going to be a valid sentence so skip the $ and look for the next one.
+                    self.discarded_byte_count += 1
+                    self._discard(1)
+                    continue
+                break # wait for rest of sentence
+
+            sentence_end = checksum_index + 3
+            sentences.append((str(self.buffer[:sentence_end]), self._arrival_time(0)))
+            self._discard(sentence_end)
+
+        return sentences
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+import os
+import math
+import mmap
+import struct
+import logging
+from array import array
+from bisect import bisect_left, bisect_right
+
+from nmea_parser import find_time_of_day, UTCDate
+
+class NMEALogIndex(object):
+    '''
+    Memory maps an NMEA log file and indexes the byte offset of each sentence by its UTC time so that any
+    section of the log can be pulled out without reading it from the start.  Times in the index are seconds
+    since the start of the UTC day the log begins on, so they keep increasing if the log passes midnight.
+    The index is saved next to the log (with an .idx extension) and only rebuilt when the log changes.
+    '''
+    # Magic string, version, log size, log modification time, entry count, offset item size.
+    header_format = '<8sIQdQI'
+    magic = 'PISCIDX\0'
+    version = 1
+
+    def __init__(self, file_path):
+        '''Constructor. Loads index for log or builds it if it's missing or out of date.'''
+        self.file_path = file_path
+        self.index_path = file_path + '.idx'
+
+        self.log_file = open(file_path, 'rb')
+        log_stat = os.fstat(self.log_file.fileno())
+        self.log_size = log_stat.st_size
+        self.log_mtime = log_stat.st_mtime
+
+        # Can't memory map an empty file.
+        self.data = ''
+        if self.log_size > 0:
+            self.data = mmap.mmap(self.log_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # Time of each sentence and the byte offset to the start of its line.  Each time is the latest time
+        # seen so far in the log so that the times are always sorted, even if some sentences come in late.
+        self.times = array('d')
+        self.offsets = array('L')
+
+        if not self._load():
+            self._build()
+            self._save()
+
+    def close(self):
+        '''Close memory mapped log.'''
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.data = ''
+        self.log_file.close()
+
+    def __len__(self):
+        '''Return number of indexed sentences.'''
+        return len(self.times)
+
+    @property
+    def start_time(self):
+        '''Time of first indexed sentence or NaN if log doesn't have any times.'''
+        return self.times[0] if self.times else float('NaN')
+
+    @property
+    def end_time(self):
+        '''Time of last indexed sentence or NaN if log doesn't have any times.'''
+        return self.times[-1] if self.times else float('NaN')
+
+    def log_time(self, time_of_day):
+        '''
+        Return time of day (seconds since the start of a UTC day) as a time in the index.  If it's before the log
+        starts then it's moved to the first later day that it's in the log, so logs that pass midnight can be seeked
+        past it.  Times that are already past the first day (86400 or more) are left alone.
+        '''
+        log_time = time_of_day
+        if not self.times:
+            return log_time
+        while log_time < self.start_time and log_time + UTCDate.seconds_per_day <= self.end_time:
+            log_time += UTCDate.seconds_per_day
+        return log_time
+
+    def offset_at(self, log_time):
+        '''Return byte offset of the first sentence at or after log time, or the end of the log if there isn't one.'''
+        index = bisect_left(self.times, log_time)
+        if index >= len(self.offsets):
+            return self.log_size
+        return self.offsets[index]
+
+    def offset_after(self, log_time):
+        '''Return byte offset of the first sentence after log time, or the end of the log if there isn't one.'''
+        index = bisect_right(self.times, log_time)
+        if index >= len(self.offsets):
+            return self.log_size
+        return self.offsets[index]
+
+    def sentences_between(self, start_time, end_time):
+        '''Return list of every sentence between start time and end time (inclusive) in the order they were logged.'''
+        start_offset = self.offset_at(start_time)
+        end_offset = self.offset_after(end_time)
+        if end_offset <= start_offset:
+            return []
+        return [line.strip() for line in self.data[start_offset:end_offset].splitlines() if line.strip()]
+
+    def _build(self):
+        '''Scan entire log to create index.'''
+        self.times = array('d')
+        self.offsets = array('L')
+
+        half_day = UTCDate.seconds_per_day / 2
+        day_offset = 0
+        last_time_of_day = None
+        latest_time = None
+
+        line_start = 0
+        while line_start < self.log_size:
+            line_end = self.data.find('\n', line_start)
+            if line_end < 0:
+                line_end = self.log_size
+
+            time_of_day = find_time_of_day(self.data[line_start:line_end].strip())
+
+            if not math.isnan(time_of_day):
+                if last_time_of_day is not None:
+                    if time_of_day < last_time_of_day - half_day:
+                        day_offset += UTCDate.seconds_per_day
+                    elif time_of_day > last_time_of_day + half_day:
+                        day_offset -= UTCDate.seconds_per_day
+                last_time_of_day = time_of_day
+
+                log_time = time_of_day + day_offset
+                if latest_time is None or log_time > latest_time:
+                    latest_time = log_time
+
+                self.times.append(latest_time)
+                self.offsets.append(line_start)
+
+            line_start = line_end + 1
+
+    def _load(self):
+        '''Read in saved index. Return false if it doesn't exist or is out of date.'''
+        header_size = struct.calcsize(self.header_format)
+        try:
+            with open(self.index_path, 'rb') as index_file:
+                header = index_file.read(header_size)
+                if len(header) != header_size:
+                    return False
+                magic, version, log_size, log_mtime, count, offset_size = struct.unpack(self.header_format, header)
+                if (magic != self.magic or version != self.version or log_size != self.log_size or
+                        log_mtime != self.log_mtime or offset_size != self.offsets.itemsize):
+                    return False
+                self.times.fromfile(index_file, count)
+                self.offsets.fromfile(index_file, count)
+        except (IOError, EOFError, struct.error):
+            self.times = array('d')
+            self.offsets = array('L')
+            return False
+
+        return True
+
+    def _save(self):
+        '''Write index next to log so it doesn't need to be rebuilt next time.'''
+        try:
+            with open(self.index_path, 'wb') as index_file:
+                index_file.write(struct.pack(self.header_format, self.magic, self.version, self.log_size,
+                                             self.log_mtime, len(self.times), self.offsets.itemsize))
+                self.times.tofile(index_file)
+                self.offsets.tofile(index_file)
+        except IOError as e:
+            # Not a big deal since can just rebuild it next time.
+            logging.getLogger().warning('Could not save NMEA log index {}: {}'.format(self.index_path, e))
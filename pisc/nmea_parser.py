@@ -30,11 +30,12 @@
 # ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-import re
 import time
 import calendar
 import math
 
+from checksum_utils import nmea_checksum
+
 def safe_float(field):
     try:
         return float(field)
@@ -57,10 +58,69 @@ def convert_longitude(field):
     return safe_float(field[0:3]) + safe_float(field[3:]) / 60.0
 
 
-def convert_time(nmea_utc):
-    # Get current time in UTC for date information
-    utc_struct = time.gmtime()  # immutable, so cannot modify this one
-    utc_list = list(utc_struct)
+class UTCDate(object):
+    '''
+    Keeps track of the unix time at the start of the current UTC day so that NMEA times, which only have
+    the time of day, can be converted to unix time with a single add.  Until a sentence with the date
+    (RMC or ZDA) is received the date comes from the system clock.  Rolls over to the next day when the
+    time of day jumps backwards by more than half a day.
+    '''
+    seconds_per_day = 86400
+    
+    def __init__(self):
+        '''Constructor'''
+        # Unix time at the start of the current UTC day. None until first time is converted or date is set.
+        self.day_start = None
+        
+        # Seconds into the day of the last converted time.  Used to detect midnight rollover.
+        self.last_seconds = None
+        
+        # Last (year, month, day) set from the GPS, or None if the date has come from the system clock.
+        self.date = None
+    
+    def set_date(self, year, month, day):
+        '''Set current UTC date. Should be called before converting the time in the same sentence.'''
+        if (year, month, day) == self.date:
+            return # nothing changed
+        if not (1 <= month <= 12 and 1 <= day <= 31):
+            return # invalid date
+        self.date = (year, month, day)
+        self.day_start = calendar.timegm((year, month, day, 0, 0, 0))
+        # Date is now known for sure so don't compare the next time against one from the old date.
+        self.last_seconds = None
+    
+    def convert(self, seconds_of_day):
+        '''Return unix time for the seconds since the start of the current UTC day.'''
+        half_day = self.seconds_per_day / 2
+        
+        if self.day_start is None:
+            # Use the system date, but pick the day that puts the time closest to now so
+            # fixes taken right around midnight don't end up on the wrong side of it.
+            now = time.time()
+            self.day_start = int(now // self.seconds_per_day) * self.seconds_per_day
+            offset = self.day_start + seconds_of_day - now
+            if offset > half_day:
+                self.day_start -= self.seconds_per_day
+            elif offset < -half_day:
+                self.day_start += self.seconds_per_day
+        elif self.last_seconds is not None:
+            if seconds_of_day < self.last_seconds - half_day:
+                # Passed midnight.
+                self.day_start += self.seconds_per_day
+            elif seconds_of_day > self.last_seconds + half_day:
+                # Sentence from right before midnight arriving after one from the new day.
+                return self.day_start - self.seconds_per_day + seconds_of_day
+        
+        self.last_seconds = seconds_of_day
+        
+        return self.day_start + seconds_of_day
+
+# Date used for converted times when the caller doesn't have its own.  Each receiver should have its own
+# UTCDate so that one receiver's date doesn't change the date of another.
+utc_date = UTCDate()
+
+def convert_time_of_day(nmea_utc):
+    '''Return seconds since the start of the UTC day for hhmmss.ss time.'''
     # If one of the time fields is empty, return NaN seconds
     if not nmea_utc[0:2] or not nmea_utc[2:4] or not nmea_utc[4:6]:
         return float('NaN')
@@ -68,11 +128,30 @@ def convert_time(nmea_utc):
         hours = int(nmea_utc[0:2])
         minutes = int(nmea_utc[2:4])
         seconds = float(nmea_utc[4:])
-        utc_list[3] = hours
-        utc_list[4] = minutes
-        utc_list[5] = seconds
-        unix_time = calendar.timegm(tuple(utc_list))
-        return unix_time
+        return hours * 3600 + minutes * 60 + seconds
+
+
+def convert_time(nmea_utc, date=None):
+    '''Return unix time for hhmmss.ss time using date (a UTCDate), or the shared utc_date if it's None.'''
+    seconds_of_day = convert_time_of_day(nmea_utc)
+    if math.isnan(seconds_of_day):
+        return seconds_of_day
+    return (utc_date if date is None else date).convert(seconds_of_day)
+
+
+def split_date(nmea_date):
+    '''Return ddmmyy date as tuple of (year, month, day) or None if invalid.'''
+    if len(nmea_date) != 6 or not nmea_date.isdigit():
+        return None
+    return (2000 + int(nmea_date[4:6]), int(nmea_date[2:4]), int(nmea_date[0:2]))
+
+
+def convert_date(nmea_date):
+    '''Return unix time at the start of ddmmyy date. NaN if date is invalid.'''
+    date = split_date(nmea_date)
+    if date is None:
+        return float('NaN')
+    return calendar.timegm(date + (0, 0, 0))
 
 
 def convert_status_flag(status_flag):
@@ -117,6 +196,13 @@ parse_maps = {
         ("longitude_direction", str, 6),
         ("speed", convert_knots_to_mps, 7),
         ("true_course", convert_deg_to_rads, 8),
+        ("utc_date", convert_date, 9),
+        ],
+    "ZDA": [
+        ("utc_time", convert_time, 1),
+        ("day", safe_int, 2),
+        ("month", safe_int, 3),
+        ("year", safe_int, 4),
         ],
     "AVR": [
         # Every index is 1 higher since the type takes up two fields.
@@ -142,50 +228,138 @@ parse_maps = {
         ],
     "GST": [
         # Added to provide fix accuracy data.
+        ("utc_time", convert_time, 1),
         ("latitude_error",safe_float,6),
         ("longitude_error",safe_float,7),
         ]
     }
 
-def parse_nmea_sentence(nmea_sentence):
-        
-    # Check for standard GPS sentence.
-    is_gps_sentence = re.match('^\$GP.*\*[0-9A-Fa-f]{2}$', nmea_sentence)
-        
-    # Need to handle trimble proprietary sentences that begin with the field PTNL.
-    if is_gps_sentence:
-        is_trimble_sentence = False
-    else:
-        is_trimble_sentence = re.match('^\$PTNL.*\*[0-9A-Fa-f]{2}$', nmea_sentence)
-    
-    # Check for a valid nmea sentence
-    if not (is_gps_sentence or is_trimble_sentence):
-        return False
-    
-    fields = [field.strip(',') for field in nmea_sentence.split(',')]
+def _zda_date(fields):
+    '''Return (year, month, day) from split ZDA sentence or None if invalid.'''
+    try:
+        return (int(fields[4]), int(fields[3]), int(fields[2]))
+    except (IndexError, ValueError):
+        return None
 
-    # The regex probably checks for this, but I can't understand it well enough
-    # so I'm putting this here to be safe.
-    if len(fields) < 2:
-        return False
-    
-    # Remove checksum from last field since it's already been checked.
-    fields[-1] = (fields[-1].split('*')[0]).strip()
-
-    if is_gps_sentence:
-        # Ignore $ and GP
-        sentence_type = fields[0][3:]
-    elif is_trimble_sentence:
-        # The actual sentence type is the second field.
+"""Sentences that contain the UTC date.  Key is the sentence identifier and value is a
+function that returns (year, month, day) from the split sentence, or None if it's not valid.
+The date is applied to the sentence's UTCDate before any fields in that sentence are converted."""
+date_parsers = {
+    "RMC": lambda fields: split_date(fields[9]) if len(fields) > 9 else None,
+    "ZDA": _zda_date,
+    }
+
+def tokenize_nmea_sentence(nmea_sentence):
+    '''
+    Split NMEA sentence into fields and verify its checksum in one pass. Return tuple of
+    (sentence_type, checksum_valid, fields) where fields doesn't include the checksum, or None if the
+    sentence isn't framed as $...*hh.  Sentence type is None if it's not a standard GPS ($GP) or
+    Trimble proprietary ($PTNL) sentence.
+    '''
+    if not nmea_sentence.startswith('$'):
+        return None
+
+    checksum_index = nmea_sentence.rfind('*')
+    if checksum_index < 0:
+        return None
+
+    transmitted_checksum = nmea_sentence[checksum_index+1:].strip()
+    if len(transmitted_checksum) != 2:
+        return None
+
+    # Everything between the $ and * is both the checksummed data and the fields.
+    data = nmea_sentence[1:checksum_index]
+    checksum_valid = ("%02X" % nmea_checksum(data)) == transmitted_checksum.upper()
+
+    fields = data.split(',')
+
+    if fields[0].startswith('GP'):
+        # Ignore GP
+        sentence_type = fields[0][2:]
+    elif fields[0] == 'PTNL' and len(fields) > 1:
+        # Need to handle trimble proprietary sentences where the actual sentence type is the second field.
         sentence_type = fields[1]
+    else:
+        sentence_type = None
+
+    return (sentence_type, checksum_valid, fields)
 
-    if not sentence_type in parse_maps:
+def decode_nmea_fields(sentence_type, fields, date=None):
+    '''
+    Convert only the fields that parse_maps needs for the sentence type. Fields are the split sentence
+    from tokenize_nmea_sentence(). Times are converted using date (a UTCDate for the receiver the sentence
+    came from), or the shared utc_date if it's None. Return {sentence_type: parsed_sentence} or False if
+    the sentence type isn't supported or the fields can't be converted.
+    '''
+    parse_map = parse_maps.get(sentence_type)
+    if parse_map is None:
         return False
 
-    parse_map = parse_maps[sentence_type]
+    if date is None:
+        date = utc_date
+
+    if sentence_type in date_parsers:
+        sentence_date = date_parsers[sentence_type](fields)
+        if sentence_date is not None:
+            date.set_date(*sentence_date)
 
     parsed_sentence = {}
-    for entry in parse_map:
-        parsed_sentence[entry[0]] = entry[1](fields[entry[2]])
+    try:
+        for field_name, convert, index in parse_map:
+            if convert is convert_time:
+                parsed_sentence[field_name] = convert_time(fields[index], date)
+            else:
+                parsed_sentence[field_name] = convert(fields[index])
+    except (IndexError, ValueError):
+        return False # missing fields or one that's not allowed to be empty.
+
+    return {sentence_type: parsed_sentence}
+
+def parse_nmea_sentence(nmea_sentence, date=None):
+    '''
+    Return parsed sentence as {sentence_type: parsed_sentence} or False if can't parse. Doesn't verify checksum.
+    Date is the UTCDate to convert times with (see decode_nmea_fields).
+    '''
+    tokens = tokenize_nmea_sentence(nmea_sentence)
+    if tokens is None:
+        return False
+
+    sentence_type, _, fields = tokens
+
+    return decode_nmea_fields(sentence_type, fields, date)
+
+def find_time_of_day(nmea_sentence):
+    '''
+    Return seconds since the start of the UTC day that sentence was recorded without parsing any other fields
+    or updating the current date.  Return NaN if sentence doesn't have a time field listed in parse_maps.
+    '''
+    tokens = tokenize_nmea_sentence(nmea_sentence)
+    if tokens is None:
+        return float('NaN')
+
+    sentence_type, _, fields = tokens
+
+    for _, convert, index in parse_maps.get(sentence_type, []):
+        if convert is convert_time and index < len(fields):
+            try:
+                return convert_time_of_day(fields[index])
+            except ValueError:
+                break
+
+    return float('NaN')
+
+def check_and_parse_nmea_sentence(nmea_sentence, date=None):
+    '''
+    Verify checksum and parse sentence without splitting it twice. Return tuple of (checksum_valid, parsed_sentence)
+    where parsed_sentence is the same as parse_nmea_sentence(), or False if the checksum isn't valid.  Date is the
+    UTCDate to convert times with (see decode_nmea_fields).
+    '''
+    tokens = tokenize_nmea_sentence(nmea_sentence)
+    if tokens is None:
+        return (False, False)
+
+    sentence_type, checksum_valid, fields = tokens
+    if not checksum_valid:
+        return (False, False)
 
-    return {sentence_type: parsed_sentence}
\ No newline at end of file
+    return (True, decode_nmea_fields(sentence_type, fields, date))
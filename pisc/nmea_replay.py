@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+import math
+import time
+
+from nmea_parser import find_time_of_day, UTCDate
+from nmea_index import NMEALogIndex
+
+class NMEAReplay(object):
+    '''
+    Plays back an NMEA log file with the same timing it was recorded with by scheduling each sentence using
+    the UTC time embedded in it.  Can be sped up or slowed down, looped, and started part way through the log.
+    Sentences without a time (or a type that's not in parse_maps) are sent right after the sentence before them.
+    '''
+    min_speed = 0.5
+    max_speed = 100.0
+
+    def __init__(self, file_path, speed=1.0, loop=False, seek_time=None, untimed_rate=10.0, max_gap=5.0):
+        '''
+        Constructor.  Speed is how many times faster than real time to replay the log.  If loop is true
+        then will start back over once the end of the log is reached.  Seek time is the seconds since the
+        start of the UTC day the log begins on to start the replay at (and loop back to), or None to start
+        at the beginning.  Seek times past a day (86400 s) are on later days.  If the log passes midnight then
+        a time of day before the log starts is taken to be on the first later day it's in the log (see
+        NMEALogIndex.log_time).  Untimed rate (Hz) is how fast to send sentences if the log doesn't have any
+        times in it.  Max gap (seconds of log time) limits how long to wait if the receiver stopped logging for
+        a while.
+        '''
+        self.file_path = file_path
+        self.speed = min(max(float(speed), self.min_speed), self.max_speed)
+        self.loop = loop
+        self.seek_time = seek_time
+        self.untimed_period = 1.0 / untimed_rate
+        self.max_gap = max_gap
+
+        # How many times the log has been played back from the beginning.
+        self.replay_count = 0
+
+        # Generator of (sentence, due_time) that the sentences are played from.
+        self._scheduled = self._schedule()
+
+        # Next (sentence, due_time) that isn't due yet.  Only used when not blocking.
+        self._next_sentence = None
+
+        # System time that the last sentence was due.
+        self._last_due_time = None
+
+        # True once reached end of log and not looping.
+        self.finished = False
+
+        # Byte offset in log to start playing from.
+        self.start_offset = 0
+        if seek_time is not None:
+            log_index = NMEALogIndex(file_path)
+            self.start_offset = log_index.offset_at(log_index.log_time(seek_time))
+            log_index.close()
+
+    def sentences(self):
+        '''Generator that yields (sentence, read_time) for every line in the log, waiting until it's due.'''
+        for sentence, due_time in self._scheduled:
+            delay = due_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            yield sentence, time.time()
+
+    def next_due_time(self):
+        '''Return system time that the next sentence is due, or None once the replay is finished. Doesn't block.'''
+        if self._next_sentence is None and not self.finished:
+            try:
+                self._next_sentence = next(self._scheduled)
+            except StopIteration:
+                self.finished = True
+
+        if self._next_sentence is None:
+            return None
+
+        return self._next_sentence[1]
+
+    def due_sentences(self):
+        '''Return list of (sentence, read_time) for every sentence that's due now. Doesn't block.'''
+        sentences = []
+        now = time.time()
+        while True:
+            due_time = self.next_due_time()
+            if due_time is None or due_time > now:
+                break
+            sentences.append((self._next_sentence[0], now))
+            self._next_sentence = None
+
+        return sentences
+
+    def _schedule(self):
+        '''Generator that yields (sentence, due_time) for every line in the log.'''
+        with open(self.file_path, 'r') as log_file:
+            while True:
+                log_file.seek(self.start_offset)
+
+                for sentence in self._play(log_file):
+                    yield sentence
+
+                self.replay_count += 1
+                if not self.loop:
+                    break
+
+    def _play(self, log_file):
+        '''Generator that schedules log once from the current file position.'''
+        # Log time (seconds into UTC day the log started on) and system time that the schedule is based on.
+        start_log_time = None
+        start_sys_time = None
+
+        # Latest log time so far. Used to find gaps in the log.
+        latest_log_time = None
+
+        # Seconds added to times to account for passing midnight in the log.
+        day_offset = 0
+        last_time_of_day = None
+
+        # True if found any sentences with a time in the log.
+        found_timed_sentence = False
+
+        half_day = UTCDate.seconds_per_day / 2
+
+        if self._last_due_time is None:
+            self._last_due_time = time.time()
+
+        for line in log_file:
+            sentence = line.strip()
+            if len(sentence) == 0:
+                continue
+
+            time_of_day = find_time_of_day(sentence)
+
+            if math.isnan(time_of_day):
+                if not found_timed_sentence:
+                    self._last_due_time += self.untimed_period / self.speed
+                yield sentence, self._last_due_time
+                continue
+
+            found_timed_sentence = True
+
+            if last_time_of_day is not None:
+                if time_of_day < last_time_of_day - half_day:
+                    day_offset += UTCDate.seconds_per_day
+                elif time_of_day > last_time_of_day + half_day:
+                    day_offset -= UTCDate.seconds_per_day
+            last_time_of_day = time_of_day
+            log_time = time_of_day + day_offset
+
+            if start_log_time is None or log_time - latest_log_time > self.max_gap or log_time < latest_log_time:
+                # Start of log, it has a big gap in it or time went backwards (e.g. log loops), so start schedule
+                # over from this sentence.
+                start_log_time = log_time
+                start_sys_time = self._last_due_time
+
+            latest_log_time = log_time
+
+            due_time = start_sys_time + (log_time - start_log_time) / self.speed
+            self._last_due_time = max(due_time, self._last_due_time)
+
+            yield sentence, due_time
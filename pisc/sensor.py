@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+import logging
+
 class Sensor:
     '''Base class for all sensors.''' 
     
@@ -66,6 +68,14 @@ class Sensor:
         '''Resume reading sensor data.  Need to override.'''
         raise NotImplementedError
     
-    def do_action(self, action_type):
-        '''Override to perform actions.'''
-        return
\ No newline at end of file
+    def do_action(self, action_type, argument=''):
+        '''
+        Perform action from a command sent by the server.  Stop and resume work for every sensor.  Argument is
+        anything after the action in the command (e.g. '2' for 'retime:2').  Override to perform other actions.
+        '''
+        if action_type == 'stop':
+            self.stop()
+        elif action_type == 'resume':
+            self.resume()
+        else:
+            logging.getLogger().warning('Sensor {} doesn\'t support action {}.'.format(self.sensor_name, action_type))
\ No newline at end of file
@@ -3,17 +3,63 @@
 import threading
 import logging
 import time
+import heapq
 
 from serial.serialutil import SerialException
 
 class SensorController:
     '''Start/stop sensors and filter commands for individual sensors. '''
     
-    def __init__(self, sensors):
-        '''Constructor'''
+    def __init__(self, sensors, time_source=None):
+        '''
+        Constructor. Time source is used to run commands at the UTC time they're scheduled for.  If it's None then
+        commands always run right away.
+        '''
         self.sensors = sensors
         self.threads = []
         
+        # Look up sensors that a command is for without searching through all of them.  IDs are stored as strings
+        # since that's how they come from the server.
+        self.sensors_by_type = {}
+        self.sensors_by_name = {}
+        self.sensors_by_id = {}
+        for sensor in sensors:
+            self.sensors_by_type.setdefault(sensor.get_type(), []).append(sensor)
+            self.sensors_by_name[sensor.get_name()] = sensor
+            self.sensors_by_id[str(sensor.get_id())] = sensor
+        
+        # Runs commands on its own thread so they never hold up the GPS client.
+        self.scheduler = CommandScheduler(time_source)
+        self.scheduler.setDaemon(True)
+        self.scheduler.start()
+        
+    def find_sensors(self, command_type, target):
+        '''
+        Return list of sensors that command is for.  Command type is 'ct' (target is sensor type),
+        'cn' (sensor name) or 'ci' (sensor ID).
+        '''
+        if command_type == 'ct':
+            return self.sensors_by_type.get(target, [])
+        if command_type == 'cn':
+            sensor = self.sensors_by_name.get(target)
+        elif command_type == 'ci':
+            sensor = self.sensors_by_id.get(str(target))
+        else:
+            sensor = None
+        return [sensor] if sensor is not None else []
+        
+    def handle_command(self, command_type, target, command, execute_time=None):
+        '''
+        Run command (e.g. 'stop' or 'retime:2') on every sensor it's for at UTC execute time, or right away if
+        execute time is None.  Anything after a colon is passed to the sensor as the action's argument.
+        '''
+        sensors = self.find_sensors(command_type, target)
+        if not sensors:
+            logging.getLogger().warning('No sensors match command {} for {}.'.format(command, target))
+            return
+        action_type, _, argument = command.partition(':')
+        self.scheduler.schedule(sensors, action_type, argument, execute_time)
+        
     def startup_sensors(self):
         '''Open each sensor interface and create a new thread to start reading data.'''
 
@@ -66,3 +112,79 @@ class SensorController:
                 time.sleep(0.2)
 
                        
+
+class CommandScheduler(threading.Thread):
+    '''
+    Runs sensor actions at the UTC time they're scheduled for so sensors on different computers can act together.
+    Every sensor for a command is run back-to-back on this thread so actions should be quick.
+    '''
+    # Condition.wait() can oversleep by tens of milliseconds, so stop waiting on it this long before a command
+    # is due and then sleep in small steps.
+    fine_wait_time = 0.06 # seconds
+    fine_sleep_time = 0.0005 # seconds
+    
+    # Longest to wait before checking the time again, since the time source can jump (e.g. when it's first set).
+    max_wait_time = 1.0 # seconds
+    
+    def __init__(self, time_source):
+        '''Constructor.  Time source gives current UTC time, or None to run everything right away.'''
+        super(CommandScheduler, self).__init__()
+        self.time_source = time_source
+        
+        # Heap of (execute time, order added, sensors, action type, argument).
+        self.commands = []
+        self.command_count = 0
+        self.condition = threading.Condition(threading.Lock())
+        
+    def schedule(self, sensors, action_type, argument, execute_time=None):
+        '''Run action on sensors at UTC execute time, or as soon as possible if it's None. Thread-safe.'''
+        with self.condition:
+            # Order added keeps commands for the same time in order and stops sensors lists from being compared.
+            heapq.heappush(self.commands, (execute_time or 0, self.command_count, sensors, action_type, argument))
+            self.command_count += 1
+            self.condition.notify()
+            
+    def run(self):
+        '''Thread start method. Wait for each command to be due and then run it.'''
+        while True:
+            with self.condition:
+                while not self.commands:
+                    self.condition.wait()
+                execute_time = self.commands[0][0]
+                remaining_time = execute_time - self._current_time()
+                if remaining_time > self.fine_wait_time:
+                    # Wake up early in case an earlier command is scheduled.
+                    self.condition.wait(min(remaining_time - self.fine_wait_time, self.max_wait_time))
+                    continue
+                
+            while self._current_time() < execute_time:
+                time.sleep(self.fine_sleep_time)
+                
+            with self.condition:
+                current_time = self._current_time()
+                due_commands = []
+                while self.commands and self.commands[0][0] <= current_time:
+                    due_commands.append(heapq.heappop(self.commands))
+                    
+            for command in due_commands:
+                self._run_command(*command)
+                
+    def _current_time(self):
+        '''Return current UTC time, or infinity if there's no time source so everything is due.'''
+        if self.time_source is None:
+            return float('inf')
+        return self.time_source.time
+                
+    def _run_command(self, execute_time, _, sensors, action_type, argument):
+        '''Have each sensor do action.'''
+        for sensor in sensors:
+            try:
+                sensor.do_action(action_type, argument)
+            except Exception as e:
+                logging.getLogger().error('Sensor {} failed to {}: {}'.format(sensor.get_name(), action_type, e))
+        
+        if execute_time > 0 and self.time_source is not None:
+            late_time = self.time_source.time - execute_time
+            logging.getLogger().info('Ran {} on {} sensors {:.1f} ms after scheduled time.'.format(action_type, len(sensors), late_time * 1000))
+        else:
+            logging.getLogger().info('Ran {} on {} sensors.'.format(action_type, len(sensors)))
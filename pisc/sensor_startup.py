@@ -15,6 +15,8 @@ from sensor_creation import create_sensors
 from time_position_sources import *
 from version import current_pisc_version, current_config_version
 from gps_startup import default_server_port
+from gps_protocol import supported_protocols
+from shared_memory import default_shared_memory_path
 
 if __name__ == "__main__":
     '''
@@ -56,12 +58,21 @@ if __name__ == "__main__":
     # Default time (in milliseconds) to use for threshold when syncing time on startup.  Smaller is stricter.
     default_sync_time = -1
     default_server_host = '127.0.0.1' # loop back
+    time_source_types = {'precise': PreciseTimeSource, 'relative': RelativePreciseTimeSource, 'disciplined': DisciplinedTimeSource}
+    default_time_source = 'precise'
+    default_shared_memory_poll = 1 # milliseconds
     
     # Define necessary and optional command line arguments.
     argparser = argparse.ArgumentParser(description='Uses config file to startup sensors and server.')
     argparser.add_argument('config_file', help='path to sensor configuration file')
     argparser.add_argument('-n', '--host', default=default_server_host, help='Server host name. Default {}.'.format(default_server_host))
     argparser.add_argument('-p', '--port', default=default_server_port, help='Server port number. Default {}.'.format(default_server_port))
+    argparser.add_argument('-b', '--backup_server', action='append', default=[], help='Standby server (host or host:port) to switch to if the server stops sending data. Can be repeated, in order of preference. Port defaults to server port.')
+    argparser.add_argument('-t', '--protocol', default=supported_protocols[0], choices=supported_protocols, help='Protocol to ask server to send data in. Falls back to csv if server doesn\'t support it. Default {}.'.format(supported_protocols[0]))
+    argparser.add_argument('-m', '--multicast', action='store_true', help='Get time/position/orientation from the server\'s multicast group if it has one.')
+    argparser.add_argument('-w', '--shared_memory', nargs='?', const=default_shared_memory_path, default=None, help='Read time/position/orientation from shared memory (default file {}) when server is on this computer and sharing it. Commands still come over UDP.'.format(default_shared_memory_path))
+    argparser.add_argument('-y', '--shared_memory_poll', default=default_shared_memory_poll, help='Time (in milliseconds) between checks of shared memory for new data. There\'s no way to be woken up by shared memory, so each check costs a system call to wait and shorter periods use more CPU. Default {}.'.format(default_shared_memory_poll))
+    argparser.add_argument('-c', '--time_source', default=default_time_source, choices=sorted(time_source_types.keys()), help='How to keep time between updates from server. Disciplined tracks system clock drift for long runs. Default {}.'.format(default_time_source))
     argparser.add_argument('-s', '--sync_thresh', default=default_sync_time, help='Time (in milliseconds) to use for threshold when syncing time. Smaller is stricter. If not greater than 0 then will disable syncing. Default {}.'.format(default_sync_time))
     args = argparser.parse_args()
 
@@ -69,6 +80,14 @@ if __name__ == "__main__":
     config_file = args.config_file
     host = args.host
     port = int(args.port)
+    server_addresses = [(host, port)]
+    for backup_server in args.backup_server:
+        backup_host, _, backup_port = backup_server.partition(':')
+        try:
+            server_addresses.append((backup_host, int(backup_port) if backup_port else port))
+        except ValueError:
+            log.error('Invalid backup server {}. Should be host or host:port.'.format(backup_server))
+            sys.exit(1)
     sync_time_thresh = float(args.sync_thresh) / 1000.0 # convert from ms to seconds
     sync_required = (sync_time_thresh > 0)
     if not os.path.isfile(config_file):
@@ -85,7 +104,7 @@ if __name__ == "__main__":
         log.error('No sensor information found in configuration file.')
         sys.exit(1)
         
-    time_source = PreciseTimeSource()
+    time_source = time_source_types[args.time_source]()
     position_source = SimplePositionSource()
     orientation_source = SimpleOrientationSource()
     
@@ -93,12 +112,14 @@ if __name__ == "__main__":
     
     log.info('Created {} sensors.'.format(len(sensors)))
 
-    sensor_controller = SensorController(sensors)
+    sensor_controller = SensorController(sensors, time_source)
 
     # Start each sensor reading on its own thread.
     sensor_controller.startup_sensors()
 
-    gps_client = GPSClient((host, port), sensor_controller, time_source, position_source, orientation_source, sync_time_thresh)
+    gps_client = GPSClient(server_addresses, sensor_controller, time_source, position_source, orientation_source, sync_time_thresh,
+                           args.protocol, args.multicast, shared_memory_path=args.shared_memory,
+                           shared_memory_poll_period=float(args.shared_memory_poll) / 1000.0)
 
     # This will keep running until the program is interrupted with Ctrl-C
     try:
@@ -106,6 +127,13 @@ if __name__ == "__main__":
         gps_client.start()
     except KeyboardInterrupt:
         log.info("Keyboard interrupt detected")
+        gps_client.disconnect()
+        report = gps_client.link_stats.report()
+        if report:
+            log.info('Packets from server\n{}'.format(report))
+        report = gps_client.sync_stats.report()
+        if report:
+            log.info('Time sync {}'.format(report))
         log.info("Closing all sensors")
         sensor_controller.close_sensors()
         # TODO terminate all data handlers
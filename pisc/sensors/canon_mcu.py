@@ -11,6 +11,7 @@ Notes:          Due to how the PTP library and MCU are setup the very last captu
 import time
 import serial
 import logging
+import threading
 
 from sensor import Sensor
 
@@ -46,6 +47,9 @@ class CanonMCU(Sensor):
         
         self.max_closing_time = self.trigger_period + 2
         
+        # Commands are sent a byte at a time so don't let the sensor thread and server commands mix them up.
+        self.command_lock = threading.Lock()
+        
     def open(self):
         '''Open serial port.'''
         self.connection = serial.Serial(port=self.port,
@@ -94,9 +98,8 @@ class CanonMCU(Sensor):
             if self.received_close_request:
                 break # end thread
 
-            if self.stop_triggering:
+            if self._disable_if_stopped():
                 # Don't want to take pictures right now.
-                self.disable_periodic_triggering()
                 time.sleep(0.5)
                 continue
             
@@ -111,7 +114,7 @@ class CanonMCU(Sensor):
             if newly_read_data is None or len(newly_read_data) == 0:
                 logging.getLogger().warning('No new data received from camera {}. Is it still plugged in?'.format(self.sensor_name))
                 # Maybe camera didn't get trigger period request.  Try again.
-                self.change_trigger_period(int(self.trigger_period * 1000))
+                self._enable_unless_stopped()
                 continue
             
             logging.getLogger().debug('Camera {} read in {} bytes'.format(self.sensor_name, len(newly_read_data)))
@@ -130,6 +133,11 @@ class CanonMCU(Sensor):
         
     def change_trigger_period(self, new_trigger_period):
         '''Change how often camera is taking pictures.  Should be in milliseconds.  Set to zero to stop taking images.'''
+        with self.command_lock:
+            self._send_trigger_period(new_trigger_period)
+            
+    def _send_trigger_period(self, new_trigger_period):
+        '''Send trigger period (in milliseconds) to MCU until it's acknowledged.  Must hold command lock.'''
         change_successful = False
         while not change_successful:
             #self.send_command('p{}\n'.format(new_trigger_period), 'change trigger period')
@@ -144,6 +152,23 @@ class CanonMCU(Sensor):
         '''Tell MCU to stop triggering camera at specified rate.'''
         self.change_trigger_period(0)
         
+    def _disable_if_stopped(self):
+        '''
+        Tell MCU to stop triggering if camera is stopped and return true if it is.  Stop flag is checked under the
+        command lock so a resume that happens at the same time can't be undone.
+        '''
+        with self.command_lock:
+            if not self.stop_triggering:
+                return False
+            self._send_trigger_period(0)
+            return True
+        
+    def _enable_unless_stopped(self):
+        '''Send current trigger period to MCU unless camera is stopped or closed.  Checked under the command lock like _disable_if_stopped.'''
+        with self.command_lock:
+            if not self.stop_triggering and not self.is_closed():
+                self._send_trigger_period(int(self.trigger_period * 1000))
+        
     def send_command(self, command, command_description, expected_ack = 'none', ack_timeout = 0):
         '''
         Send specified command over connection.  Command description should describe what type of command is being sent. 
@@ -308,4 +333,31 @@ class CanonMCU(Sensor):
         
     def resume(self):
         '''Set flag to resume reading sensor data. Thread safe.'''
-        self.stop_triggering = False
\ No newline at end of file
+        self.stop_triggering = False
+        
+    def do_action(self, action_type, argument=''):
+        '''
+        Stop, resume or retime (argument is new trigger period in seconds) camera.  Trigger period is sent to
+        the MCU right away instead of waiting on the sensor thread so that cameras commanded at the same
+        time trigger together.
+        '''
+        if action_type == 'retime':
+            new_trigger_period = float(argument)
+            if new_trigger_period <= 0:
+                raise ValueError('Trigger period must be positive, not {}.'.format(argument))
+            self.trigger_period = new_trigger_period
+            self.max_closing_time = self.trigger_period + 2
+            self._enable_unless_stopped()
+        elif action_type == 'stop':
+            # Change flag and MCU together under the command lock so the sensor thread can't get in between.
+            with self.command_lock:
+                self.stop()
+                if not self.is_closed():
+                    self._send_trigger_period(0)
+        elif action_type == 'resume':
+            with self.command_lock:
+                self.resume()
+                if not self.is_closed():
+                    self._send_trigger_period(int(self.trigger_period * 1000))
+        else:
+            Sensor.do_action(self, action_type, argument)
\ No newline at end of file
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+import os
+import mmap
+import struct
+import tempfile
+
+from gps_protocol import binary_formats, timed_message_types
+
+# Default file to share memory through.  /dev/shm is kept in RAM on linux so nothing ever goes to disk.
+default_shared_memory_path = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'pisc_gps')
+
+# Start of file so reader can tell it's the right kind of file and layout.
+shared_memory_magic = 'PISCSHM1'
+
+# Magic and number of slots in each stream's history ring.
+shared_memory_header = struct.Struct('<8sI')
+
+# Seqlock sequence at the start of every slot.  Odd while writer is changing the slot.
+slot_sequence = struct.Struct('<Q')
+
+def _slot_struct(message_type):
+    '''Return Struct of slot contents after the sequence: message count then fields (same as binary packets but with system time).'''
+    return struct.Struct('<Q' + binary_formats[message_type][1])
+
+class _StreamLayout(object):
+    '''Where one message type's latest value slot and history ring are in the shared memory.'''
+    def __init__(self, message_type, offset, history_size):
+        '''Constructor. Stream starts at offset bytes into shared memory.'''
+        self.message_type = message_type
+        self.contents = _slot_struct(message_type)
+        self.slot_size = slot_sequence.size + self.contents.size
+        self.history_size = history_size
+        self.latest_offset = offset
+        self.history_offset = offset + self.slot_size
+        self.end_offset = self.history_offset + self.slot_size * history_size
+
+    def history_slot_offset(self, count):
+        '''Return offset of slot in history ring that message number count goes in.'''
+        return self.history_offset + self.slot_size * (count % self.history_size)
+
+def _layout(history_size):
+    '''Return (list of _StreamLayout for each timed message type, total size in bytes).'''
+    streams = []
+    offset = shared_memory_header.size
+    for message_type in timed_message_types:
+        stream = _StreamLayout(message_type, offset, history_size)
+        streams.append(stream)
+        offset = stream.end_offset
+    return streams, offset
+
+class SharedMemoryWriter(object):
+    '''
+    Puts timed messages (time/position/orientation) in a memory mapped file so any number of clients on the same
+    computer can read them without a socket.  Each message type has a latest value slot plus a history ring of the
+    last few messages.  Every slot is protected by a seqlock: the writer makes the slot's sequence odd, changes the
+    slot and then makes it even again, so a reader that sees the same even sequence before and after reading knows
+    it didn't get half of one message and half of another.  Only one thread can write.
+    '''
+    def __init__(self, path=default_shared_memory_path, history_size=16):
+        '''Constructor.  Replaces any file already at path.  History size is how many messages of each type to keep.'''
+        self.path = path
+        self.streams, size = _layout(history_size)
+
+        # {message type: number of messages written}
+        self.counts = dict((message_type, 0) for message_type in timed_message_types)
+
+        # Start with a new file instead of changing an old one, since readers that still have the old one mapped would
+        # crash if it shrank.  They just stop seeing new messages and open the new one when they reconnect.
+        if os.path.exists(path):
+            os.remove(path)
+        with open(path, 'w+b') as shared_file:
+            shared_file.write('\0' * size)
+            shared_file.flush()
+            self.memory = mmap.mmap(shared_file.fileno(), size)
+        shared_memory_header.pack_into(self.memory, 0, shared_memory_magic, history_size)
+
+        self.stream_by_type = dict((stream.message_type, stream) for stream in self.streams)
+
+    def write(self, fields):
+        '''Store timed message fields (type first, then UTC time and the system time it was read in, see GPSServer).'''
+        message_type = fields[0]
+        stream = self.stream_by_type[message_type]
+        count = self.counts[message_type] + 1
+        self.counts[message_type] = count
+        # Strings (i.e. zone) can't be None in a struct.
+        values = ['' if field is None else field for field in fields[1:]]
+        contents = stream.contents.pack(count, *values)
+        self._write_slot(stream.history_slot_offset(count), contents)
+        self._write_slot(stream.latest_offset, contents)
+
+    def _write_slot(self, offset, contents):
+        '''Copy packed contents into slot at offset, marking the slot as changing while it's copied.'''
+        sequence = slot_sequence.unpack_from(self.memory, offset)[0]
+        slot_sequence.pack_into(self.memory, offset, sequence + 1)
+        start = offset + slot_sequence.size
+        self.memory[start:start + len(contents)] = contents
+        slot_sequence.pack_into(self.memory, offset, sequence + 2)
+
+    def remove(self):
+        '''
+        Remove file so clients that start later don't read stale data.  Memory stays mapped until the process exits,
+        so it's still safe to write to.
+        '''
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass # already gone
+
+class SharedMemoryReader(object):
+    '''
+    Reads timed messages that a SharedMemoryWriter in another process puts in shared memory.  Reads come straight
+    out of the mapped memory, so checking for new messages doesn't make any system calls.  Not thread-safe.
+    '''
+    # How many times to try reading a slot that keeps changing before giving up on it for now.
+    max_read_attempts = 100
+
+    def __init__(self, path=default_shared_memory_path):
+        '''Constructor.  Raises EnvironmentError if file can't be opened, or ValueError if it's not shared memory.'''
+        with open(path, 'rb') as shared_file:
+            size = os.fstat(shared_file.fileno()).st_size
+            if size < shared_memory_header.size:
+                raise ValueError('{} is not shared memory from a GPS server.'.format(path))
+            self.memory = mmap.mmap(shared_file.fileno(), size, access=mmap.ACCESS_READ)
+
+        magic, history_size = shared_memory_header.unpack_from(self.memory, 0)
+        self.streams, expected_size = _layout(history_size)
+        if magic != shared_memory_magic or size != expected_size:
+            self.memory.close()
+            raise ValueError('{} is not shared memory from a GPS server.'.format(path))
+
+        self.path = path
+
+        # {message type: count of last message returned}.  Missing until first message of that type is read.
+        self.last_counts = {}
+
+    def latest(self, message_type):
+        '''Return (count, fields) of newest message of type, or None if there isn't one yet.'''
+        stream = self._stream(message_type)
+        contents = self._read_slot(stream.latest_offset, stream)
+        if contents is None or contents[0] == 0:
+            return None
+        return contents[0], self._fields(message_type, contents)
+
+    def read_new(self):
+        '''
+        Return list of (count, fields) for messages written since last time, oldest first for each message type.
+        Fields are the same as what the writer was given (type, UTC time, system time it was read in, ...), and count
+        is which message of that type it was (starting at 1) so skipped ones can be found.  The first call only
+        returns the latest of each type.  Messages that have already been written over in the history ring are skipped.
+        '''
+        messages = []
+        for stream in self.streams:
+            newest = self.latest(stream.message_type)
+            if newest is None:
+                continue
+            newest_count = newest[0]
+            last_count = self.last_counts.get(stream.message_type)
+            if last_count is None or newest_count <= last_count:
+                if newest_count != last_count:
+                    messages.append(newest)
+                self.last_counts[stream.message_type] = newest_count
+                continue
+            for count in range(max(last_count + 1, newest_count - stream.history_size + 1), newest_count + 1):
+                contents = self._read_slot(stream.history_slot_offset(count), stream)
+                if contents is not None and contents[0] == count:
+                    messages.append((count, self._fields(stream.message_type, contents)))
+            self.last_counts[stream.message_type] = newest_count
+        return messages
+
+    def close(self):
+        '''Unmap shared memory.'''
+        self.memory.close()
+
+    def _stream(self, message_type):
+        '''Return _StreamLayout for message type.'''
+        return self.streams[timed_message_types.index(message_type)]
+
+    def _read_slot(self, offset, stream):
+        '''Return contents (count then fields) of slot at offset, or None if writer kept changing it.'''
+        for _ in range(self.max_read_attempts):
+            sequence = slot_sequence.unpack_from(self.memory, offset)[0]
+            if sequence % 2 == 1:
+                continue # writer is in the middle of changing it
+            contents = stream.contents.unpack_from(self.memory, offset + slot_sequence.size)
+            if slot_sequence.unpack_from(self.memory, offset)[0] == sequence:
+                return contents
+        return None
+
+    def _fields(self, message_type, contents):
+        '''Return message fields from slot contents.'''
+        fields = [message_type] + list(contents[1:])
+        if message_type in ('p', 'f'):
+            # Same as binary packets.
+            fields[6] = fields[6].rstrip('\0') or 'None'
+        return fields
@@ -2,7 +2,9 @@
 
 import threading
 import time
+import math
 import logging
+from collections import deque
 
 class SimpleTimeSource(object):
     '''
@@ -20,8 +22,8 @@ class SimpleTimeSource(object):
             current_time = self._time
         return current_time
 
-    def set_time(self, new_time, time_ref):
-        '''Set new time. Thread-safe.'''
+    def set_time(self, new_time, time_ref, error=None):
+        '''Set new time. Error isn't used. Thread-safe.'''
         with self.lock:
             self._time = new_time + (time.time() - time_ref)
         
@@ -53,10 +55,10 @@ class PreciseTimeSource(object):
 
         return current_time
             
-    def set_time(self, new_time, ref_time):
+    def set_time(self, new_time, ref_time, error=None):
         '''Set new time if it's later than the last set time. Allows a reference time (ref_time) which 
            comes from calling time.time() to be specified which then the elapsed time since 
-           ref_time is taken into account once the lock is acquired.  Thread-safe.'''
+           ref_time is taken into account once the lock is acquired.  Error isn't used.  Thread-safe.'''
         with self.lock:
             if new_time > self._time:
                 self.last_set_time = time.time()
@@ -71,15 +73,206 @@ class RelativePreciseTimeSource(PreciseTimeSource):
         '''Return parent's time property'''
         return super(RelativePreciseTimeSource, self).time
 
-    def set_time(self, new_time, ref_time):
+    def set_time(self, new_time, ref_time, error=None):
         '''Set new time only if hasn't been set yet. Allows a reference time (ref_time) which 
            comes from calling time.time() to be specified which then the elapsed time since 
-           ref_time is taken into account once the lock is acquired.  Thread-safe.'''
+           ref_time is taken into account once the lock is acquired.  Error isn't used.  Thread-safe.'''
         if self._time == self._default_time:
             with self.lock:
                 self.last_set_time = time.time()
                 self._time = new_time + (time.time() - ref_time)
 
+class DisciplinedTimeSource(object):
+    '''
+    Keeps time by fitting the offset and rate of the system clock against reported times over a sliding window,
+    so it doesn't drift with the system clock over a long run.  Only the best reported time out of each sample
+    period is kept, and each one is weighted by its error.  Reported times without an error (e.g. from data packets)
+    are off by however long the packet took to get here, so they're only used until the first one with an error
+    (e.g. from a time sync) comes in.  Small corrections are slewed in gradually instead of making the time jump, and the time never goes backwards.
+    '''
+    # Error assumed for reported times that don't come with one (e.g. UTC time + delay from a position message)
+    # until there's a synced time.
+    default_error = 0.002 # seconds
+    
+    # How far off the system clock rate is assumed to be until there's enough data to fit it.
+    unfit_rate_error = 0.00005 # seconds per second
+    
+    def __init__(self, default_time=0, window_duration=600.0, sample_period=1.0, min_rate_span=30.0,
+                 max_slew_rate=0.0005, step_threshold=0.128, max_rate=0.0005):
+        '''
+        Constructor.  Default time is returned until the first time is set.  Reported times from the last window
+        duration seconds are fit, keeping the best one every sample period seconds.  Rate isn't fit until the
+        samples span min rate span seconds, and is limited to max rate.  Corrections are slewed in at max slew rate
+        (seconds per second) unless they're bigger than step threshold seconds.
+        '''
+        self._default_time = default_time
+        self.window_duration = window_duration
+        self.sample_period = sample_period
+        self.min_rate_span = min_rate_span
+        self.max_slew_rate = max_slew_rate
+        self.step_threshold = step_threshold
+        self.max_rate = max_rate
+        self.lock = threading.Lock()
+        
+        # (system time, offset, error) where offset is reported time minus system time. One per sample period, oldest first.
+        self.samples = deque()
+        
+        # Best (system time, offset, error) in the current sample period and when that period started.
+        self.pending_sample = None
+        self.pending_start_time = None
+        
+        # (center system time, offset at center, rate, offset error, rate error), or None if time was never set.
+        self.fit = None
+        
+        # Correction (in seconds) still being slewed in as of slew time.
+        self.slew = 0.0
+        self.slew_time = 0.0
+        
+        # Last time returned.  Used to make sure time never goes backwards.
+        self.last_time = default_time
+        
+        # True once a reported time with an error was set.  Times without one are ignored after that.
+        self.synced = False
+        
+    @property
+    def time(self):
+        '''Return current time from fit.  Thread-safe.'''
+        with self.lock:
+            if self.fit is None:
+                return self._default_time
+            sys_time = time.time()
+            current_time = self._fit_time(sys_time) + self._slew_correction(sys_time)
+            if current_time < self.last_time:
+                current_time = self.last_time # hold until fit catches up
+            self.last_time = current_time
+            return current_time
+        
+    @property
+    def error(self):
+        '''Return estimate of how far off (in seconds) the current time could be, or infinity if never set.  Thread-safe.'''
+        with self.lock:
+            if self.fit is None:
+                return float('inf')
+            sys_time = time.time()
+            center_time, _, _, offset_error, rate_error = self.fit
+            return offset_error + rate_error * abs(sys_time - center_time) + abs(self._slew_correction(sys_time))
+        
+    @property
+    def rate(self):
+        '''Return how much faster (in seconds per second) the reported time runs than the system clock.  Thread-safe.'''
+        with self.lock:
+            return self.fit[2] if self.fit is not None else 0.0
+        
+    def set_time(self, new_time, ref_time, error=None):
+        '''
+        Add reported time (new time) that was true at system time ref time (from time.time()).  Error (in seconds)
+        is how far off it could be, or None to use the default error.  Once any time is set with an error then ones
+        without are ignored since their latency isn't known.  Thread-safe.
+        '''
+        synced = error is not None
+        if error is None:
+            error = self.default_error
+        sample = (ref_time, new_time - ref_time, max(error, 1e-6))
+        
+        with self.lock:
+            if self.synced and not synced:
+                return
+            
+            if synced and not self.synced:
+                # Start window over with just synced times.
+                self.synced = True
+                self.samples.clear()
+                self.pending_sample = None
+                self._add_sample(sample)
+                return
+            
+            if self.pending_sample is not None and ref_time - self.pending_start_time < self.sample_period:
+                if self._better_sample(sample, self.pending_sample):
+                    self.pending_sample = sample
+                return
+            
+            if self.pending_sample is not None:
+                self._add_sample(self.pending_sample)
+            
+            self.pending_sample = sample
+            self.pending_start_time = ref_time
+            
+            if self.fit is None:
+                # Don't make first time wait a whole sample period.
+                self._add_sample(sample)
+                self.pending_sample = None
+            
+    def _better_sample(self, sample, other_sample):
+        '''
+        Return true if sample should be kept over other sample.  Lower error is better.  If errors are the same
+        then the one with the larger offset is better since anything that delays a reported time makes it smaller.
+        '''
+        if sample[2] != other_sample[2]:
+            return sample[2] < other_sample[2]
+        return sample[1] > other_sample[1]
+            
+    def _add_sample(self, sample):
+        '''Add sample to window, drop ones that are too old and then refit.  Must hold lock.'''
+        self.samples.append(sample)
+        while self.samples[-1][0] - self.samples[0][0] > self.window_duration:
+            self.samples.popleft()
+        
+        sys_time = time.time()
+        old_time = None
+        if self.fit is not None:
+            old_time = self._fit_time(sys_time) + self._slew_correction(sys_time)
+            
+        self.fit = self._fit_samples()
+        
+        # Slew out the difference between old and new fit unless it's too big to wait on.
+        correction = 0.0
+        if old_time is not None:
+            correction = old_time - self._fit_time(sys_time)
+            if abs(correction) > self.step_threshold:
+                logging.getLogger().warning('Time stepped by {} seconds.'.format(-correction))
+                correction = 0.0
+        self.slew = correction
+        self.slew_time = sys_time
+            
+    def _fit_samples(self):
+        '''Return (center time, offset, rate, offset error, rate error) from weighted least squares fit of samples.'''
+        # Work relative to newest sample so system times don't lose precision when squared.
+        base_time = self.samples[-1][0]
+        points = [(sys_time - base_time, offset, 1.0 / (error * error)) for sys_time, offset, error in self.samples]
+        
+        total_weight = sum(w for _, _, w in points)
+        center_x = sum(w * x for x, _, w in points) / total_weight
+        center_offset = sum(w * y for _, y, w in points) / total_weight
+        sxx = sum(w * (x - center_x) ** 2 for x, _, w in points)
+        sxy = sum(w * (x - center_x) * (y - center_offset) for x, y, w in points)
+        
+        fit_rate = len(points) > 2 and sxx > 0 and self.samples[-1][0] - self.samples[0][0] >= self.min_rate_span
+        rate = max(-self.max_rate, min(sxy / sxx, self.max_rate)) if fit_rate else 0.0
+        
+        # Scale errors up if samples are spread out more than their errors say they should be.
+        degrees_of_freedom = len(points) - (2 if fit_rate else 1)
+        scale = 1.0
+        if degrees_of_freedom > 0:
+            residuals = sum(w * (y - center_offset - rate * (x - center_x)) ** 2 for x, y, w in points)
+            scale = max(residuals / degrees_of_freedom, 1.0)
+        
+        offset_error = math.sqrt(scale / total_weight)
+        rate_error = math.sqrt(scale / sxx) if fit_rate else self.unfit_rate_error
+        
+        return (base_time + center_x, center_offset, rate, offset_error, rate_error)
+    
+    def _fit_time(self, sys_time):
+        '''Return reported time at system time according to fit.  Must hold lock.'''
+        center_time, center_offset, rate = self.fit[:3]
+        return sys_time + center_offset + rate * (sys_time - center_time)
+    
+    def _slew_correction(self, sys_time):
+        '''Return part of correction that hasn't been slewed in yet at system time.  Must hold lock.'''
+        slewed = self.max_slew_rate * max(sys_time - self.slew_time, 0)
+        if abs(self.slew) <= slewed:
+            return 0.0
+        return self.slew - math.copysign(slewed, self.slew)
+
 class SimplePositionSource(object):
     '''
     Wrapper for a position tuple (time, (x,y,z), zone) that allows sensors/handlers thread-safe access to most recent position.
@@ -87,6 +280,8 @@ class SimplePositionSource(object):
     def __init__(self, default_position = (0, (0, 0, 0), 'None')):
         '''Constructor'''
         self._position = default_position
+        # Fix quality, precision and velocity that goes with the position, or None if the server doesn't send it.
+        self._fix = None
         # Using a lock to be safe even though simple access/assignment should be atomic.
         self.lock = threading.Lock()
         # Use an event to notify any interested threads when a new position arrives.
@@ -115,6 +310,19 @@ class SimplePositionSource(object):
             self.event.clear()
             self.event.set()
 
+    @property
+    def fix(self):
+        '''Return dictionary of fix_type, hdop, num_satellites, x_error, y_error, speed and course (plus utc_time). Thread-safe.'''
+        with self.lock:
+            current_fix = self._fix
+        return current_fix
+
+    @fix.setter
+    def fix(self, new_fix):
+        '''Set new fix. Should be set before the position it goes with. Thread-safe.'''
+        with self.lock:
+            self._fix = new_fix
+
 class SimpleOrientationSource(object):
     '''
     Wrapper for a orientation tuple (time, (roll, pitch, yaw)) that allows sensors/handlers thread-safe access to most recent orientation.
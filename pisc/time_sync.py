@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+import time
+from collections import namedtuple, deque
+
+"""One round trip between client and server.  Offset is what to add to client system time to get server UTC time,
+delay is the time spent on the network, and sys time is when the reply was received."""
+TimeSyncSample = namedtuple('TimeSyncSample', 'offset delay sys_time')
+
+class TimeSync(object):
+    '''
+    Estimates the offset between the server's UTC time and this computer's system time the same way NTP does.
+    Each round trip has four timestamps:
+      T1 - client system time request is sent
+      T2 - server UTC time request is received
+      T3 - server UTC time reply is sent
+      T4 - client system time reply is received
+    which give offset = ((T2 - T1) + (T3 - T4)) / 2 and delay = (T4 - T1) - (T3 - T2).  The offset can be off by at most
+    half the delay, so out of the last few round trips the one with the smallest delay is trusted.  A slow round trip
+    just doesn't get picked instead of spoiling the rest.  Not thread-safe.
+    '''
+    def __init__(self, max_error=0.015, window_size=8, min_samples=4, request_timeout=2.0, stats=None):
+        '''
+        Constructor.  Max error (in seconds) is how far off the best offset can be before it's good enough to use.
+        Window size is how many of the latest round trips to pick the best one out of, and min samples is how
+        many it takes before trusting any of them.  Requests that aren't answered within request timeout
+        seconds are forgotten.  If stats (SyncStats) is set then round trips and forgotten requests are counted there.
+        '''
+        self.max_error = max_error
+        self.min_samples = min_samples
+        self.request_timeout = request_timeout
+        self.stats = stats
+
+        # Latest TimeSyncSamples, oldest first.
+        self.samples = deque(maxlen=max(window_size, 1))
+
+        # {sync id: client system time request was sent (T1)} for requests that haven't been answered.
+        self.pending_requests = {}
+
+        # Next id to use for sync request. Used to match up replies with requests.
+        self.next_sync_id = 0
+
+    def new_request(self, send_time=None):
+        '''Return id to send in a new sync request and remember when it was sent (default now).'''
+        if send_time is None:
+            send_time = time.time()
+
+        # Forget about requests that were lost.
+        for sync_id, request_time in self.pending_requests.items():
+            if send_time - request_time > self.request_timeout:
+                del self.pending_requests[sync_id]
+                if self.stats is not None:
+                    self.stats.expired_requests += 1
+
+        sync_id = self.next_sync_id
+        self.next_sync_id += 1
+        self.pending_requests[sync_id] = send_time
+        return sync_id
+
+    def add_reply(self, sync_id, server_receive_time, server_send_time, receive_time=None):
+        '''
+        Add round trip from server's reply to request with sync id.  Server times are T2 and T3 and receive time
+        is T4 (default now).  Return new TimeSyncSample or None if reply doesn't match a pending request.
+        '''
+        send_time = self.pending_requests.pop(sync_id, None)
+        if send_time is None:
+            return None # duplicate or too late
+        if receive_time is None:
+            receive_time = time.time()
+
+        offset = ((server_receive_time - send_time) + (server_send_time - receive_time)) / 2.0
+        delay = (receive_time - send_time) - (server_send_time - server_receive_time)
+        if delay < 0:
+            return None # system clock must have changed
+
+        sample = TimeSyncSample(offset, delay, receive_time)
+        self.samples.append(sample)
+        if self.stats is not None:
+            self.stats.add_rtt(delay)
+        return sample
+
+    def best_sample(self):
+        '''Return sample with smallest delay, or None if there aren't any yet.'''
+        if not self.samples:
+            return None
+        return min(self.samples, key=lambda sample: sample.delay)
+
+    def error(self):
+        '''Return most the best offset could be off by in seconds, or infinity if there aren't any samples.'''
+        best_sample = self.best_sample()
+        if best_sample is None:
+            return float('inf')
+        return best_sample.delay / 2.0
+
+    def synced(self):
+        '''Return true if there are enough samples and the best one is within max error.'''
+        return len(self.samples) >= self.min_samples and self.error() <= self.max_error
+
+    def utc_time(self, sys_time=None):
+        '''Return server UTC time at system time (default now) using best offset.  Only valid once synced.'''
+        if sys_time is None:
+            sys_time = time.time()
+        return sys_time + self.best_sample().offset
+
+class SyncStats(object):
+    '''
+    Keeps track of how time syncs with the server are going: how many rounds were good enough or not, how long
+    round trips take, how many requests were never answered and how long it took to sync.  Updated from one thread
+    but can be read from any.
+    '''
+    # Upper edge (in seconds) of each round trip time histogram bin.  There's one more bin for anything slower.
+    rtt_bins = [0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5]
+
+    def __init__(self):
+        '''Constructor.'''
+        self.accepted_rounds = 0
+        self.rejected_rounds = 0
+        self.expired_requests = 0
+        self.rtt_count = 0
+        self.rtt_sum = 0.0
+        self.rtt_max = 0.0
+        self.rtt_histogram = [0] * (len(self.rtt_bins) + 1)
+
+        # System time current sync started, or None if not syncing.
+        self.start_time = None
+
+        # Seconds it took to sync the last time it finished, or None if it never has.
+        self.convergence_time = None
+
+    def started(self, sys_time=None):
+        '''Note that syncing started at system time (default now) unless it already had.'''
+        if self.start_time is None:
+            self.start_time = time.time() if sys_time is None else sys_time
+
+    def add_rtt(self, rtt):
+        '''Add round trip time (in seconds) of one sync message.'''
+        self.rtt_count += 1
+        self.rtt_sum += rtt
+        self.rtt_max = max(self.rtt_max, rtt)
+        for i, upper_edge in enumerate(self.rtt_bins):
+            if rtt <= upper_edge:
+                self.rtt_histogram[i] += 1
+                return
+        self.rtt_histogram[-1] += 1
+
+    def round_finished(self, accepted, sys_time=None):
+        '''Count sync round that was or wasn't good enough.  Accepted round finishes sync at system time (default now).'''
+        if not accepted:
+            self.rejected_rounds += 1
+            return
+        self.accepted_rounds += 1
+        if self.start_time is not None:
+            self.convergence_time = (time.time() if sys_time is None else sys_time) - self.start_time
+            self.start_time = None
+
+    def summary(self):
+        '''
+        Return dictionary of accepted_rounds, rejected_rounds, expired_requests, mean/max round trip time (None
+        if there aren't any), rtt_histogram with a count for each bin in rtt_bins plus one for anything slower,
+        and convergence_time.
+        '''
+        return {'accepted_rounds': self.accepted_rounds,
+                'rejected_rounds': self.rejected_rounds,
+                'expired_requests': self.expired_requests,
+                'mean_rtt': self.rtt_sum / self.rtt_count if self.rtt_count > 0 else None,
+                'max_rtt': self.rtt_max if self.rtt_count > 0 else None,
+                'rtt_histogram': list(self.rtt_histogram),
+                'convergence_time': self.convergence_time}
+
+    def report(self):
+        '''Return summary as a line of text for logging, or empty string if there haven't been any syncs.'''
+        stats = self.summary()
+        if stats['mean_rtt'] is None:
+            return ''
+        line = 'rounds accepted {} rejected {} expired requests {} rtt mean {:.2f} max {:.2f} ms'.format(
+                    stats['accepted_rounds'], stats['rejected_rounds'], stats['expired_requests'],
+                    stats['mean_rtt'] * 1000, stats['max_rtt'] * 1000)
+        if stats['convergence_time'] is not None:
+            line += ' synced in {:.2f} s'.format(stats['convergence_time'])
+        return line
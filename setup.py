@@ -19,4 +19,8 @@ if __name__ == "__main__":
           install_requires=[
               'pyserial',
           ],
+          extras_require={
+              # Only needed for batch parsing NMEA logs.
+              'batch': ['numpy'],
+          },
           zip_safe=False)
\ No newline at end of file
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import math
+import calendar
+import unittest
+
+# Modules in pisc import each other directly so need to be on the path.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pisc'))
+
+from checksum_utils import nmea_checksum
+from gps_ingest import Feedback, ReceiverGate, NMEASource, SentenceProcessor, EpochCoalescer
+
+def make_sentence(data):
+    '''Return NMEA sentence with checksum added to data (which doesn't include the $ or *).'''
+    return '${}*{:02X}'.format(data, nmea_checksum(data))
+
+def gga(utc_time):
+    '''Return GGA sentence at UTC time (hhmmss.ss).'''
+    return make_sentence('GPGGA,{},3911.6402181,N,09634.4651967,W,4,11,1.0,318.958,M,-28.308,M,11.0,1015'.format(utc_time))
+
+def gst(utc_time, error=0.05):
+    '''Return GST sentence at UTC time (hhmmss.ss) with latitude/longitude error in meters.'''
+    return make_sentence('GPGST,{},0.092,0.044,0.027,295.507,{},{},0.076'.format(utc_time, error, error))
+
+def rmc(utc_time, date):
+    '''Return RMC sentence at UTC time (hhmmss.ss) on date (ddmmyy).'''
+    return make_sentence('GPRMC,{},A,3911.6402181,N,09634.4651967,W,0.5,45.0,{},,'.format(utc_time, date))
+
+def nmea_time(seconds):
+    '''Return seconds past 12:00:00 as hhmmss.ss.'''
+    return '12{:02d}{:05.2f}'.format(int(seconds // 60), seconds % 60)
+
+class RecordingPublisher(object):
+    '''Stands in for GPSServer and keeps every fix that's published.'''
+    def __init__(self):
+        '''Constructor.'''
+        self.fixes = []
+
+    def new_fix(self, utc_time, sys_time, x, y, z, zone, fix_type, hdop, num_satellites, x_error, y_error, speed, course):
+        '''Save fix.'''
+        self.fixes.append((utc_time, x_error, y_error))
+
+    def new_orientation(self, utc_time, sys_time, roll, pitch, yaw):
+        '''Ignore orientation.'''
+        pass
+
+class TestEpochCoalescer(unittest.TestCase):
+
+    def test_newer_epoch_finishes_current(self):
+        epochs = EpochCoalescer()
+        self.assertEqual(epochs.add('GGA', {'utc_time': 10.0}, 0.0), [])
+        finished = epochs.add('GGA', {'utc_time': 10.1}, 0.0)
+        self.assertEqual([(utc_time, sorted(data)) for utc_time, _, data in finished], [(10.0, ['GGA'])])
+
+    def test_finishes_once_every_type_arrives(self):
+        epochs = EpochCoalescer()
+        epochs.add('GGA', {'utc_time': 10.0}, 0.0)
+        epochs.add('RMC', {'utc_time': 10.0}, 0.0)
+        finished = epochs.add('GST', {'utc_time': 10.0}, 0.0)
+        self.assertEqual([sorted(data) for _, _, data in finished], [['GGA', 'GST', 'RMC']])
+
+    def test_slow_sentence_after_gga_joins_its_epoch(self):
+        # Previous epochs only had GGA, but this one should still wait on the GST that comes after its GGA.
+        epochs = EpochCoalescer()
+        epochs.add('GGA', {'utc_time': 10.0}, 0.0)
+        epochs.add('GGA', {'utc_time': 10.1}, 0.0)
+        epochs.add('GST', {'utc_time': 10.1}, 0.0)
+        finished = epochs.add('GGA', {'utc_time': 10.2}, 0.0)
+        self.assertEqual([sorted(data) for _, _, data in finished], [['GGA', 'GST']])
+
+    def test_expires_after_timeout(self):
+        epochs = EpochCoalescer()
+        epochs.add('GGA', {'utc_time': 10.0}, 5.0)
+        self.assertEqual(epochs.expire(5.0 + EpochCoalescer.epoch_timeout / 2), [])
+        self.assertEqual(len(epochs.expire(5.0 + EpochCoalescer.epoch_timeout * 2)), 1)
+        self.assertEqual(epochs.flush(), [])
+
+    def test_late_sentence_dropped(self):
+        epochs = EpochCoalescer()
+        epochs.add('GGA', {'utc_time': 10.0}, 0.0)
+        epochs.add('GGA', {'utc_time': 10.1}, 0.0)
+        self.assertEqual(epochs.add('GST', {'utc_time': 10.0}, 0.0), [])
+        self.assertEqual([sorted(data) for _, _, data in epochs.flush()], [['GGA']])
+
+    def test_big_jump_back_starts_new_stream(self):
+        epochs = EpochCoalescer()
+        for i in range(10):
+            epochs.add('GGA', {'utc_time': 10.0 + i * 0.1}, 0.0)
+        finished = epochs.add('GGA', {'utc_time': 5.0}, 0.0)
+        self.assertAlmostEqual(finished[0][0], 10.9)
+        self.assertEqual([utc_time for utc_time, _, _ in epochs.flush()], [5.0])
+
+class TestSentenceProcessor(unittest.TestCase):
+
+    def setUp(self):
+        feedback = Feedback()
+        self.publisher = RecordingPublisher()
+        self.source = NMEASource('test', ReceiverGate('test', feedback, required_precision=0.1))
+        self.processor = SentenceProcessor(None, self.publisher, feedback)
+
+    def play(self, sentences):
+        '''Process every sentence then flush out the last epoch.'''
+        for sentence in sentences:
+            self.processor.process(self.source, sentence, 0.0)
+        self.processor.flush()
+
+    def test_gga_10hz_gst_1hz(self):
+        sentences = []
+        for i in range(30):
+            seconds = i * 0.1
+            sentences.append(gga(nmea_time(seconds)))
+            if i % 10 == 0:
+                sentences.append(gst(nmea_time(seconds)))
+        self.play(sentences)
+
+        self.assertEqual(len(self.publisher.fixes), 30)
+        for _, x_error, y_error in self.publisher.fixes:
+            self.assertEqual((x_error, y_error), (0.05, 0.05))
+
+    def test_gst_before_gga(self):
+        sentences = []
+        for i in range(30):
+            seconds = i * 0.1
+            if i % 10 == 0:
+                sentences.append(gst(nmea_time(seconds)))
+            sentences.append(gga(nmea_time(seconds)))
+        self.play(sentences)
+
+        self.assertEqual(len(self.publisher.fixes), 30)
+
+    def test_old_gst_not_used(self):
+        sentences = [gst(nmea_time(0)), gga(nmea_time(0))]
+        sentences += [gga(nmea_time(0.1 * i)) for i in range(1, 40)]
+        self.play(sentences)
+
+        max_age = ReceiverGate.max_gst_age
+        self.assertTrue(self.publisher.fixes)
+        self.assertTrue(all(utc_time - self.publisher.fixes[0][0] <= max_age + 1e-6 for utc_time, _, _ in self.publisher.fixes))
+        self.assertTrue(len(self.publisher.fixes) < 40)
+
+    def test_sources_keep_their_own_date(self):
+        other_source = NMEASource('other', ReceiverGate('other', Feedback()))
+        self.processor.process(self.source, rmc('120000.00', '010115'), 0.0)
+        self.processor.process(other_source, rmc('120000.00', '020216'), 0.0)
+        self.assertEqual(self.source.utc_date.date, (2015, 1, 1))
+        self.assertEqual(other_source.utc_date.date, (2016, 2, 2))
+
+        self.source.gate.required_precision = -1
+        self.play([gga('120001.00')])
+        self.assertEqual(self.publisher.fixes[0][0], calendar.timegm((2015, 1, 1, 12, 0, 1)))
+
+    def test_large_gst_error_rejected(self):
+        self.play([gga(nmea_time(0)), gst(nmea_time(0), error=0.5)])
+        self.assertEqual(self.publisher.fixes, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import unittest
+
+# Modules in pisc import each other directly so need to be on the path.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pisc'))
+
+from gps_protocol import csv_protocol, binary_protocol, supported_protocols, ntp_option, sequence_option
+from gps_protocol import encode, decode, split_encode, encode_time_delay, append_sequence, decode_sequenced
+from gps_protocol import command_fields, connect_request, choose_protocol, connect_ack, parse_connect_ack, sequence_modulus
+
+# Message fields (packet type first) that should come back the same after encoding and decoding.
+messages = [['t', 1234.5, 0.25],
+            ['p', 1234.5, 0.25, 1.5, -2.5, 300.25, '14S'],
+            ['p', 1234.5, 0.25, 1.5, -2.5, 300.25, 'None'],
+            ['o', 1234.5, 0.25, 0.0, 0.125, -3.0],
+            ['f', 1234.5, 0.25, 1.5, -2.5, 300.25, '14S', 4, 1.0, 11, 0.03, 0.04, 2.5, 1.25],
+            ['ts2', 7, 1444444444.123456, 1444444444.123789],
+            ['sync1', 3, 1234.5],
+            ['ct', 'canon_mcu', 'stop', 1444444444.123456],
+            ['cn', 'camera1', 'resume']]
+
+class TestGPSProtocol(unittest.TestCase):
+
+    def test_round_trip(self):
+        for protocol in supported_protocols:
+            for fields in messages:
+                self.assertEqual(decode(encode(fields, protocol)), (fields[0], fields[1:]), '{} {}'.format(protocol, fields))
+
+    def test_split_encode_matches_encode(self):
+        for protocol in supported_protocols:
+            fields = messages[1]
+            head, tail = split_encode(fields, protocol)
+            self.assertEqual(head + encode_time_delay(fields[2], protocol) + tail, encode(fields, protocol))
+
+    def test_sequenced_round_trip(self):
+        for protocol in supported_protocols:
+            for fields in messages:
+                packet = encode(fields, protocol)
+                sequenced = fields[0] in ('t', 'p', 'o', 'f', 'ct', 'cn', 'ci')
+                if sequenced:
+                    packet = append_sequence(packet, 5, protocol)
+                self.assertEqual(decode_sequenced(packet), (fields[0], fields[1:], 5 if sequenced else None))
+
+    def test_binary_sequence_wraps_around(self):
+        packet = append_sequence(encode(messages[0], binary_protocol), sequence_modulus + 5, binary_protocol)
+        self.assertEqual(decode_sequenced(packet)[2], 5)
+
+    def test_invalid_packets(self):
+        for data in ['', ' , ', '\xb1', '\xb1\xff', '\xb1\x02abc']:
+            self.assertRaises(ValueError, decode, data)
+
+    def test_command_fields(self):
+        self.assertEqual(command_fields('ci', '3', 'stop'), ['ci', '3', 'stop'])
+        self.assertEqual(command_fields('ci', '3', 'stop', 5), ['ci', '3', 'stop', 5.0])
+
+    def test_connect_request(self):
+        self.assertEqual(connect_request('sync', csv_protocol), 'sync')
+        self.assertEqual(choose_protocol(connect_request('sync', csv_protocol)), ('sync', csv_protocol))
+        request = connect_request('add', binary_protocol, [ntp_option])
+        self.assertEqual(choose_protocol(request), ('add', binary_protocol))
+
+    def test_connect_ack(self):
+        self.assertEqual(parse_connect_ack(connect_ack(csv_protocol)), (csv_protocol, None, []))
+        ack = connect_ack(binary_protocol, ('239.255.50.5', 50006), [ntp_option, sequence_option])
+        self.assertEqual(parse_connect_ack(ack), (binary_protocol, ('239.255.50.5', 50006), [ntp_option, sequence_option]))
+        self.assertEqual(parse_connect_ack('t,1,2'), None)
+
+if __name__ == '__main__':
+    unittest.main()
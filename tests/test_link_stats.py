@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import unittest
+
+# Modules in pisc import each other directly so need to be on the path.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pisc'))
+
+from link_stats import LinkStats
+from gps_protocol import sequence_modulus
+
+class TestLinkStats(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = LinkStats(restart_run=3)
+
+    def test_in_order(self):
+        for i in range(5):
+            self.assertTrue(self.stats.accept('t', i, 1000.0 + i))
+        self.assertEqual(self.stats.summary()['t']['received'], 5)
+
+    def test_lost_duplicate_reordered(self):
+        self.assertTrue(self.stats.accept('t', 0, 1000.0))
+        self.assertTrue(self.stats.accept('t', 3, 1003.0))
+        self.assertFalse(self.stats.accept('t', 3, 1003.0))
+        self.assertFalse(self.stats.accept('t', 2, 1002.0))
+        summary = self.stats.summary()['t']
+        self.assertEqual((summary['lost'], summary['duplicate'], summary['reordered']), (2, 1, 1))
+
+    def test_sequence_wraps_around(self):
+        self.assertTrue(self.stats.accept('t', sequence_modulus - 1, 1000.0))
+        self.assertTrue(self.stats.accept('t', 0, 1001.0))
+        self.assertEqual(self.stats.summary()['t']['lost'], 0)
+
+    def test_looped_replay_with_sequences(self):
+        for i in range(5):
+            self.assertTrue(self.stats.accept('t', i, 1000.0 + i))
+        for i in range(5):
+            self.assertTrue(self.stats.accept('t', 5 + i, 900.0 + i))
+        self.assertEqual(self.stats.summary()['t']['stale'], 0)
+
+    def test_looped_replay_without_sequences(self):
+        for i in range(5):
+            self.assertTrue(self.stats.accept('t', None, 1000.0 + i))
+        self.assertFalse(self.stats.accept('t', None, 1003.5))
+        for i in range(5):
+            self.assertTrue(self.stats.accept('t', None, 900.0 + i))
+        self.assertEqual(self.stats.summary()['t']['stale'], 1)
+
+    def test_server_restart_with_small_sequence(self):
+        for i in range(50):
+            self.stats.accept('t', i, 1000.0 + i)
+        # Restarted server starts numbering over but its times are newer.
+        self.assertTrue(self.stats.accept('t', 0, 1100.0))
+        self.assertTrue(self.stats.accept('t', 1, 1101.0))
+
+    def test_server_restart_without_times(self):
+        for i in range(50):
+            self.stats.accept('c', i)
+        # Can't tell it from reordering until a few come in one after another.
+        results = [self.stats.accept('c', i) for i in range(5)]
+        self.assertEqual(results, [False, False, True, True, True])
+
+    def test_reset_stream_positions(self):
+        self.stats.accept('t', 10, 1000.0)
+        self.stats.reset_stream_positions()
+        self.assertTrue(self.stats.accept('t', 5, 999.0))
+
+if __name__ == '__main__':
+    unittest.main()
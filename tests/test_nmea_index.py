@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+# Modules in pisc import each other directly so need to be on the path.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pisc'))
+
+from nmea_index import NMEALogIndex
+from checksum_utils import nmea_checksum
+
+def gga(utc_time):
+    '''Return GGA sentence at UTC time (hhmmss.ss).'''
+    data = 'GPGGA,{},3911.6402181,N,09634.4651967,W,4,11,1.0,318.958,M,-28.308,M,11.0,1015'.format(utc_time)
+    return '${}*{:02X}'.format(data, nmea_checksum(data))
+
+def write_log(directory, lines):
+    '''Write lines to a new log in directory and return its path.'''
+    path = os.path.join(directory, 'log.txt')
+    with open(path, 'w') as log_file:
+        log_file.write(''.join(line + '\n' for line in lines))
+    return path
+
+class TestNMEALogIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def index(self, lines):
+        '''Return index of log with lines.'''
+        log_index = NMEALogIndex(write_log(self.directory, lines))
+        self.addCleanup(log_index.close)
+        return log_index
+
+    def test_offset_at(self):
+        lines = [gga('120000.00'), gga('120000.00'), gga('120001.00'), gga('120002.00')]
+        log_index = self.index(lines)
+        line_offsets = [sum(len(line) + 1 for line in lines[:i]) for i in range(len(lines) + 1)]
+
+        self.assertEqual(len(log_index), 4)
+        self.assertEqual(log_index.start_time, 12 * 3600)
+        self.assertEqual(log_index.end_time, 12 * 3600 + 2)
+        self.assertEqual(log_index.offset_at(0), line_offsets[0])
+        self.assertEqual(log_index.offset_at(12 * 3600), line_offsets[0])
+        self.assertEqual(log_index.offset_at(12 * 3600 + 0.5), line_offsets[2])
+        self.assertEqual(log_index.offset_at(12 * 3600 + 1), line_offsets[2])
+        self.assertEqual(log_index.offset_at(13 * 3600), line_offsets[4])
+        self.assertEqual(log_index.offset_after(12 * 3600), line_offsets[2])
+
+    def test_log_passing_midnight(self):
+        lines = [gga('235959.00'), gga('000000.00'), gga('000001.00')]
+        log_index = self.index(lines)
+        second_offset = len(lines[0]) + 1
+
+        self.assertEqual(list(log_index.times), [86399, 86400, 86401])
+        self.assertEqual(log_index.log_time(0), 86400)
+        self.assertEqual(log_index.log_time(86399), 86399)
+        self.assertEqual(log_index.log_time(86400), 86400)
+        self.assertEqual(log_index.log_time(100), 100) # not in log so left alone
+        self.assertEqual(log_index.offset_at(log_index.log_time(0)), second_offset)
+
+    def test_sentences_without_time_are_skipped(self):
+        log_index = self.index(['garbage', gga('120000.00'), gga('')])
+        self.assertEqual(len(log_index), 1)
+        self.assertEqual(log_index.offset_at(0), len('garbage') + 1)
+
+    def test_sentences_between(self):
+        lines = [gga('120000.00'), gga('120001.00'), gga('120002.00')]
+        log_index = self.index(lines)
+        self.assertEqual(log_index.sentences_between(12 * 3600 + 1, 12 * 3600 + 2), lines[1:])
+
+    def test_saved_index_is_reused(self):
+        log_index = self.index([gga('120000.00'), gga('120001.00')])
+        self.assertTrue(os.path.exists(log_index.index_path))
+        # Make saved index different from what a rebuild would give so it's clear which one was used.
+        log_index.times[1] += 0.5
+        log_index._save()
+        reloaded = NMEALogIndex(log_index.file_path)
+        self.addCleanup(reloaded.close)
+        self.assertEqual(list(reloaded.times), [12 * 3600, 12 * 3600 + 1.5])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,285 @@
+#! /usr/bin/env python
+
+import sys
+import os
+import gc
+import json
+import time
+import argparse
+import platform
+import subprocess
+from timeit import default_timer
+
+# Modules in pisc import each other directly so need to be on the path.
+pisc_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pisc')
+sys.path.insert(0, pisc_directory)
+
+from checksum_utils import check_nmea_checksum
+from nmea_parser import check_and_parse_nmea_sentence
+from gps_ingest import Feedback, ReceiverGate, NMEASource, SentenceProcessor
+from gps_server import GPSServer
+from gps_protocol import binary_protocol
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None # not in python 2 unless pytracemalloc is installed
+
+try:
+    import resource
+except ImportError:
+    resource = None # windows
+
+# Bump whenever the output format changes so old results aren't compared against new ones by mistake.
+results_version = 2
+
+class BenchmarkServer(GPSServer):
+    '''
+    GPSServer that's never started and has no clients.  Every published message is still encoded the same way it
+    would be for a client that gets binary packets with sequence numbers, so the ingest benchmark covers encoding
+    but not sending.
+    '''
+    def __init__(self):
+        '''Constructor.'''
+        super(BenchmarkServer, self).__init__('127.0.0.1', 0)
+        self.sock.close() # never bound
+        self.publish_count = 0
+
+    def _publish(self, message):
+        '''Publish message like normal and then encode it like a client handler would.'''
+        super(BenchmarkServer, self)._publish(message)
+        message.encode(message.time_delay(), binary_protocol, True)
+        self.publish_count += 1
+
+def make_ingest(required_fix, required_precision):
+    '''
+    Return function that runs a sentence through the same parse/gate/publish/encode path as gps_startup.  Each one has
+    its own source, so a new one is needed for every pass through a log or its epochs would all look like they're late.
+    '''
+    # Feedback thread is never started so messages just fill up its queue and then get dropped like they
+    # would if the console couldn't keep up.
+    feedback = Feedback()
+    gate = ReceiverGate('benchmark', feedback, required_fix, required_precision)
+    source = NMEASource('benchmark', gate)
+    processor = SentenceProcessor(None, BenchmarkServer(), feedback)
+    read_time = time.time()
+    return lambda sentence: processor.process(source, sentence, read_time)
+
+def read_sentences(file_path):
+    '''Return list of every non-empty line in NMEA log.'''
+    with open(file_path, 'r') as log_file:
+        return [line.strip() for line in log_file if line.strip()]
+
+def percentile(sorted_values, percent):
+    '''Return value at percent (0 - 100) of sorted values using nearest rank.'''
+    if not sorted_values:
+        return float('NaN')
+    index = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+def measure_throughput(make_function, sentences, repeat):
+    '''Return best sentences per second out of repeat runs through every sentence, with a new function for each run.'''
+    best_duration = None
+    for _ in range(repeat):
+        function = make_function()
+        start_time = default_timer()
+        for sentence in sentences:
+            function(sentence)
+        duration = default_timer() - start_time
+        if best_duration is None or duration < best_duration:
+            best_duration = duration
+
+    if best_duration <= 0:
+        return float('NaN')
+    return len(sentences) / best_duration
+
+def measure_latency(make_function, sentences):
+    '''Return dictionary of per-sentence latency percentiles in microseconds.'''
+    function = make_function()
+    latencies = []
+    for sentence in sentences:
+        start_time = default_timer()
+        function(sentence)
+        latencies.append(default_timer() - start_time)
+
+    # Subtract the cost of reading the timer so it doesn't swamp really fast functions.
+    overhead = min(timer_overhead() for _ in range(5))
+    latencies = sorted(max(latency - overhead, 0) * 1e6 for latency in latencies)
+
+    return {'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99),
+            'max': latencies[-1] if latencies else float('NaN')}
+
+def timer_overhead(samples=1000):
+    '''Return average time in seconds it takes to read the timer twice.'''
+    start_time = default_timer()
+    for _ in range(samples):
+        default_timer()
+    return (default_timer() - start_time) / samples
+
+def measure_allocations(make_function, sentences):
+    '''
+    Return dictionary describing memory used per sentence.  Uses tracemalloc if it's available.  Otherwise falls
+    back on counting objects tracked by the garbage collector that are still alive after the run (to catch leaks)
+    and how much the peak resident memory of the process grew.
+    '''
+    count = max(len(sentences), 1)
+    function = make_function()
+
+    if tracemalloc is not None:
+        tracemalloc.start()
+        start_size, _ = tracemalloc.get_traced_memory()
+        for sentence in sentences:
+            function(sentence)
+        end_size, peak_size = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {'method': 'tracemalloc',
+                'retained_bytes_per_sentence': (end_size - start_size) / float(count),
+                'peak_bytes': peak_size - start_size}
+
+    gc.collect()
+    start_objects = len(gc.get_objects())
+    start_max_rss = max_rss_kb()
+    for sentence in sentences:
+        function(sentence)
+    gc.collect()
+    end_objects = len(gc.get_objects())
+
+    return {'method': 'gc',
+            'retained_gc_objects_per_sentence': (end_objects - start_objects) / float(count),
+            'max_rss_growth_kb': max_rss_kb() - start_max_rss if start_max_rss is not None else None}
+
+def max_rss_kb():
+    '''Return peak resident memory of this process in kilobytes, or None if it can't be found (e.g. on Windows).'''
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def benchmark(make_function, sentences, repeat):
+    '''
+    Return dictionary of throughput, latency and allocation results for running function on every sentence.
+    Make function is called to get a fresh function for every pass through the sentences.
+    '''
+    # Warm up caches (e.g. UTC date) so first run isn't penalized.
+    function = make_function()
+    for sentence in sentences[:100]:
+        function(sentence)
+
+    return {'sentences_per_second': measure_throughput(make_function, sentences, repeat),
+            'latency_us': measure_latency(make_function, sentences),
+            'allocations': measure_allocations(make_function, sentences)}
+
+def current_commit():
+    '''Return git commit hash of the repository this script is in, or None if it can't be found.'''
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=devnull,
+                                           cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline):
+    '''Print (to stderr so JSON output stays parseable) how much each throughput changed relative to baseline results.'''
+    if baseline.get('version') != results['version']:
+        print >> sys.stderr, 'Baseline has results version {} but expected {}.'.format(baseline.get('version'), results['version'])
+        return
+
+    print >> sys.stderr, 'Compared to baseline commit {}:'.format(baseline.get('commit'))
+    for file_name, file_results in sorted(results['files'].iteritems()):
+        baseline_file_results = baseline['files'].get(file_name)
+        if baseline_file_results is None:
+            continue
+        for stage, stage_results in sorted(file_results['stages'].iteritems()):
+            baseline_stage_results = baseline_file_results['stages'].get(stage)
+            if baseline_stage_results is None:
+                continue
+            new_rate = stage_results['sentences_per_second']
+            old_rate = baseline_stage_results['sentences_per_second']
+            if old_rate > 0:
+                print >> sys.stderr, '  {:<24} {:<9} {:>12.0f} -> {:>12.0f} sentences/s ({:+.1f}%)'.format(
+                    file_name, stage, old_rate, new_rate, (new_rate - old_rate) / old_rate * 100)
+
+if __name__ == '__main__':
+    '''
+    Benchmark checksum, parse and the full parse/gate/publish/encode ingest path over every NMEA log in a directory
+    and write results as JSON so they can be compared between commits.
+    '''
+    default_nmea_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'nmea')
+    default_repeat = 5
+    default_min_sentences = 20000
+
+    parser = argparse.ArgumentParser(description='Benchmark NMEA checksum, parsing and ingest.')
+    parser.add_argument('nmea_directory', nargs='?', default=default_nmea_directory, help='Directory of NMEA logs to benchmark. Default {}.'.format(default_nmea_directory))
+    parser.add_argument('-o', '--output', default='', help='Path to write JSON results to. Default is to print them.')
+    parser.add_argument('-c', '--compare', default='', help='Path to JSON results from an earlier run to compare against.')
+    parser.add_argument('-r', '--repeat', default=default_repeat, help='How many times to time each stage. Best time is used. Default {}.'.format(default_repeat))
+    parser.add_argument('-n', '--min_sentences', default=default_min_sentences, help='Small logs are repeated until they have at least this many sentences. Default {}.'.format(default_min_sentences))
+    parser.add_argument('-s', '--required_fix', default='none', help='Required GGA fix used by ingest gate. Default none.')
+    parser.add_argument('-z', '--required_precision', default=-1, help='Required precision used by ingest gate. Default -1 (not checked).')
+    args = parser.parse_args()
+
+    nmea_directory = args.nmea_directory
+    repeat = max(int(args.repeat), 1)
+    min_sentences = int(args.min_sentences)
+    required_fix = args.required_fix.lower()
+    required_precision = float(args.required_precision)
+
+    if not os.path.isdir(nmea_directory):
+        print 'Directory does not exist: {}'.format(nmea_directory)
+        sys.exit(1)
+
+    baseline = None
+    if args.compare != '':
+        try:
+            with open(args.compare, 'r') as baseline_file:
+                baseline = json.load(baseline_file)
+        except (IOError, ValueError) as e:
+            print 'Could not read baseline results {}: {}'.format(args.compare, e)
+            sys.exit(1)
+
+    # (stage name, function that returns the function to benchmark)
+    stages = [('checksum', lambda: check_nmea_checksum),
+              ('parse', lambda: check_and_parse_nmea_sentence),
+              ('ingest', lambda: make_ingest(required_fix, required_precision))]
+
+    results = {'version': results_version,
+               'commit': current_commit(),
+               'time': time.time(),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'repeat': repeat,
+               'files': {}}
+
+    file_names = sorted(file_name for file_name in os.listdir(nmea_directory) if file_name.endswith('.txt'))
+
+    for file_name in file_names:
+        sentences = read_sentences(os.path.join(nmea_directory, file_name))
+        if len(sentences) == 0:
+            continue
+
+        log_sentence_count = len(sentences)
+        if len(sentences) < min_sentences:
+            sentences = sentences * ((min_sentences + len(sentences) - 1) // len(sentences))
+
+        sys.stderr.write('Benchmarking {} ({} sentences)\n'.format(file_name, len(sentences)))
+
+        file_results = {'log_sentences': log_sentence_count,
+                        'benchmarked_sentences': len(sentences),
+                        'stages': {}}
+
+        for stage_name, make_function in stages:
+            file_results['stages'][stage_name] = benchmark(make_function, sentences, repeat)
+
+        results['files'][file_name] = file_results
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output == '':
+        print output
+    else:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+        sys.stderr.write('Wrote results to {}\n'.format(args.output))
+
+    if baseline is not None:
+        compare(results, baseline)